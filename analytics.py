@@ -0,0 +1,213 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import select, func
+from models import Base
+from db import create_erp_engine, database_url_from_secrets
+from units import CONVERSION_FACTORS
+import export
+
+# Columnar copy of the ERP tables in DuckDB for ad-hoc analytics.
+# Tables are synced from the primary (or the read replica) as Arrow batches; reports run as
+# vectorized SQL in-process and never touch MySQL. Only the append-only tables are synced
+# incrementally (new rows by id); the tables that change in place have no change timestamp to
+# sync by, so they are copied in full on every sync.
+
+ANALYTICS_PATH = os.environ.get('ERP_ANALYTICS_PATH', os.path.join(tempfile.gettempdir(), 'erp-analytics.duckdb'))
+SYNC_INTERVAL_SECONDS = 300
+
+# Rows in these tables are only inserted or deleted, so they are synced by id.
+# The other tables change in place (quantities, statuses) and are reloaded in full.
+APPEND_ONLY_TABLES = {'production_order_component', 'goods_receipt_line', 'sales_order_item', 'sales_order_item_batch', 'disposal_record', 'audit_log', 'quality_inspection'}
+SKIPPED_TABLES = {'api_idempotency_key', 'job', 'schema_migration', 'search_term'}
+
+REPORTS = {
+    'stock_ageing': ("Lageralder (materialer)", """
+        SELECT m.name AS materiale, b.unit AS enhed,
+               sum(b.quantity) FILTER (WHERE current_date - b.date <= 30) AS "0-30 dage",
+               sum(b.quantity) FILTER (WHERE current_date - b.date BETWEEN 31 AND 90) AS "31-90 dage",
+               sum(b.quantity) FILTER (WHERE current_date - b.date BETWEEN 91 AND 180) AS "91-180 dage",
+               sum(b.quantity) FILTER (WHERE current_date - b.date > 180) AS "over 180 dage",
+               max(current_date - b.date) AS "ældste batch (dage)"
+        FROM material_batch b JOIN material m ON m.id = b.material_id
+        WHERE b.quantity > 0
+        GROUP BY m.name, b.unit
+        ORDER BY "ældste batch (dage)" DESC
+    """),
+    'monthly_consumption': ("Forbrug pr. materiale pr. måned", """
+        SELECT date_trunc('month', po.date) AS måned, m.name AS materiale, m.unit AS enhed,
+               sum(c.quantity_used * coalesce(f.factor, 1)) AS forbrug,
+               count(DISTINCT po.id) AS produktionsordrer
+        FROM production_order_component c
+        JOIN production_order po ON po.id = c.production_order_id
+        JOIN material m ON m.id = c.component_material_id
+        LEFT JOIN unit_factor f ON f.from_unit = c.unit AND f.to_unit = m.unit
+        GROUP BY ALL
+        ORDER BY måned DESC, forbrug DESC
+    """),
+    'supplier_order_intervals': ("Leverandørers ordreinterval", """
+        WITH orders AS (
+            SELECT supplier_id, date, date - lag(date) OVER (PARTITION BY supplier_id ORDER BY date, id) AS days_since_previous
+            FROM purchase_order
+        ), lines AS (
+            SELECT po.supplier_id, count(*) AS linjer, count(DISTINCT i.material_id) AS materialer
+            FROM purchase_order_item i JOIN purchase_order po ON po.id = i.purchase_order_id
+            GROUP BY po.supplier_id
+        )
+        SELECT s.name AS leverandør, count(*) AS ordrer, min(o.date) AS første, max(o.date) AS seneste,
+               round(avg(o.days_since_previous), 1) AS "gns. dage mellem ordrer",
+               median(o.days_since_previous) AS "median dage",
+               round(stddev_samp(o.days_since_previous), 1) AS "spredning (dage)",
+               any_value(l.linjer) AS linjer, any_value(l.materialer) AS materialer
+        FROM orders o JOIN supplier s ON s.id = o.supplier_id
+        LEFT JOIN lines l ON l.supplier_id = o.supplier_id
+        GROUP BY s.name
+        ORDER BY ordrer DESC
+    """),
+    'disposals_by_reason': ("Kassationer pr. årsag og måned", """
+        SELECT date_trunc('month', d.date) AS måned, d.reason AS årsag,
+               coalesce(m.name, p.name) AS vare, d.unit AS enhed, sum(d.quantity) AS mængde, count(*) AS antal
+        FROM disposal_record d
+        LEFT JOIN material m ON m.id = d.material_id
+        LEFT JOIN product p ON p.id = d.product_id
+        GROUP BY ALL
+        ORDER BY måned DESC, mængde DESC
+    """),
+}
+
+class AnalyticsError(Exception):
+    pass
+
+class AnalyticsStore:
+    # One read-write DuckDB connection per process; threads get their own cursor.
+    # The ad-hoc queries on the "Analyse" page are written by the operators, so the database has no access
+    # to files or URLs (read_text, read_csv('http://...'), COPY, ATTACH, INSTALL) and its configuration is
+    # locked so a query cannot turn that back on. The sync only registers Arrow batches and needs neither.
+    # DuckDB opens a file once per process with one configuration, so this applies to the whole store
+    def __init__(self, path=ANALYTICS_PATH):
+        import duckdb
+        self.duckdb = duckdb
+        self.path = path
+        self.conn = duckdb.connect(path, config={'enable_external_access': False})
+        self.lock = threading.Lock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS _sync_state (table_name VARCHAR PRIMARY KEY, last_id BIGINT, synced_at TIMESTAMP)")
+        self.conn.execute("CREATE OR REPLACE TABLE unit_factor (from_unit VARCHAR, to_unit VARCHAR, factor DOUBLE)")
+        self.conn.executemany("INSERT INTO unit_factor VALUES (?, ?, ?)",
+                              [(f, t, factor) for (f, t), factor in CONVERSION_FACTORS.items()])
+        self.conn.execute("SET lock_configuration = true")
+
+    def last_synced(self):
+        row = self.conn.cursor().execute("SELECT min(synced_at) FROM _sync_state").fetchone()
+        return row[0] if row else None
+
+    def _arrow_chunks(self, engine, query, chunk_size):
+        import pyarrow as pa
+        schema = pa.schema([(c.name, export.arrow_type(c.type)) for c in query.selected_columns])
+        empty = True
+        for chunk in export.iter_chunks(engine, query, chunk_size):
+            empty = False
+            columns = list(zip(*chunk))
+            yield pa.Table.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema)
+        if empty:
+            # An empty batch still carries the schema, so empty source tables exist for the reports
+            yield pa.Table.from_pylist([], schema=schema)
+
+    def _load(self, cursor, engine, table_name, query, replace, chunk_size):
+        rows = 0
+        first = replace
+        for batch in self._arrow_chunks(engine, query, chunk_size):
+            cursor.register('_incoming', batch)
+            if first:
+                cursor.execute(f'CREATE OR REPLACE TABLE "{table_name}" AS SELECT * FROM _incoming')
+                first = False
+            else:
+                cursor.execute(f'INSERT INTO "{table_name}" SELECT * FROM _incoming')
+            cursor.unregister('_incoming')
+            rows += batch.num_rows
+        return rows
+
+    def _sync_table(self, cursor, engine, table, chunk_size):
+        query = export.table_query(table.name)
+        state = cursor.execute("SELECT last_id FROM _sync_state WHERE table_name = ?", [table.name]).fetchone()
+        columns = [name for (name,) in cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = ? ORDER BY ordinal_position", [table.name]).fetchall()]
+        # A new column in the ERP schema means the copy has to be rebuilt before rows can be appended
+        if table.name not in APPEND_ONLY_TABLES or state is None or columns != [c.name for c in query.selected_columns]:
+            rows = self._load(cursor, engine, table.name, query, True, chunk_size)
+        else:
+            # New rows by id. New ids are always above the watermark, so rows were deleted at the source only when
+            # it has fewer rows up to the watermark than the copy; only then are its ids compared
+            rows = self._load(cursor, engine, table.name, query.where(table.c.id > state[0]), False, chunk_size)
+            with engine.connect() as conn:
+                source_count = conn.execute(select(func.count()).select_from(table).where(table.c.id <= state[0])).scalar()
+            copy_count = cursor.execute(f'SELECT count(*) FROM "{table.name}" WHERE id <= ?', [state[0]]).fetchone()[0]
+            if source_count != copy_count:
+                self._load(cursor, engine, '_seen_ids', select(table.c.id), True, chunk_size * 10)
+                cursor.execute(f'DELETE FROM "{table.name}" WHERE id NOT IN (SELECT id FROM _seen_ids)')
+                cursor.execute("DROP TABLE _seen_ids")
+        # The watermark is the highest id actually copied, so rows inserted during the sync are picked up next time
+        last_id = cursor.execute(f'SELECT coalesce(max(id), 0) FROM "{table.name}"').fetchone()[0] if 'id' in table.c else 0
+        cursor.execute("INSERT OR REPLACE INTO _sync_state VALUES (?, ?, now())", [table.name, last_id])
+        return rows
+
+    def sync(self, engine, chunk_size=export.DEFAULT_CHUNK_SIZE):
+        started = time.monotonic()
+        rows = {}
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                for table in Base.metadata.sorted_tables:
+                    if table.name not in SKIPPED_TABLES:
+                        rows[table.name] = self._sync_table(cursor, engine, table, chunk_size)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        return {'rows': rows, 'seconds': round(time.monotonic() - started, 2)}
+
+    def sync_if_stale(self, engine, max_age_seconds=SYNC_INTERVAL_SECONDS):
+        last = self.last_synced()
+        if last is None or (time.time() - last.timestamp()) > max_age_seconds:
+            return self.sync(engine)
+        return None
+
+    def query(self, sql, params=None):
+        # Only single SELECT statements, so the query page cannot modify the store; reading files and
+        # URLs is refused by the connection itself
+        statements = self.duckdb.extract_statements(sql)
+        if len(statements) != 1 or statements[0].type != self.duckdb.StatementType.SELECT:
+            raise AnalyticsError("Kun én SELECT-forespørgsel ad gangen er tilladt.")
+        try:
+            return self.conn.cursor().execute(sql, params or []).df()
+        except self.duckdb.Error as e:
+            raise AnalyticsError(str(e))
+
+    def report(self, name):
+        return self.query(REPORTS[name][1])
+
+    def tables(self):
+        return [name for (name,) in self.conn.cursor().execute(
+            "SELECT table_name FROM information_schema.tables WHERE table_name NOT LIKE '\\_%' ESCAPE '\\' ORDER BY table_name").fetchall()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync the ERP database into DuckDB and run analytics reports.")
+    parser.add_argument("report", nargs="?", choices=sorted(REPORTS), help="Report to print after syncing")
+    parser.add_argument("--path", default=ANALYTICS_PATH, help="DuckDB file")
+    parser.add_argument("--sql", help="Run an ad-hoc SELECT instead of a report")
+    parser.add_argument("--url", help="Database URL (default: DATABASE_URL or DB_* environment variables)")
+    args = parser.parse_args(argv)
+
+    store = AnalyticsStore(args.path)
+    result = store.sync(create_erp_engine(args.url or database_url_from_secrets(os.environ)))
+    print(f"Synced {sum(result['rows'].values())} rows in {result['seconds']} s", file=sys.stderr)
+    if args.sql or args.report:
+        df = store.query(args.sql) if args.sql else store.report(args.report)
+        print(df.to_string(index=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
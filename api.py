@@ -0,0 +1,398 @@
+import contextlib
+import hashlib
+import json
+import os
+import secrets
+from datetime import date, datetime
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from models import Material, Product, Customer, Supplier, MaterialBatch, ProductBatch, IdempotencyKey, Site, SiteScoped
+from db import create_async_erp_engine, database_url_from_secrets
+from export import is_blob_column
+from units import CONVERSION_FACTORS
+import audit
+import migrations
+import search
+import services
+import sites
+
+# JSON API for scanners and the webshop.
+# Run with: uvicorn --factory api:create_app --workers 4
+# Writes go through services.py inside AsyncSession.run_sync, so the API and the
+# Streamlit pages share the same business rules.
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_OPERATIONS = 500
+
+class InvalidPayload(Exception):
+    pass
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+def _columns(model):
+    return [c for c in model.__table__.columns if not is_blob_column(c)]
+
+def _parse_date(value):
+    if value is None:
+        return date.today()
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise InvalidPayload(f"Ugyldig dato: {value}")
+
+def _site_id(request):
+    # X-Site: the production site the client works for; without it the API sees and writes for all sites
+    value = request.headers.get('X-Site')
+    return int(value) if value else None
+
+# JSON types of the payload fields; the services expect them and would otherwise fail with Python's own messages
+TYPE_NAMES = {int: "et heltal", float: "et tal", str: "en tekst", list: "en liste", bool: "true eller false",
+              date: "en dato (ÅÅÅÅ-MM-DD)"}
+
+def _checked(value, kind, name):
+    if kind is date:
+        with contextlib.suppress(TypeError, ValueError):
+            date.fromisoformat(value)
+            return value
+    elif kind is bool:
+        # Only JSON true/false; the string "false" would otherwise count as true
+        if isinstance(value, bool):
+            return value
+    elif not isinstance(value, bool) and isinstance(value, (int, float) if kind is float else kind):
+        return value
+    raise InvalidPayload(f"{name} skal være {TYPE_NAMES[kind]}.")
+
+def _require(payload, *fields):
+    # fields: (key, type); returns the values in that order
+    missing = [k for k, _ in fields if k not in payload]
+    if missing:
+        raise InvalidPayload(f"Mangler felter: {', '.join(missing)}")
+    return [_checked(payload[k], kind, k) for k, kind in fields]
+
+def _optional(payload, *fields):
+    # Only checked when present and not null
+    for key, kind in fields:
+        if payload.get(key) is not None:
+            _checked(payload[key], kind, key)
+
+def _objects(values, name, required=(), optional=(), nested=None):
+    # A list of objects with the given fields; nested checks a list inside each of them
+    for number, value in enumerate(values, start=1):
+        try:
+            if not isinstance(value, dict):
+                raise InvalidPayload("skal være et objekt.")
+            _require(value, *required)
+            _optional(value, *optional)
+            if nested is not None:
+                nested(value)
+        except InvalidPayload as e:
+            raise InvalidPayload(f"{name} nr. {number}: {e}")
+    return values
+
+def _units(session, model, lines, key, name):
+    # The unit of each line must be the item's unit or convert to it; convert_units would count an unknown unit 1:1.
+    # Unknown items are left to the service
+    item_units = dict(session.query(model.id, model.unit).filter(model.id.in_({line[key] for line in lines})).all())
+    for number, line in enumerate(lines, start=1):
+        item_unit = item_units.get(line[key])
+        if item_unit is not None and line['unit'] != item_unit and (line['unit'], item_unit) not in CONVERSION_FACTORS:
+            raise InvalidPayload(f"{name} nr. {number}: enheden {line['unit']} kan ikke omregnes til {item_unit}.")
+
+# Write operations: JSON payload -> service call
+def _purchase_order(session, payload):
+    supplier_id, items = _require(payload, ('supplier_id', int), ('items', list))
+    _optional(payload, ('status', str), ('checked', bool))
+    _objects(items, 'items', [('material_id', int), ('quantity', float), ('unit', str)],
+             [('batch_id', str), ('unit_cost', float), ('expiry_date', date)])
+    _units(session, Material, items, 'material_id', 'items')
+    return services.create_purchase_order(session, supplier_id, items, _parse_date(payload.get('date')),
+                                          checked=payload.get('checked') or False,
+                                          status=payload.get('status', services.RECEIVED))
+
+def _goods_receipt(session, payload):
+    # Missing line fields are reported per line by the service
+    supplier_id, lines = _require(payload, ('supplier_id', int), ('lines', list))
+    _optional(payload, ('delivery_note', str), ('checked', bool))
+    _objects(lines, 'lines', optional=[('purchase_order_item_id', int), ('quantity', float), ('batch_id', str),
+                                       ('unit_cost', float), ('expiry_date', date)])
+    return services.receive_goods(session, supplier_id, lines, _parse_date(payload.get('date')),
+                                  delivery_note=payload.get('delivery_note'), checked=payload.get('checked') or False)
+
+def _production_order(session, payload):
+    product_id, quantity, batch_id, allocations = _require(
+        payload, ('product_id', int), ('quantity', float), ('batch_id', str), ('allocations', list))
+    _optional(payload, ('expiry_date', date))
+    _objects(allocations, 'allocations', [('bom_id', int), ('batch_id', int), ('quantity', float)])
+    return services.produce(session, product_id, quantity, batch_id, _parse_date(payload.get('date')), allocations,
+                            expiry_date=payload.get('expiry_date'))
+
+def _sales_order(session, payload):
+    customer_id, lines = _require(payload, ('customer_id', int), ('lines', list))
+    _objects(lines, 'lines', [('product_id', int), ('quantity', float), ('unit', str), ('allocations', list)],
+             nested=lambda line: _objects(line['allocations'], 'allocations', [('batch_id', int), ('quantity', float)]))
+    _units(session, Product, lines, 'product_id', 'lines')
+    return services.sell(session, customer_id, _parse_date(payload.get('date')), lines)
+
+def _disposal(session, payload):
+    kind, batch_id, quantity, reason = _require(payload, ('kind', str), ('batch_id', int), ('quantity', float), ('reason', str))
+    return services.dispose(session, kind, batch_id, quantity, reason, _parse_date(payload.get('date')))
+
+def _quality_inspection(session, payload):
+    # lines: [{batch_id, result, notes}]; result and notes at the top level apply to every line
+    lines, = _require(payload, ('lines', list))
+    _optional(payload, ('result', str), ('notes', str))
+    _objects(lines, 'lines', optional=[('batch_id', int), ('result', str), ('notes', str)])
+    return services.record_inspections(session, lines, session.info.get('audit_actor'),
+                                       result=payload.get('result'), notes=payload.get('notes'))
+
+OPERATIONS = {
+    'purchase_order': _purchase_order,
+    'goods_receipt': _goods_receipt,
+    'production_order': _production_order,
+    'sales_order': _sales_order,
+    'disposal': _disposal,
+    'quality_inspection': _quality_inspection,
+}
+
+def _request_hash(operations):
+    return hashlib.sha256(json.dumps(operations, sort_keys=True, default=str).encode()).hexdigest()
+
+def _stored_response(session, key, endpoint, request_hash):
+    stored = session.get(IdempotencyKey, key)
+    if stored is None:
+        return None
+    # A key only replays the request it was sent with; reused for another endpoint or payload the request is
+    # rejected, as replaying the stored answer would report an operation that never ran
+    if stored.endpoint != endpoint or (stored.request_hash is not None and stored.request_hash != request_hash):
+        return 422, {'error': 'Idempotency-Key er allerede brugt til en anden forespørgsel.'}
+    return stored.status_code, json.loads(stored.response)
+
+def _execute(session, endpoint, operations, idempotency_key):
+    # Runs synchronously inside AsyncSession.run_sync: one transaction for all operations
+    site_id = sites.current(session)
+    if site_id is not None and session.get(Site, site_id) is None:
+        return 400, {'error': f'Produktionsstedet {site_id} findes ikke.'}
+    request_hash = _request_hash(operations)
+    if idempotency_key:
+        stored = _stored_response(session, idempotency_key, endpoint, request_hash)
+        if stored is not None:
+            return stored
+    results = []
+    for index, (name, payload) in enumerate(operations):
+        try:
+            if name not in OPERATIONS:
+                raise InvalidPayload(f"Ukendt operation: {name}")
+            if not isinstance(payload, dict):
+                raise InvalidPayload("Operationens data skal være et objekt.")
+            obj = OPERATIONS[name](session, payload)
+        except InvalidPayload as e:
+            session.rollback()
+            return 400, {'error': str(e), 'index': index}
+        except services.ServiceError as e:
+            session.rollback()
+            return 422, {'error': str(e), 'index': index}
+        # Bulk operations answer with their counts instead of a created row
+        results.append(dict(obj, type=name) if isinstance(obj, dict) else {'type': name, 'id': obj.id})
+    body = {'results': results}
+    if idempotency_key:
+        session.add(IdempotencyKey(key=idempotency_key, endpoint=endpoint, request_hash=request_hash, status_code=201,
+                                   response=json.dumps(body), created_at=datetime.now()))
+    try:
+        session.commit()
+    except IntegrityError:
+        # A concurrent request with the same key committed first; return its response instead
+        session.rollback()
+        stored = _stored_response(session, idempotency_key, endpoint, request_hash) if idempotency_key else None
+        if stored is None:
+            raise
+        return stored
+    return 201, body
+
+async def _write(request, endpoint, operations):
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= 80:
+        return JSONResponse({'error': 'Idempotency-Key skal være 1-80 tegn.'}, status_code=400)
+    try:
+        site_id = _site_id(request)
+    except ValueError:
+        return JSONResponse({'error': 'Ugyldig X-Site.'}, status_code=400)
+    async with request.app.state.sessionmaker() as session:
+        # No per-user logins behind the shared token; clients name themselves for the audit log
+        audit.set_actor(session, request.headers.get('X-User') or 'api')
+        sites.scope(session, site_id)
+        status_code, body = await session.run_sync(_execute, endpoint, operations, key)
+    return JSONResponse(body, status_code=status_code)
+
+async def _read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise InvalidPayload("Ugyldig JSON.")
+
+def operation_endpoint(name):
+    async def endpoint(request):
+        try:
+            payload = await _read_json(request)
+        except InvalidPayload as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        response = await _write(request, name, [(name, payload)])
+        if response.status_code == 201:
+            body = json.loads(response.body)
+            return JSONResponse(body['results'][0], status_code=201)
+        return response
+    return endpoint
+
+async def batch(request):
+    try:
+        payload = await _read_json(request)
+    except InvalidPayload as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    operations = payload.get('operations') if isinstance(payload, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return JSONResponse({'error': 'operations skal være en ikke-tom liste.'}, status_code=400)
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return JSONResponse({'error': f'Højst {MAX_BATCH_OPERATIONS} operationer pr. kald.'}, status_code=400)
+    try:
+        parsed = [(op['type'], op.get('data')) for op in operations]
+    except (KeyError, TypeError, AttributeError):
+        return JSONResponse({'error': 'Hver operation skal have type og data.'}, status_code=400)
+    return await _write(request, 'batch', parsed)
+
+# Read endpoints with keyset pagination (?after_id=&limit=)
+def _limit(params, default):
+    limit = int(params.get('limit', default))
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise InvalidPayload(f"limit skal være mellem 1 og {MAX_PAGE_SIZE}.")
+    return limit
+
+def list_endpoint(model, filters=()):
+    columns = _columns(model)
+
+    async def endpoint(request):
+        params = request.query_params
+        try:
+            limit = _limit(params, DEFAULT_PAGE_SIZE)
+            after_id = int(params.get('after_id', 0))
+            query = select(*columns).where(model.id > after_id).order_by(model.id).limit(limit)
+            for param, build in filters:
+                if param in params:
+                    query = query.where(build(params[param]))
+            site_id = _site_id(request)
+            if site_id is not None and issubclass(model, SiteScoped):
+                query = query.where(model.site_id == site_id)
+        except InvalidPayload as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        except ValueError:
+            return JSONResponse({'error': 'Ugyldig parameter.'}, status_code=400)
+        async with request.app.state.sessionmaker() as session:
+            rows = (await session.execute(query)).mappings().all()
+        items = [{k: _json_value(v) for k, v in row.items()} for row in rows]
+        next_after = items[-1]['id'] if len(items) == limit else None
+        return JSONResponse({'items': items, 'next_after_id': next_after})
+    return endpoint
+
+def detail_endpoint(model):
+    columns = _columns(model)
+
+    async def endpoint(request):
+        async with request.app.state.sessionmaker() as session:
+            row = (await session.execute(select(*columns).where(model.id == request.path_params['id']))).mappings().first()
+        if row is None:
+            return JSONResponse({'error': 'Ikke fundet.'}, status_code=404)
+        return JSONResponse({k: _json_value(v) for k, v in row.items()})
+    return endpoint
+
+def _available(model):
+    return lambda value: model.available == (value in ('1', 'true'))
+
+async def search_endpoint(request):
+    # ?q=&type=customer&type=supplier&limit=
+    params = request.query_params
+    entities = [e for e in params.getlist('type') if e in search.ENTITIES] or None
+    try:
+        limit = _limit(params, search.DEFAULT_LIMIT)
+    except InvalidPayload as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except ValueError:
+        return JSONResponse({'error': 'Ugyldig parameter.'}, status_code=400)
+    async with request.app.state.sessionmaker() as session:
+        results = await session.run_sync(search.search, params.get('q', ''), entities, limit)
+    return JSONResponse({'items': results})
+
+async def health(request):
+    return JSONResponse({'status': 'ok'})
+
+class TokenMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, token):
+        super().__init__(app)
+        self.token = token
+
+    async def dispatch(self, request, call_next):
+        if request.url.path != '/health':
+            supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+            if not secrets.compare_digest(supplied, self.token):
+                return JSONResponse({'error': 'Ikke autoriseret.'}, status_code=401)
+        return await call_next(request)
+
+routes = [
+    Route('/health', health),
+    Route('/materials', list_endpoint(Material)),
+    Route('/materials/{id:int}', detail_endpoint(Material)),
+    Route('/products', list_endpoint(Product)),
+    Route('/products/{id:int}', detail_endpoint(Product)),
+    Route('/customers', list_endpoint(Customer)),
+    Route('/suppliers', list_endpoint(Supplier)),
+    Route('/search', search_endpoint),
+    Route('/material-batches', list_endpoint(MaterialBatch, [
+        ('material_id', lambda v: MaterialBatch.material_id == int(v)),
+        ('available', _available(MaterialBatch)),
+        ('qc_status', lambda v: MaterialBatch.qc_status == v),
+    ])),
+    Route('/product-batches', list_endpoint(ProductBatch, [
+        ('product_id', lambda v: ProductBatch.product_id == int(v)),
+        ('available', _available(ProductBatch)),
+    ])),
+    Route('/purchase-orders', operation_endpoint('purchase_order'), methods=['POST']),
+    Route('/goods-receipts', operation_endpoint('goods_receipt'), methods=['POST']),
+    Route('/production-orders', operation_endpoint('production_order'), methods=['POST']),
+    Route('/sales-orders', operation_endpoint('sales_order'), methods=['POST']),
+    Route('/disposals', operation_endpoint('disposal'), methods=['POST']),
+    Route('/quality-inspections', operation_endpoint('quality_inspection'), methods=['POST']),
+    Route('/batch', batch, methods=['POST']),
+]
+
+def create_app(url=None, token=None):
+    url = url or database_url_from_secrets(os.environ)
+    token = token or os.environ.get('API_TOKEN')
+    engine_options = {}
+    if not url.startswith('sqlite'):
+        engine_options = dict(
+            pool_size=int(os.environ.get('API_POOL_SIZE', 20)),
+            max_overflow=int(os.environ.get('API_MAX_OVERFLOW', 20)),
+            pool_recycle=3600,
+            pool_pre_ping=True,
+        )
+    engine = create_async_erp_engine(url, **engine_options)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        async with engine.connect() as conn:
+            await conn.run_sync(migrations.upgrade)
+        audit.start(url, 'api')
+        app.state.sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+        yield
+        await engine.dispose()
+        audit.flush()
+
+    middleware = [Middleware(TokenMiddleware, token=token)] if token else []
+    return Starlette(routes=routes, middleware=middleware, lifespan=lifespan)
@@ -1,332 +1,247 @@
 import streamlit as st
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Date, Boolean, Text
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-from sqlalchemy.dialects.mysql import LONGBLOB
+import altair as alt
+from sqlalchemy import func, true
+from sqlalchemy.orm import sessionmaker, selectinload
 import pandas as pd
 import base64
 from PIL import Image
 import io
-from datetime import datetime
-from streamlit_option_menu import option_menu
 import os
+import tempfile
+from datetime import datetime, timedelta
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit_option_menu import option_menu
+from models import (
+    Base, Product, Material, Customer, Supplier, Recipe, BoM, ProductionOrder,
+    SalesOrder, MaterialBatch, ProductBatch, PurchaseOrder, PurchaseOrderItem, GoodsReceipt, GoodsReceiptLine, ProductionLine,
+    QC_PENDING, QC_RELEASED, QC_HELD
+)
+from units import convert_units
+from db import (
+    cert_path, create_erp_engine, create_read_engine, database_url_from_secrets, read_database_url_from_secrets,
+    read_sticky_seconds, ReadSession, ReadYourWrites
+)
+import analytics
+import attachments
+import availability
+import audit
+import export
+import costing
+import migrations
+import planning
+import replenishment
+import instrumentation
+import search
+import services
+import sites
+import snapshots
+import jobs
 
-Base = declarative_base()
-
-# Database credentials
-db_user = st.secrets['DB_USER']
-db_password = st.secrets['DB_PASSWORD']
-db_host = st.secrets['DB_HOST']
-db_port = st.secrets['DB_PORT']
-db_name = st.secrets['DB_NAME']
-
-class Product(Base):
-    __tablename__ = 'product'
-    id = Column(Integer, primary_key=True)
-    name = Column(String(80), nullable=False)
-    quantity = Column(Float, default=0.0, nullable=False)
-    unit = Column(String(20), nullable=False, default='stk')
-
-class Material(Base):
-    __tablename__ = 'material'
-    id = Column(Integer, primary_key=True)
-    name = Column(String(80), nullable=False)
-    producer_name = Column(String(80), nullable=True)
-    unit = Column(String(20), nullable=False)
-    quantity = Column(Float, default=0.0, nullable=False)
-
-class Customer(Base):
-    __tablename__ = 'customer'
-    id = Column(Integer, primary_key=True)
-    name = Column(String(80), nullable=False)
-    address = Column(String(120), nullable=False)
-    contact_email = Column(String(80), nullable=False)
-    phone_number = Column(String(20), nullable=False)
-    vat_number = Column(String(20), nullable=False)
-
-class Supplier(Base):
-    __tablename__ = 'supplier'
-    id = Column(Integer, primary_key=True)
-    name = Column(String(80), nullable=False)
-    address = Column(String(120), nullable=False)
-    contact_email = Column(String(80), nullable=False)
-    phone_number = Column(String(20), nullable=False)
-    vat_number = Column(String(20), nullable=False)
-    organic_number = Column(String(80), nullable=True)
-    report_file = Column(LONGBLOB, nullable=True)
-    report_filename = Column(String(255), nullable=True)
-    report_mimetype = Column(String(50), nullable=True)
-
-class Recipe(Base):
-    __tablename__ = 'recipe'
-    id = Column(Integer, primary_key=True)
-    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
-    method = Column(Text, nullable=True)
-    output_quantity = Column(Float, nullable=False)
-
-class BoM(Base):
-    __tablename__ = 'bom'
-    id = Column(Integer, primary_key=True)
-    recipe_id = Column(Integer, ForeignKey('recipe.id'), nullable=False)
-    component_material_id = Column(Integer, ForeignKey('material.id'), nullable=True)
-    component_product_id = Column(Integer, ForeignKey('product.id'), nullable=True)
-    quantity_required = Column(Float, nullable=False)
-    unit = Column(String(20), nullable=False)
-
-class ProductionOrder(Base):
-    __tablename__ = 'production_order'
-    id = Column(Integer, primary_key=True)
-    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
-    quantity = Column(Float, nullable=False)
-    status = Column(String(20), default='Afventer', nullable=False)
-    batch_id = Column(String(80), nullable=False)
-    date = Column(Date, nullable=False)
-
-class ProductionOrderComponent(Base):
-    __tablename__ = 'production_order_component'
-    id = Column(Integer, primary_key=True)
-    production_order_id = Column(Integer, ForeignKey('production_order.id'), nullable=False)
-    component_material_id = Column(Integer, ForeignKey('material.id'), nullable=True)
-    component_product_id = Column(Integer, ForeignKey('product.id'), nullable=True)
-    batch_id = Column(Integer, nullable=False)
-    quantity_used = Column(Float, nullable=False)
-    unit = Column(String(20), nullable=False)
-
-class SalesOrder(Base):
-    __tablename__ = 'sales_order'
-    id = Column(Integer, primary_key=True)
-    customer_id = Column(Integer, ForeignKey('customer.id'), nullable=False)
-    status = Column(String(20), default='Afventer', nullable=False)
-    date = Column(Date, nullable=False)
-    items = relationship('SalesOrderItem', backref='sales_order', cascade="all,delete-orphan")
-
-class SalesOrderItem(Base):
-    __tablename__ = 'sales_order_item'
-    id = Column(Integer, primary_key=True)
-    sales_order_id = Column(Integer, ForeignKey('sales_order.id'), nullable=False)
-    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
-    quantity = Column(Float, nullable=False)
-    unit = Column(String(20), nullable=False)
-
-class MaterialBatch(Base):
-    __tablename__ = 'material_batch'
-    id = Column(Integer, primary_key=True)
-    material_id = Column(Integer, ForeignKey('material.id'), nullable=False)
-    batch_id = Column(String(80), nullable=False)
-    quantity = Column(Float, nullable=False)
-    unit = Column(String(20), nullable=False)
-    date = Column(Date, nullable=False)
-    checked = Column(Boolean, default=False, nullable=False)
-
-class ProductBatch(Base):
-    __tablename__ = 'product_batch'
-    id = Column(Integer, primary_key=True)
-    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
-    batch_id = Column(String(80), nullable=False)
-    quantity = Column(Float, nullable=False)
-    unit = Column(String(20), nullable=False)
-    date = Column(Date, nullable=False)
-
-class DisposalRecord(Base):
-    __tablename__ = 'disposal_record'
-    id = Column(Integer, primary_key=True)
-    material_id = Column(Integer, ForeignKey('material.id'), nullable=True)
-    product_id = Column(Integer, ForeignKey('product.id'), nullable=True)
-    batch_id = Column(Integer, nullable=False)
-    quantity = Column(Float, nullable=False)
-    unit = Column(String(20), nullable=False)
-    reason = Column(String(255), nullable=False)
-    date = Column(Date, nullable=False)
-
-class PurchaseOrder(Base):
-    __tablename__ = 'purchase_order'
-    id = Column(Integer, primary_key=True)
-    supplier_id = Column(Integer, ForeignKey('supplier.id'), nullable=False)
-    date = Column(Date, nullable=False)
-    checked = Column(Boolean, default=False, nullable=False)
-    invoice_file = Column(LONGBLOB, nullable=True)
-    invoice_filename = Column(String(255), nullable=True)
-    invoice_mimetype = Column(String(50), nullable=True)
-    items = relationship('PurchaseOrderItem', backref='purchase_order')
-
-class PurchaseOrderItem(Base):
-    __tablename__ = 'purchase_order_item'
-    id = Column(Integer, primary_key=True)
-    purchase_order_id = Column(Integer, ForeignKey('purchase_order.id'), nullable=False)
-    material_id = Column(Integer, ForeignKey('material.id'), nullable=False)
-    batch_id = Column(String(80), nullable=False)
-    quantity = Column(Float, nullable=False)
-    unit = Column(String(20), nullable=False)
-
-cert_path = os.path.join(os.path.dirname(__file__), "certs", "DigiCertGlobalRootCA.crt.pem")
 if not os.path.exists(cert_path):
     st.error("Certificate file not found. Please verify the path.")
 
-engine = create_engine(
-    f'mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}',
-    connect_args={
-        'ssl': {
-            'ssl_ca': cert_path
-        }
-    }
-)
-Base.metadata.create_all(engine)
+@st.cache_resource
+def get_engines():
+    # One pool per server process; reporting reads get their own engine when a replica or mirror is configured
+    engine = create_erp_engine(database_url_from_secrets(st.secrets), pool_pre_ping=True, pool_recycle=3600)
+    with engine.connect() as conn:
+        migrations.upgrade(conn)
+    audit.start(database_url_from_secrets(st.secrets), 'app')
+    read_url = read_database_url_from_secrets(st.secrets)
+    read_engine = create_read_engine(read_url, pool_pre_ping=True) if read_url else None
+    for e in (engine, read_engine):
+        if e is not None:
+            instrumentation.install(e, Base)
+    return engine, read_engine
+
+engine, read_engine = get_engines()
+instrumentation.start("ERP System")
+# The pool is shared across reruns now, so sessions a previous rerun left open (st.stop, exceptions) are closed here
+for previous_session in st.session_state.get("db_sessions", ()):
+    previous_session.close()
+if "read_your_writes" not in st.session_state:
+    st.session_state.read_your_writes = ReadYourWrites(read_sticky_seconds(st.secrets))
 DBSession = sessionmaker(bind=engine)
-session = DBSession()
+session = st.session_state.read_your_writes.track(DBSession())
+# Lists and reports read through read_session; edits and service calls use session (the primary)
+read_session = ReadSession(bind=engine, replica=read_engine, consistency=st.session_state.read_your_writes)
+st.session_state.db_sessions = (session, read_session)
+if "METRICS_PORT" in st.secrets:
+    instrumentation.serve_metrics(st.secrets["METRICS_PORT"], st.secrets.get("METRICS_HOST", "127.0.0.1"))
 
 st.set_page_config(layout="wide")
 
-# Caching functions
-@st.cache_data(show_spinner=False)
-def get_all_materials():
-    return session.query(Material).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_products():
-    return session.query(Product).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_customers():
-    return session.query(Customer).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_suppliers():
-    return session.query(Supplier).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_boms():
-    return session.query(BoM).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_production_orders():
-    return session.query(ProductionOrder).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_sales_orders():
-    return session.query(SalesOrder).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_purchase_orders():
-    return session.query(PurchaseOrder).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_material_batches():
-    return session.query(MaterialBatch).all()
-
-@st.cache_data(show_spinner=False)
-def get_all_product_batches():
-    return session.query(ProductBatch).all()
+@st.cache_resource
+def get_job_queue():
+    # With JOB_WORKER set, the standalone worker runs the jobs and the app only queues them
+    queue = jobs.JobQueue(database_url_from_secrets(st.secrets), run_jobs=not st.secrets.get("JOB_WORKER", False))
+    queue.recover()
+    return queue
+
+@st.cache_resource
+def get_analytics_store():
+    return analytics.AnalyticsStore()
+
+# Lists every page picks from. They are shared snapshots (snapshots.py), loaded once per process and
+# version instead of copied into every session; orders and batches per site, as read_session is scoped to it
+SNAPSHOTS = {
+    'materials': lambda: snapshots.rows(read_session, Material),
+    'products': lambda: snapshots.rows(read_session, Product),
+    'customers': lambda: snapshots.rows(read_session, Customer),
+    'suppliers': lambda: snapshots.rows(read_session, Supplier),
+    'boms': lambda: snapshots.rows(read_session, BoM),
+    'production_orders': lambda: snapshots.rows(read_session, ProductionOrder),
+    'sales_orders': lambda: snapshots.rows(read_session, SalesOrder),
+    'purchase_orders': lambda: snapshots.rows(read_session, PurchaseOrder),
+    # Only batches with stock left; consumed ones stay in the table for history
+    'material_batches': lambda: snapshots.rows(read_session, MaterialBatch, MaterialBatch.available == true()),
+    'product_batches': lambda: snapshots.rows(read_session, ProductBatch, ProductBatch.available == true()),
+}
+SITE_SNAPSHOTS = {'production_orders', 'sales_orders', 'purchase_orders', 'material_batches', 'product_batches'}
+
+def snapshot_key(name):
+    return site_id if name in SITE_SNAPSHOTS else None
+
+def refresh_snapshot(name):
+    snapshots.refresh(st.session_state, name, snapshot_key(name), SNAPSHOTS[name])
+
+@instrumentation.cached(st.cache_data(show_spinner=False))
+def get_all_sites():
+    return sites.all_sites(read_session)
 
 def refresh_materials():
-    get_all_materials.clear()
-    st.session_state.materials = get_all_materials()
+    refresh_snapshot('materials')
 
 def refresh_products():
-    get_all_products.clear()
-    st.session_state.products = get_all_products()
+    refresh_snapshot('products')
 
 def refresh_customers():
-    get_all_customers.clear()
-    st.session_state.customers = get_all_customers()
+    refresh_snapshot('customers')
 
 def refresh_suppliers():
-    get_all_suppliers.clear()
-    st.session_state.suppliers = get_all_suppliers()
+    refresh_snapshot('suppliers')
 
 def refresh_boms():
-    get_all_boms.clear()
-    st.session_state.boms = get_all_boms()
+    refresh_snapshot('boms')
+
+def refresh_sites():
+    get_all_sites.clear()
 
 def refresh_production_orders():
-    get_all_production_orders.clear()
-    st.session_state.production_orders = get_all_production_orders()
+    refresh_snapshot('production_orders')
 
 def refresh_sales_orders():
-    get_all_sales_orders.clear()
-    st.session_state.sales_orders = get_all_sales_orders()
+    refresh_snapshot('sales_orders')
 
 def refresh_purchase_orders():
-    get_all_purchase_orders.clear()
-    st.session_state.purchase_orders = get_all_purchase_orders()
+    refresh_snapshot('purchase_orders')
 
 def refresh_material_batches():
-    get_all_material_batches.clear()
-    st.session_state.material_batches = get_all_material_batches()
+    refresh_snapshot('material_batches')
 
 def refresh_product_batches():
-    get_all_product_batches.clear()
-    st.session_state.product_batches = get_all_product_batches()
-
-def convert_units(quantity, from_unit, to_unit):
-    conversion_factors = {
-        ('kg', 'g'): 1000,
-        ('g', 'kg'): 0.001,
-        ('l', 'ml'): 1000,
-        ('ml', 'l'): 0.001,
-    }
-    if from_unit == to_unit:
-        return quantity
-    return quantity * conversion_factors.get((from_unit, to_unit), 1)
-
-# Initialize session state
-if "materials" not in st.session_state:
-    st.session_state.materials = get_all_materials()
-
-if "products" not in st.session_state:
-    st.session_state.products = get_all_products()
-
-if "customers" not in st.session_state:
-    st.session_state.customers = get_all_customers()
-
-if "suppliers" not in st.session_state:
-    st.session_state.suppliers = get_all_suppliers()
-
-if "boms" not in st.session_state:
-    st.session_state.boms = get_all_boms()
-
-if "production_orders" not in st.session_state:
-    st.session_state.production_orders = get_all_production_orders()
-
-if "sales_orders" not in st.session_state:
-    st.session_state.sales_orders = get_all_sales_orders()
-
-if "purchase_orders" not in st.session_state:
-    st.session_state.purchase_orders = get_all_purchase_orders()
-
-if "material_batches" not in st.session_state:
-    st.session_state.material_batches = get_all_material_batches()
-
-if "product_batches" not in st.session_state:
-    st.session_state.product_batches = get_all_product_batches()
+    refresh_snapshot('product_batches')
+
+def production_availability(force=False):
+    # Shared by the sessions of a site; the products whose components changed are evaluated again when a
+    # batch list gets a new version. Stock is read from the primary, so it is never older than that version
+    return availability.current(
+        session, site_id,
+        tuple(snapshots.version(name, snapshot_key(name)) for name in ('materials', 'products', 'boms')),
+        tuple(snapshots.version(name, snapshot_key(name)) for name in ('material_batches', 'product_batches')),
+        force)
+
+def show_attachment(attachment_id, download_label):
+    # From the primary: a read mirror only has the attachment blobs when it was refreshed with them
+    attachment = attachments.load(session, attachment_id)
+    if attachment is None:
+        return False
+    data, filename, mimetype = attachment
+    if mimetype == 'application/pdf':
+        b64_pdf = base64.b64encode(data).decode('utf-8')
+        pdf_display = f'<iframe src="data:application/pdf;base64,{b64_pdf}" width="700" height="1000" type="application/pdf"></iframe>'
+        st.markdown(pdf_display, unsafe_allow_html=True)
+    elif mimetype and mimetype.startswith('image/'):
+        st.image(Image.open(io.BytesIO(data)))
+    else:
+        st.download_button(download_label, data=data, file_name=filename, mime=mimetype)
+    return True
+
+# Site: fixed per deployment with SITE_ID in the secrets, otherwise chosen in the sidebar when there are several
+all_sites = get_all_sites()
+site_names = {s.id: s.name for s in all_sites}
+if "SITE_ID" in st.secrets:
+    site_id = int(st.secrets["SITE_ID"])
+elif len(all_sites) > 1:
+    site_id = st.sidebar.selectbox("Produktionssted", list(site_names), format_func=site_names.get, key="site_id")
+else:
+    site_id = all_sites[0].id if all_sites else None
+sites.scope(session, site_id)
+sites.scope(read_session, site_id)
+# New sessions, sessions that changed site and sessions released while idle get the current lists here
+for name, load in SNAPSHOTS.items():
+    snapshots.attach(st.session_state, name, snapshot_key(name), load)
 
 with st.sidebar:
     st.title("ERP System")
+    search_query = st.text_input("Søg", key="global_search", placeholder="Kunder, leverandører, materialer, produkter, opskrifter")
     st.header("Handlinger")
     action = option_menu(
         menu_title=None,
         options=[
-            "Opret et nyt materiale", "Køb noget", "Producer noget", "Opret en ny opskrift / stykliste",
-            "Sælg noget", "Flyt noget", "Smid noget ud", "Opret en ny kunde", "Opret en ny leverandør", "Administrationsside"
+            "Opret et nyt materiale", "Køb noget", "Varemodtagelse", "Kvalitetskontrol", "Producer noget", "Kan produceres", "Opret en ny opskrift / stykliste",
+            "Sælg noget", "Flyt noget", "Smid noget ud", "Opret en ny kunde", "Opret en ny leverandør", "Produktionsplan", "Genbestilling", "Kostpriser", "Eksporter data", "Analyse", "Baggrundsjob", "Administrationsside"
         ],
         icons=[
-            "file-plus", "cart-plus", "gear", "clipboard",
-            "cart", "arrows-move", "trash", "person-plus", "truck", "tools"
+            "file-plus", "cart-plus", "box-seam", "clipboard-check", "gear", "check2-square", "clipboard",
+            "cart", "arrows-move", "trash", "person-plus", "truck", "calendar-week", "arrow-repeat", "cash-coin", "download", "bar-chart", "hourglass-split", "tools"
         ],
         menu_icon="cast",
         default_index=0,
     )
+instrumentation.set_label(action)
+
+def authenticated_user():
+    # Streamlit login, or the user an authenticating reverse proxy passes on
+    try:
+        if st.user.is_logged_in:
+            return st.user.get("email") or st.user.get("name")
+    except Exception:
+        pass
+    headers = st.context.headers
+    return headers.get("X-Forwarded-Email") or headers.get("X-Forwarded-User")
+
+current_user = authenticated_user()
+if current_user is None:
+    current_user = st.sidebar.text_input("Dit navn (til ændringsloggen)", key="audit_user").strip() or None
+audit.set_actor(session, current_user)
+audit.set_actor(read_session, current_user)
 
 st.header("ERP System")
 
+if search_query.strip():
+    with st.container(border=True):
+        results = search.search(read_session, search_query)
+        st.subheader(f"Søgeresultater for '{search_query.strip()}'")
+        if results:
+            st.dataframe(pd.DataFrame([
+                {"Type": search.LABELS[r['entity']], "ID": r['id'], "Navn": r['label'], "Fundet i": r['match'], "Relevans": r['score']}
+                for r in results
+            ]), hide_index=True)
+        else:
+            st.info("Ingen resultater.")
+
 if action == "Administrationsside":
     st.header("Administrationsside")
     management_option = st.selectbox(
         "Vælg, hvad du vil administrere",
-        ["Materialer", "Produkter", "Kunder", "Leverandører", "Styklister (BoM)", "Produktionsordrer", "Salgsordrer", "Indkøbsordrer", "Materiale Batches", "Produkt Batches"]
+        ["Materialer", "Produkter", "Kunder", "Leverandører", "Styklister (BoM)", "Produktionsordrer", "Salgsordrer", "Indkøbsordrer", "Materiale Batches", "Produkt Batches", "Udløb og lagerhenstand", "Lagerafstemning", "Ændringslog", "Produktionssteder"]
     )
+    instrumentation.set_label(f"{action} / {management_option}")
 
     # Manage Materials
     if management_option == "Materialer":
-        materials = session.query(Material).all()
+        materials = read_session.query(Material).all()
         material_options = [(m.id, m.name, m.quantity, m.unit, m.producer_name) for m in materials]
         df = pd.DataFrame(material_options, columns=["ID", "Navn", "Mængde", "Enhed", "Producentnavn"])
         st.dataframe(df)
@@ -357,18 +272,13 @@ if action == "Administrationsside":
                 confirm_delete = st.checkbox("Bekræft sletning")
                 if confirm_delete:
                     try:
-                        bom_entries = session.query(BoM).filter_by(component_material_id=selected_material_id).all()
-                        if bom_entries:
-                            st.error("Kan ikke slette materialet, da det bruges i en stykliste.")
-                        else:
-                            material_batches = session.query(MaterialBatch).filter_by(material_id=selected_material_id).all()
-                            if material_batches:
-                                st.error("Kan ikke slette materialet, da der er tilknyttede batches.")
-                            else:
-                                session.delete(selected_material)
-                                session.commit()
-                                refresh_materials()
-                                st.success("Materiale slettet med succes!")
+                        services.delete_material(session, selected_material_id)
+                        session.commit()
+                        refresh_materials()
+                        st.success("Materiale slettet med succes!")
+                    except services.ServiceError as e:
+                        session.rollback()
+                        st.error(str(e))
                     except Exception as e:
                         session.rollback()
                         st.error(f"Fejl under sletning af materiale: {str(e)}")
@@ -378,7 +288,7 @@ if action == "Administrationsside":
             st.info("Indtast et gyldigt materiale ID for at redigere eller slette.")
 
     elif management_option == "Produkter":
-        products = session.query(Product).all()
+        products = read_session.query(Product).all()
         product_options = [(p.id, p.name, p.quantity, p.unit) for p in products]
         df = pd.DataFrame(product_options, columns=["ID", "Navn", "Mængde", "Enhed"])
         st.dataframe(df)
@@ -407,21 +317,13 @@ if action == "Administrationsside":
                 confirm_delete = st.checkbox("Bekræft sletning")
                 if confirm_delete:
                     try:
-                        bom_entries = session.query(BoM).filter(
-                            (BoM.component_product_id == selected_product_id) | (BoM.recipe_id == selected_product_id)
-                        ).all()
-                        production_orders = session.query(ProductionOrder).filter_by(product_id=selected_product_id).all()
-                        if bom_entries or production_orders:
-                            st.error("Kan ikke slette produktet, da det bruges i en stykliste eller produktionsordre.")
-                        else:
-                            product_batches = session.query(ProductBatch).filter_by(product_id=selected_product_id).all()
-                            if product_batches:
-                                st.error("Kan ikke slette produktet, da der er tilknyttede batches.")
-                            else:
-                                session.delete(selected_product)
-                                session.commit()
-                                refresh_products()
-                                st.success("Produkt slettet med succes!")
+                        services.delete_product(session, selected_product_id)
+                        session.commit()
+                        refresh_products()
+                        st.success("Produkt slettet med succes!")
+                    except services.ServiceError as e:
+                        session.rollback()
+                        st.error(str(e))
                     except Exception as e:
                         session.rollback()
                         st.error(f"Fejl under sletning af produkt: {str(e)}")
@@ -431,7 +333,7 @@ if action == "Administrationsside":
             st.info("Indtast et gyldigt produkt ID for at redigere eller slette.")
 
     elif management_option == "Kunder":
-        customers = session.query(Customer).all()
+        customers = read_session.query(Customer).all()
         customer_options = [(c.id, c.name, c.address, c.contact_email, c.phone_number, c.vat_number) for c in customers]
         df = pd.DataFrame(customer_options, columns=["ID", "Navn", "Adresse", "Kontakt Email", "Telefonnummer", "CVR-nummer"])
         st.dataframe(df)
@@ -464,14 +366,13 @@ if action == "Administrationsside":
                 confirm_delete = st.checkbox("Bekræft sletning")
                 if confirm_delete:
                     try:
-                        sales_orders = session.query(SalesOrder).filter_by(customer_id=selected_customer_id).all()
-                        if sales_orders:
-                            st.error("Kan ikke slette kunden, da der er tilknyttede salgsordrer.")
-                        else:
-                            session.delete(selected_customer)
-                            session.commit()
-                            refresh_customers()
-                            st.success("Kunde slettet med succes!")
+                        services.delete_customer(session, selected_customer_id)
+                        session.commit()
+                        refresh_customers()
+                        st.success("Kunde slettet med succes!")
+                    except services.ServiceError as e:
+                        session.rollback()
+                        st.error(str(e))
                     except Exception as e:
                         session.rollback()
                         st.error(f"Fejl under sletning af kunde: {str(e)}")
@@ -481,7 +382,7 @@ if action == "Administrationsside":
             st.info("Indtast et gyldigt kunde ID for at redigere eller slette.")
 
     elif management_option == "Leverandører":
-        suppliers = session.query(Supplier).all()
+        suppliers = read_session.query(Supplier).all()
         supplier_options = [(s.id, s.name, s.address, s.contact_email, s.phone_number, s.vat_number, s.organic_number) for s in suppliers]
         df = pd.DataFrame(supplier_options, columns=["ID", "Navn", "Adresse", "Kontakt Email", "Telefonnummer", "CVR-nummer", "Økologinummer"])
         st.dataframe(df)
@@ -498,13 +399,6 @@ if action == "Administrationsside":
             new_organic_number = st.text_input("Økologinummer", value=selected_supplier.organic_number or "")
 
             report_file = st.file_uploader("Upload ny leverandørrapport (PDF eller billede)", type=["pdf", "png", "jpg", "jpeg"], key="edit_supplier_report")
-            report_file_data = selected_supplier.report_file
-            report_filename = selected_supplier.report_filename
-            report_mimetype = selected_supplier.report_mimetype
-            if report_file is not None:
-                report_file_data = report_file.read()
-                report_filename = report_file.name
-                report_mimetype = report_file.type
 
             if st.button("Opdater leverandør"):
                 selected_supplier.name = new_name
@@ -513,10 +407,9 @@ if action == "Administrationsside":
                 selected_supplier.phone_number = new_phone_number
                 selected_supplier.vat_number = new_vat_number
                 selected_supplier.organic_number = new_organic_number
-                selected_supplier.report_file = report_file_data
-                selected_supplier.report_filename = report_filename
-                selected_supplier.report_mimetype = report_mimetype
                 try:
+                    if report_file is not None:
+                        selected_supplier.report_attachment_id = attachments.store_upload(engine, report_file)
                     session.commit()
                     refresh_suppliers()
                     st.success("Leverandør opdateret med succes!")
@@ -524,29 +417,21 @@ if action == "Administrationsside":
                     session.rollback()
                     st.error(f"Fejl under opdatering af leverandør: {str(e)}")
 
-            if selected_supplier.report_file:
+            if selected_supplier.report_attachment_id:
                 st.write("**Leverandørrapport:**")
-                if selected_supplier.report_mimetype == 'application/pdf':
-                    b64_pdf = base64.b64encode(selected_supplier.report_file).decode('utf-8')
-                    pdf_display = f'<iframe src="data:application/pdf;base64,{b64_pdf}" width="700" height="1000" type="application/pdf"></iframe>'
-                    st.markdown(pdf_display, unsafe_allow_html=True)
-                elif selected_supplier.report_mimetype and selected_supplier.report_mimetype.startswith('image/'):
-                    image = Image.open(io.BytesIO(selected_supplier.report_file))
-                    st.image(image)
-                else:
-                    st.download_button("Download rapport", data=selected_supplier.report_file, file_name=selected_supplier.report_filename, mime=selected_supplier.report_mimetype)
+                show_attachment(selected_supplier.report_attachment_id, "Download rapport")
             else:
                 st.write("Ingen leverandørrapport uploadet.")
         else:
             st.info("Indtast et gyldigt leverandør ID for at redigere eller slette.")
 
     elif management_option == "Styklister (BoM)":
-        boms = session.query(BoM).all()
-        products = session.query(Product).all()
+        boms = read_session.query(BoM).all()
+        products = read_session.query(Product).all()
         product_map = {p.id: p for p in products}
-        recipes = session.query(Recipe).all()
+        recipes = read_session.query(Recipe).all()
         recipe_map = {r.id: r for r in recipes}
-        materials = session.query(Material).all()
+        materials = read_session.query(Material).all()
         material_map = {m.id: m for m in materials}
         bom_options = []
         for b in boms:
@@ -579,7 +464,7 @@ if action == "Administrationsside":
                 confirm_delete = st.checkbox("Bekræft sletning")
                 if confirm_delete:
                     try:
-                        session.delete(selected_bom)
+                        services.delete_bom(session, selected_bom_id)
                         session.commit()
                         refresh_boms()
                         st.success("Styklistepost slettet med succes!")
@@ -592,8 +477,8 @@ if action == "Administrationsside":
             st.info("Indtast et gyldigt stykliste ID for at slette.")
 
     elif management_option == "Produktionsordrer":
-        production_orders = session.query(ProductionOrder).all()
-        products = session.query(Product).all()
+        production_orders = read_session.query(ProductionOrder).all()
+        products = read_session.query(Product).all()
         product_map = {p.id: p for p in products}
         production_data = []
         for po in production_orders:
@@ -622,13 +507,7 @@ if action == "Administrationsside":
 
             if st.button("Opdater produktionsordre"):
                 try:
-                    old_product = session.query(Product).filter_by(id=selected_order.product_id).first()
-                    old_product.quantity -= selected_order.quantity
-                    new_product = session.query(Product).filter_by(id=new_product_id).first()
-                    new_product.quantity += new_quantity
-                    selected_order.status = new_status
-                    selected_order.quantity = new_quantity
-                    selected_order.product_id = new_product_id
+                    services.update_production_order(session, selected_production_order_id, new_status, new_quantity, new_product_id)
                     session.commit()
                     refresh_products()
                     refresh_production_orders()
@@ -641,30 +520,12 @@ if action == "Administrationsside":
                 confirm_delete = st.checkbox("Bekræft sletning")
                 if confirm_delete:
                     try:
-                        db_order = session.query(ProductionOrder).filter_by(id=selected_production_order_id).first()
-                        product = session.query(Product).filter_by(id=db_order.product_id).first()
-                        product.quantity -= db_order.quantity
-                        product_batch = session.query(ProductBatch).filter_by(batch_id=db_order.batch_id).first()
-                        if product_batch:
-                            session.delete(product_batch)
-                        components_used = session.query(ProductionOrderComponent).filter_by(production_order_id=selected_production_order_id).all()
-                        for component in components_used:
-                            if component.component_material_id:
-                                material = session.query(Material).filter_by(id=component.component_material_id).first()
-                                batch = session.query(MaterialBatch).filter_by(id=component.batch_id).first()
-                                batch.quantity += component.quantity_used
-                                material.quantity += convert_units(component.quantity_used, component.unit, material.unit)
-                            else:
-                                product_comp = session.query(Product).filter_by(id=component.component_product_id).first()
-                                batch = session.query(ProductBatch).filter_by(id=component.batch_id).first()
-                                batch.quantity += component.quantity_used
-                                product_comp.quantity += convert_units(component.quantity_used, component.unit, product_comp.unit)
-                            session.delete(component)
-                        session.delete(db_order)
+                        services.delete_production_order(session, selected_production_order_id)
                         session.commit()
                         refresh_materials()
                         refresh_products()
                         refresh_production_orders()
+                        refresh_material_batches()
                         refresh_product_batches()
                         st.success("Produktionsordre slettet og lager opdateret med succes!")
                     except Exception as e:
@@ -676,20 +537,20 @@ if action == "Administrationsside":
             st.info("Indtast et gyldigt produktionsordre ID for at redigere eller slette.")
 
     elif management_option == "Salgsordrer":
-        sales_orders = session.query(SalesOrder).all()
+        # The lines of all orders in one query instead of one per order
+        sales_orders = read_session.query(SalesOrder).options(selectinload(SalesOrder.items)).all()
         products = st.session_state.products
         product_map = {p.id: p for p in products}
         customers = st.session_state.customers
         customer_map = {c.id: c for c in customers}
         sales_data = []
         for so in sales_orders:
-            product = product_map.get(so.product_id)
             customer = customer_map.get(so.customer_id)
             sales_data.append({
                 "ID": so.id,
-                "Produkt": product.name if product else "Ukendt",
+                "Produkt": ", ".join(product_map[item.product_id].name if item.product_id in product_map else "Ukendt" for item in so.items),
                 "Kunde": customer.name if customer else "Ukendt",
-                "Mængde": so.quantity,
+                "Mængde": ", ".join(f"{item.quantity} {item.unit}" for item in so.items),
                 "Dato": so.date.strftime("%Y-%m-%d"),
                 "Status": so.status
             })
@@ -715,12 +576,11 @@ if action == "Administrationsside":
                 confirm_delete = st.checkbox("Bekræft sletning")
                 if confirm_delete:
                     try:
-                        product = session.query(Product).filter_by(id=selected_order.product_id).first()
-                        product.quantity += selected_order.quantity
-                        session.delete(selected_order)
+                        services.delete_sales_order(session, selected_sales_order_id)
                         session.commit()
                         refresh_sales_orders()
                         refresh_products()
+                        refresh_product_batches()
                         st.success("Salgsordre slettet og lager opdateret med succes!")
                     except Exception as e:
                         session.rollback()
@@ -731,7 +591,10 @@ if action == "Administrationsside":
             st.info("Indtast et gyldigt salgsordre ID for at redigere eller slette.")
 
     elif management_option == "Materiale Batches":
-        material_batches = session.query(MaterialBatch).all()
+        if st.checkbox("Vis også opbrugte batches", key="show_used_material_batches"):
+            material_batches = read_session.query(MaterialBatch).all()
+        else:
+            material_batches = st.session_state.material_batches
         materials = st.session_state.materials
         material_map = {m.id: m for m in materials}
         batch_data = []
@@ -744,13 +607,19 @@ if action == "Administrationsside":
                 "Mængde": mb.quantity,
                 "Enhed": mb.unit,
                 "Dato": mb.date.strftime("%Y-%m-%d"),
-                "Tjekket": "Ja" if mb.checked else "Nej"
+                "Bedst før": mb.expiry_date,
+                "Kostpris pr. enhed": mb.unit_cost,
+                "Tjekket": "Ja" if mb.checked else "Nej",
+                "Kontrol": mb.qc_status
             })
         df = pd.DataFrame(batch_data)
         st.dataframe(df)
 
     elif management_option == "Produkt Batches":
-        product_batches = session.query(ProductBatch).all()
+        if st.checkbox("Vis også opbrugte batches", key="show_used_product_batches"):
+            product_batches = read_session.query(ProductBatch).all()
+        else:
+            product_batches = st.session_state.product_batches
         products = st.session_state.products
         product_map = {p.id: p for p in products}
         batch_data = []
@@ -762,13 +631,160 @@ if action == "Administrationsside":
                 "Batch ID": pb.batch_id,
                 "Mængde": pb.quantity,
                 "Enhed": pb.unit,
-                "Dato": pb.date.strftime("%Y-%m-%d")
+                "Dato": pb.date.strftime("%Y-%m-%d"),
+                "Bedst før": pb.expiry_date,
+                "Kostpris pr. enhed": pb.unit_cost
             })
         df = pd.DataFrame(batch_data)
         st.dataframe(df)
 
+    elif management_option == "Udløb og lagerhenstand":
+        materials_map = {m.id: m for m in st.session_state.materials}
+        products_map = {p.id: p for p in st.session_state.products}
+        today = datetime.now().date()
+
+        def batch_rows(kind, batches):
+            rows = []
+            for b in batches:
+                item = materials_map.get(b.material_id) if kind == 'material' else products_map.get(b.product_id)
+                rows.append({
+                    "ID": b.id,
+                    "Type": "Materiale" if kind == 'material' else "Produkt",
+                    "Navn": item.name if item else "Ukendt",
+                    "Batch ID": b.batch_id,
+                    "Mængde": b.quantity,
+                    "Enhed": b.unit,
+                    "Modtaget": b.date,
+                    "Bedst før": b.expiry_date,
+                    "Dage tilbage": (b.expiry_date - today).days if b.expiry_date else None,
+                    "Sidst brugt": b.last_used,
+                    "Udløbet": "Ja" if b.expired else "Nej"
+                })
+            return rows
+
+        st.subheader("Tættest på udløb")
+        days_ahead = st.number_input("Vis batches der udløber inden for (dage)", min_value=0, value=14, step=1, key="expiry_days_ahead")
+        until = today + timedelta(days=int(days_ahead))
+        expiring = (batch_rows('material', services.expiring_batches(read_session, 'material', until))
+                    + batch_rows('product', services.expiring_batches(read_session, 'product', until)))
+        expiring.sort(key=lambda row: row["Bedst før"])
+        if expiring:
+            st.dataframe(pd.DataFrame(expiring))
+        else:
+            st.info("Ingen batches udløber i perioden.")
+
+        st.subheader("Batches uden bevægelse")
+        idle_days = st.number_input("Ikke brugt i mindst (dage)", min_value=1, value=90, step=1, key="idle_days")
+        since = today - timedelta(days=int(idle_days))
+        idle = (batch_rows('material', services.idle_batches(read_session, 'material', since))
+                + batch_rows('product', services.idle_batches(read_session, 'product', since)))
+        if idle:
+            st.dataframe(pd.DataFrame(idle))
+        else:
+            st.info("Ingen batches har ligget stille så længe.")
+
+        st.subheader("Udløbne batches")
+        st.caption("Markerer alle batches med overskredet bedst før-dato. Kassering skriver restmængden af som 'Udløbet'.")
+        dispose_expired = st.checkbox("Kassér restmængden af udløbne batches", key="expiry_dispose")
+        if st.button("Kør udløbskontrol", key="expiry_sweep"):
+            try:
+                sweep = services.expiry_sweep(session, today, dispose=dispose_expired)
+                session.commit()
+                refresh_materials()
+                refresh_products()
+                refresh_material_batches()
+                refresh_product_batches()
+                st.success(
+                    f"Materialebatches: {sweep['material']['flagged']} markeret, {sweep['material']['disposed']} kasseret. "
+                    f"Produktbatches: {sweep['product']['flagged']} markeret, {sweep['product']['disposed']} kasseret."
+                )
+            except Exception as e:
+                session.rollback()
+                st.error(f"Fejl under udløbskontrol: {str(e)}")
+
+    elif management_option == "Lagerafstemning":
+        st.caption("Sammenligner lagertallet for hvert materiale og produkt med summen af dets batches (omregnet til varens enhed).")
+        report = services.reconcile_stock(read_session)
+        discrepancies = report['material']['discrepancies'] + report['product']['discrepancies']
+        stale_flags = report['material']['stale_flags'] + report['product']['stale_flags']
+        if discrepancies:
+            st.dataframe(pd.DataFrame([{
+                "Type": "Materiale" if row['kind'] == 'material' else "Produkt",
+                "ID": row['id'],
+                "Navn": row['name'],
+                "Enhed": row['unit'],
+                "Lagertal": row['quantity'],
+                "Sum af batches": row['batch_total'],
+                "Forskel": row['difference'],
+            } for row in discrepancies]), hide_index=True)
+        if stale_flags:
+            st.warning(f"{stale_flags} batches er markeret forkert som tilgængelige eller opbrugte.")
+        if discrepancies or stale_flags:
+            if st.button("Ret lagertal til batchsummen", key="repair_stock"):
+                try:
+                    result = services.reconcile_stock(session, repair=True)
+                    session.commit()
+                    refresh_materials()
+                    refresh_products()
+                    refresh_material_batches()
+                    refresh_product_batches()
+                    st.success(f"{result['material']['repaired']} materialer og {result['product']['repaired']} produkter rettet, "
+                               f"{stale_flags} batchmarkeringer opdateret.")
+                except Exception as e:
+                    session.rollback()
+                    st.error(f"Fejl under lagerafstemning: {str(e)}")
+        else:
+            st.success("Alle lagertal stemmer med batchene.")
+
+    elif management_option == "Ændringslog":
+        st.caption("Hver ændring med værdierne før og efter. Ændringer skrives i baggrunden og kan være et øjeblik om at dukke op.")
+        audited = sorted(name for name in Base.metadata.tables if name not in audit.SKIPPED_TABLES)
+        col1, col2, col3 = st.columns(3)
+        entity = col1.selectbox("Tabel", ["Alle"] + audited, key="audit_entity")
+        entity_id = col2.number_input("ID (0 = alle)", min_value=0, step=1, key="audit_entity_id")
+        actor = col3.text_input("Bruger", key="audit_actor").strip()
+        col1, col2, col3 = st.columns(3)
+        since = col1.date_input("Fra", value=datetime.now().date() - timedelta(days=30), key="audit_since")
+        until = col2.date_input("Til og med", value=datetime.now().date(), key="audit_until")
+        limit = col3.number_input("Højst", min_value=10, max_value=5000, value=500, step=100, key="audit_limit")
+        entries = audit.history(
+            read_session,
+            entity=None if entity == "Alle" else entity,
+            entity_id=int(entity_id) or None,
+            actor=actor or None,
+            since=datetime.combine(since, datetime.min.time()),
+            until=datetime.combine(until + timedelta(days=1), datetime.min.time()),
+            limit=int(limit),
+        )
+        if entries:
+            st.dataframe(pd.DataFrame([{
+                "Tidspunkt": e.occurred_at,
+                "Bruger": e.actor or "Ukendt",
+                "Kilde": e.source,
+                "Tabel": e.entity,
+                "ID": e.entity_id,
+                "Handling": {"insert": "Oprettet", "update": "Ændret", "delete": "Slettet"}.get(e.action, e.action),
+                "Ændringer": audit.describe_changes(e.changes),
+            } for e in entries]), hide_index=True)
+        else:
+            st.info("Ingen ændringer fundet.")
+
+    elif management_option == "Produktionssteder":
+        st.caption("Ordrer, batches og produktionslinjer hører til ét produktionssted. Materialer, produkter, opskrifter, kunder og leverandører er fælles.")
+        st.dataframe(pd.DataFrame([(s.id, s.name) for s in all_sites], columns=["ID", "Navn"]), hide_index=True)
+        new_site_name = st.text_input("Nyt produktionssted", key="new_site_name")
+        if st.button("Opret produktionssted"):
+            try:
+                services.create_site(session, new_site_name)
+                session.commit()
+                refresh_sites()
+                st.success("Produktionssted oprettet. Vælg det i sidepanelet.")
+            except services.ServiceError as e:
+                session.rollback()
+                st.error(str(e))
+
     elif management_option == "Indkøbsordrer":
-        purchase_orders = session.query(PurchaseOrder).all()
+        purchase_orders = read_session.query(PurchaseOrder).all()
         suppliers = st.session_state.suppliers
         supplier_map = {s.id: s for s in suppliers}
         po_data = []
@@ -778,6 +794,7 @@ if action == "Administrationsside":
                 "ID": po.id,
                 "Leverandør": sup.name if sup else "Ukendt",
                 "Dato": po.date.strftime("%Y-%m-%d"),
+                "Status": po.status,
                 "Tjekket": "Ja" if po.checked else "Nej"
             })
         df = pd.DataFrame(po_data)
@@ -799,21 +816,15 @@ if action == "Administrationsside":
                     "Materiale": mat.name if mat else "Ukendt",
                     "Batch ID": item.batch_id,
                     "Mængde": item.quantity,
-                    "Enhed": item.unit
+                    "Modtaget": item.quantity_received,
+                    "Enhed": item.unit,
+                    "Stykpris": item.unit_cost
                 })
             item_df = pd.DataFrame(item_data)
             st.dataframe(item_df)
-            if selected_po.invoice_file:
+            if selected_po.invoice_attachment_id:
                 st.write("**Faktura:**")
-                if selected_po.invoice_mimetype == 'application/pdf':
-                    b64_pdf = base64.b64encode(selected_po.invoice_file).decode('utf-8')
-                    pdf_display = f'<iframe src="data:application/pdf;base64,{b64_pdf}" width="700" height="1000" type="application/pdf"></iframe>'
-                    st.markdown(pdf_display, unsafe_allow_html=True)
-                elif selected_po.invoice_mimetype and selected_po.invoice_mimetype.startswith('image/'):
-                    image = Image.open(io.BytesIO(selected_po.invoice_file))
-                    st.image(image)
-                else:
-                    st.download_button("Download faktura", data=selected_po.invoice_file, file_name=selected_po.invoice_filename, mime=selected_po.invoice_mimetype)
+                show_attachment(selected_po.invoice_attachment_id, "Download faktura")
             else:
                 st.write("Ingen faktura uploadet.")
             suppliers_options = [(s.id, s.name) for s in suppliers]
@@ -822,23 +833,16 @@ if action == "Administrationsside":
             new_date = st.date_input("Ny dato", value=selected_po.date)
             new_checked = st.checkbox("Vare modtaget og tjekket", value=selected_po.checked)
             invoice_file = st.file_uploader("Upload ny faktura (PDF eller billede)", type=["pdf", "png", "jpg", "jpeg"], key="edit_invoice_file")
-            invoice_file_data = selected_po.invoice_file
-            invoice_filename = selected_po.invoice_filename
-            invoice_mimetype = selected_po.invoice_mimetype
-            if invoice_file is not None:
-                invoice_file_data = invoice_file.read()
-                invoice_filename = invoice_file.name
-                invoice_mimetype = invoice_file.type
 
             if st.button("Opdater indkøbsordre"):
                 try:
+                    invoice_attachment_id = attachments.store_upload(engine, invoice_file)
                     db_po = session.query(PurchaseOrder).filter_by(id=selected_po_id).first()
                     db_po.supplier_id = new_supplier_id
                     db_po.date = new_date
                     db_po.checked = new_checked
-                    db_po.invoice_file = invoice_file_data
-                    db_po.invoice_filename = invoice_filename
-                    db_po.invoice_mimetype = invoice_mimetype
+                    if invoice_attachment_id is not None:
+                        db_po.invoice_attachment_id = invoice_attachment_id
                     session.commit()
                     refresh_purchase_orders()
                     st.success("Indkøbsordre opdateret med succes!")
@@ -850,16 +854,7 @@ if action == "Administrationsside":
                 confirm_delete = st.checkbox("Bekræft sletning")
                 if confirm_delete:
                     try:
-                        db_po = session.query(PurchaseOrder).filter_by(id=selected_po_id).first()
-                        items = session.query(PurchaseOrderItem).filter_by(purchase_order_id=selected_po_id).all()
-                        for item in items:
-                            material = session.query(Material).filter_by(id=item.material_id).first()
-                            material.quantity -= convert_units(item.quantity, item.unit, material.unit)
-                            batch = session.query(MaterialBatch).filter_by(batch_id=item.batch_id).first()
-                            if batch:
-                                session.delete(batch)
-                            session.delete(item)
-                        session.delete(db_po)
+                        services.delete_purchase_order(session, selected_po_id)
                         session.commit()
                         refresh_materials()
                         refresh_purchase_orders()
@@ -881,9 +876,8 @@ elif action == "Opret et nyt materiale":
     unit = st.selectbox("Enhed", ["kg", "g", "l", "ml", "stk"], key="material_unit")
     if st.button("Tilføj materiale"):
         if material_name and unit:
-            new_material = Material(name=material_name, unit=unit, producer_name=producer_name)
             try:
-                session.add(new_material)
+                services.create_material(session, material_name, unit, producer_name)
                 session.commit()
                 refresh_materials()
                 st.success("Materiale tilføjet med succes!")
@@ -901,6 +895,7 @@ elif action == "Køb noget":
     if suppliers:
         supplier = st.selectbox("Vælg leverandør", [(s.id, s.name) for s in suppliers], key="buy_supplier")
         supplier_id, supplier_name = supplier
+        order_only = st.checkbox("Kun bestil - varerne modtages senere under 'Varemodtagelse'", key="buy_order_only")
         st.subheader("Tilføj materialer til indkøbsordren")
         materials = st.session_state.materials
         if materials:
@@ -910,9 +905,11 @@ elif action == "Køb noget":
                 batch_id = st.text_input("Batch ID", key="buy_batch_id")
                 quantity = st.number_input("Indkøbt mængde", min_value=0.0, step=0.1, key="buy_quantity")
                 unit = st.selectbox("Enhed", ["kg", "g", "l", "ml", "stk"], key="buy_unit")
+                unit_cost = st.number_input("Stykpris (kr. pr. enhed, valgfri)", min_value=0.0, value=None, step=0.01, key="buy_unit_cost")
+                expiry_date = st.date_input("Bedst før (valgfri)", value=None, key="buy_expiry_date")
                 add_item_button = st.form_submit_button("Tilføj til indkøbsordre")
             if add_item_button:
-                if batch_id.strip() == "":
+                if batch_id.strip() == "" and not order_only:
                     st.error("Batch ID er påkrævet.")
                 elif quantity <= 0:
                     st.error("Mængden skal være større end 0.")
@@ -922,62 +919,60 @@ elif action == "Køb noget":
                         'material_name': material_name,
                         'batch_id': batch_id,
                         'quantity': quantity,
-                        'unit': unit
+                        'unit': unit,
+                        'unit_cost': unit_cost,
+                        'expiry_date': expiry_date
                     })
                     st.success(f"Materiale '{material_name}' tilføjet til indkøbsordren.")
 
             if st.session_state.purchase_order_items:
                 st.subheader("Materialer i indkøbsordren")
                 po_items_df = pd.DataFrame(st.session_state.purchase_order_items)
-                st.dataframe(po_items_df[['material_name', 'batch_id', 'quantity', 'unit']])
-                checked = st.checkbox("Vare modtaget og tjekket")
+                st.dataframe(po_items_df[['material_name', 'batch_id', 'quantity', 'unit', 'unit_cost', 'expiry_date']])
+                checked = st.checkbox("Vare modtaget og tjekket", disabled=order_only)
                 date = st.date_input("Dato for indkøb", datetime.now(), key="buy_date")
+                status = services.ORDERED if order_only else services.RECEIVED
                 invoice_file = st.file_uploader("Upload faktura (PDF eller billede)", type=["pdf", "png", "jpg", "jpeg"], key="invoice_file")
-                if st.button("Afgiv indkøbsordre"):
+                run_in_background = st.checkbox("Kør i baggrunden (store ordrer og fakturaer)", key="buy_in_background")
+                place_order = st.button("Afgiv indkøbsordre")
+                if place_order and run_in_background:
+                    params = {
+                        'supplier_id': supplier_id,
+                        'items': st.session_state.purchase_order_items,
+                        'date': date.isoformat(),
+                        'checked': checked,
+                        'status': status,
+                        'site_id': site_id,
+                    }
+                    if invoice_file is not None:
+                        params['invoice_path'] = os.path.join(tempfile.mkdtemp(), invoice_file.name)
+                        with open(params['invoice_path'], "wb") as f:
+                            f.write(invoice_file.getvalue())
+                        params['invoice_filename'] = invoice_file.name
+                        params['invoice_mimetype'] = invoice_file.type
+                    job_id = get_job_queue().submit('purchase_order', params)
+                    st.session_state.purchase_order_items = []
+                    st.info(f"Indkøbsordren behandles i baggrunden (job #{job_id}). Følg den under 'Baggrundsjob'.")
+                elif place_order:
                     try:
-                        invoice_file_data = None
-                        invoice_filename = None
-                        invoice_mimetype = None
-                        if invoice_file is not None:
-                            invoice_file_data = invoice_file.read()
-                            invoice_filename = invoice_file.name
-                            invoice_mimetype = invoice_file.type
-                        new_purchase_order = PurchaseOrder(
-                            supplier_id=supplier_id,
-                            date=date,
+                        invoice_attachment_id = attachments.store_upload(engine, invoice_file)
+                        services.create_purchase_order(
+                            session,
+                            supplier_id,
+                            st.session_state.purchase_order_items,
+                            date,
                             checked=checked,
-                            invoice_file=invoice_file_data,
-                            invoice_filename=invoice_filename,
-                            invoice_mimetype=invoice_mimetype
+                            invoice_attachment_id=invoice_attachment_id,
+                            status=status
                         )
-                        session.add(new_purchase_order)
-                        session.flush()
-                        for item in st.session_state.purchase_order_items:
-                            new_item = PurchaseOrderItem(
-                                purchase_order_id=new_purchase_order.id,
-                                material_id=item['material_id'],
-                                batch_id=item['batch_id'],
-                                quantity=item['quantity'],
-                                unit=item['unit']
-                            )
-                            session.add(new_item)
-                            material = session.query(Material).filter_by(id=item['material_id']).first()
-                            converted_quantity = convert_units(item['quantity'], item['unit'], material.unit)
-                            material.quantity += converted_quantity
-                            new_batch = MaterialBatch(
-                                material_id=item['material_id'],
-                                batch_id=item['batch_id'],
-                                quantity=item['quantity'],
-                                unit=item['unit'],
-                                date=date,
-                                checked=checked
-                            )
-                            session.add(new_batch)
                         session.commit()
                         refresh_materials()
                         refresh_purchase_orders()
                         refresh_material_batches()
-                        st.success("Indkøbsordre oprettet og lager opdateret med succes!")
+                        if order_only:
+                            st.success("Indkøbsordre bestilt. Varerne modtages under 'Varemodtagelse'.")
+                        else:
+                            st.success("Indkøbsordre oprettet og lager opdateret med succes!")
                         st.session_state.purchase_order_items = []
                     except Exception as e:
                         session.rollback()
@@ -989,6 +984,164 @@ elif action == "Køb noget":
     else:
         st.error("Ingen leverandører tilgængelige.")
 
+elif action == "Varemodtagelse":
+    st.header("Varemodtagelse")
+    pending = services.pending_deliveries(read_session)
+    if not pending:
+        st.info("Ingen bestilte varer afventer levering.")
+    else:
+        st.subheader("Afventende leverancer")
+        st.dataframe(pd.DataFrame([{
+            "Linje": p.id,
+            "Ordre": p.purchase_order_id,
+            "Leverandør": p.supplier_name,
+            "Bestilt": p.date,
+            "Materiale": p.material_name,
+            "Mængde": p.quantity,
+            "Modtaget": p.quantity_received,
+            "Udestående": p.outstanding,
+            "Enhed": p.unit,
+        } for p in pending]), hide_index=True)
+
+        st.subheader("Modtag varer")
+        supplier_names = {p.supplier_id: p.supplier_name for p in pending}
+        receipt_supplier_id = st.selectbox("Leverandør", list(supplier_names), format_func=lambda i: supplier_names[i], key="receipt_supplier")
+        col1, col2 = st.columns(2)
+        delivery_note = col1.text_input("Følgeseddelnummer", key="receipt_delivery_note")
+        receipt_date = col2.date_input("Modtagelsesdato", datetime.now(), key="receipt_date")
+        receipt_checked = st.checkbox("Vare modtaget og tjekket", key="receipt_checked")
+        prefill = st.checkbox("Forudfyld med udestående mængder", key="receipt_prefill")
+        lines_df = pd.DataFrame([{
+            "Linje": p.id,
+            "Ordre": p.purchase_order_id,
+            "Materiale": p.material_name,
+            "Udestående": p.outstanding,
+            "Enhed": p.unit,
+            "Modtaget nu": p.outstanding if prefill else 0.0,
+            "Batch ID": "",
+            "Bedst før": None,
+            "Stykpris": p.unit_cost,
+        } for p in pending if p.supplier_id == receipt_supplier_id])
+        lines_df["Bedst før"] = pd.to_datetime(lines_df["Bedst før"])
+        edited_lines = st.data_editor(lines_df, disabled=["Linje", "Ordre", "Materiale", "Udestående", "Enhed"], hide_index=True,
+                                      column_config={"Bedst før": st.column_config.DateColumn("Bedst før")},
+                                      key=f"receipt_lines_{receipt_supplier_id}_{prefill}")
+        st.caption("Store leverancer kan i stedet uploades som CSV med kolonnerne line (linjenummeret ovenfor), quantity og batch_id, "
+                   "og eventuelt expiry_date og unit_cost.")
+        receipt_file = st.file_uploader("Upload CSV", type=["csv"], key="receipt_csv")
+        if st.button("Bogfør modtagelse", key="receive_goods"):
+            try:
+                if receipt_file is not None:
+                    csv_df = pd.read_csv(receipt_file, sep=None, engine="python", dtype={"batch_id": str})
+                    csv_df.columns = [c.strip().lower() for c in csv_df.columns]
+                    csv_df = csv_df.astype(object).where(csv_df.notna(), None)
+                    receipt_lines = [{
+                        "purchase_order_item_id": None if row.get("line") is None else int(row["line"]),
+                        "quantity": row.get("quantity"),
+                        "batch_id": row.get("batch_id"),
+                        "expiry_date": row.get("expiry_date"),
+                        "unit_cost": row.get("unit_cost"),
+                    } for row in csv_df.to_dict("records")]
+                else:
+                    receipt_lines = [{
+                        "purchase_order_item_id": int(row["Linje"]),
+                        "quantity": float(row["Modtaget nu"]),
+                        "batch_id": row["Batch ID"],
+                        "expiry_date": None if pd.isna(row["Bedst før"]) else row["Bedst før"].date(),
+                        "unit_cost": None if pd.isna(row["Stykpris"]) else float(row["Stykpris"]),
+                    } for _, row in edited_lines.iterrows() if row["Modtaget nu"] and row["Modtaget nu"] > 0]
+                receipt = services.receive_goods(session, receipt_supplier_id, receipt_lines, receipt_date,
+                                                 delivery_note=delivery_note.strip(), checked=receipt_checked)
+                session.commit()
+                refresh_materials()
+                refresh_purchase_orders()
+                refresh_material_batches()
+                st.success(f"Modtagelse {receipt.id} bogført med {len(receipt_lines)} linjer."
+                           + ("" if receipt_checked else " Batchene afventer kvalitetskontrol."))
+            except services.ServiceError as e:
+                session.rollback()
+                st.error(str(e))
+            except Exception as e:
+                session.rollback()
+                st.error(f"Der opstod en fejl under varemodtagelsen: {str(e)}")
+
+    st.subheader("Seneste modtagelser")
+    receipts = (read_session.query(GoodsReceipt, Supplier.name, func.count(GoodsReceiptLine.id))
+                .join(Supplier, Supplier.id == GoodsReceipt.supplier_id)
+                .outerjoin(GoodsReceiptLine, GoodsReceiptLine.goods_receipt_id == GoodsReceipt.id)
+                .group_by(GoodsReceipt.id, Supplier.name)
+                .order_by(GoodsReceipt.id.desc()).limit(50).all())
+    if receipts:
+        st.dataframe(pd.DataFrame([{
+            "ID": receipt.id,
+            "Leverandør": supplier_name,
+            "Dato": receipt.date,
+            "Følgeseddel": receipt.delivery_note,
+            "Linjer": line_count,
+            "Tjekket": "Ja" if receipt.checked else "Nej",
+        } for receipt, supplier_name, line_count in receipts]), hide_index=True)
+    else:
+        st.info("Ingen modtagelser endnu.")
+
+elif action == "Kvalitetskontrol":
+    st.header("Kvalitetskontrol")
+    st.caption("Modtagne materialebatches skal frigives, før de kan bruges i produktionen, medmindre de blev tjekket ved modtagelsen. "
+               "Spærrede batches kan frigives igen eller bortskaffes under 'Smid noget ud'.")
+    qc_status = st.radio("Vis batches", [QC_PENDING, QC_HELD, QC_RELEASED], horizontal=True, key="qc_status_filter")
+    queue = services.pending_inspections(session, qc_status)
+    if not queue:
+        st.info("Ingen batches afventer kontrol." if qc_status == QC_PENDING else f"Ingen batches med status '{qc_status}'.")
+    else:
+        select_all = st.checkbox("Vælg alle", key=f"qc_select_all_{qc_status}")
+        queue_df = pd.DataFrame([{
+            "Vælg": select_all,
+            "ID": b.id,
+            "Materiale": b.material_name,
+            "Batch ID": b.batch_id,
+            "Mængde": b.quantity,
+            "Enhed": b.unit,
+            "Modtaget": b.date,
+            "Bedst før": b.expiry_date,
+            "Bemærkning": "",
+        } for b in queue])
+        edited_queue = st.data_editor(queue_df, disabled=["ID", "Materiale", "Batch ID", "Mængde", "Enhed", "Modtaget", "Bedst før"],
+                                      hide_index=True, key=f"qc_queue_{qc_status}_{select_all}")
+        chosen = edited_queue[edited_queue["Vælg"]]
+        st.caption(f"{len(chosen)} af {len(queue)} batches valgt" + (" (kun de ældste vises)" if len(queue) >= 200 else "") + ".")
+        col1, col2 = st.columns(2)
+        qc_notes = col1.text_input("Bemærkning (bruges hvor linjen ikke selv har en; påkrævet for at spærre)", key="qc_notes")
+        results = [QC_RELEASED, QC_HELD] if qc_status != QC_RELEASED else [QC_HELD]
+        qc_result = col2.selectbox("Resultat", results, format_func=lambda r: "Frigiv" if r == QC_RELEASED else "Spær", key="qc_result")
+        if st.button("Gem kontrol for valgte batches", key="qc_save"):
+            try:
+                qc_summary = services.record_inspections(
+                    session, [{'batch_id': int(row["ID"]), 'notes': row["Bemærkning"]} for _, row in chosen.iterrows()],
+                    current_user, result=qc_result, notes=qc_notes)
+                session.commit()
+                refresh_material_batches()
+                st.success(f"{qc_summary['released']} batches frigivet og {qc_summary['held']} spærret.")
+            except services.ServiceError as e:
+                session.rollback()
+                st.error(str(e))
+            except Exception as e:
+                session.rollback()
+                st.error(f"Der opstod en fejl under kvalitetskontrollen: {str(e)}")
+
+    st.subheader("Seneste kontroller")
+    history = services.inspection_history(read_session, limit=100)
+    if history:
+        st.dataframe(pd.DataFrame([{
+            "Tidspunkt": h.inspected_at,
+            "ID": h.material_batch_id,
+            "Batch ID": h.batch_id,
+            "Materiale": h.material_name,
+            "Resultat": h.result,
+            "Kontrolleret af": h.inspector,
+            "Bemærkning": h.notes,
+        } for h in history]), hide_index=True)
+    else:
+        st.info("Ingen kontroller endnu.")
+
 elif action == "Producer noget":
     st.header("Produktionsstyring")
     products = st.session_state.products
@@ -1005,6 +1158,12 @@ elif action == "Producer noget":
             st.error("Ingen opskrift fundet for det valgte produkt.")
         else:
             bom_items = session.query(BoM).filter_by(recipe_id=recipe.id).all()
+            can_make = production_availability()['frame']
+            can_make = can_make[can_make['product_id'] == product_id]
+            if not can_make.empty and pd.notna(can_make['direct'].iloc[0]):
+                row = can_make.iloc[0]
+                st.caption(f"Kan produceres af komponenterne på lager: {row['direct']} {product_unit} (begrænset af {row['bottleneck']})"
+                           + (f"; {row['tree']} {product_unit} hvis mellemprodukterne produceres først" if row['tree'] > row['direct'] else "") + ".")
             quantity = st.number_input(
                 f"Mængde der skal produceres (Standard opskrift producerer {recipe.output_quantity} {product_unit})",
                 min_value=0.0,
@@ -1013,6 +1172,15 @@ elif action == "Producer noget":
             )
             batch_id = st.text_input("Batch ID for det producerede produkt", key="produce_batch_id")
             date = st.date_input("Produktionsdato", datetime.now(), key="produce_date")
+            expiry_date = st.date_input("Bedst før (valgfri)", value=None, key="produce_expiry_date")
+            planned_orders = [o for o in st.session_state.production_orders
+                              if o.product_id == product_id and not services.is_produced(o) and o.status in services.PLANNED_STATUSES]
+            planned_order = st.selectbox(
+                "Planlagt produktionsordre",
+                [None] + planned_orders,
+                format_func=lambda o: "Ny ordre" if o is None else f"#{o.id}: {o.quantity} {product_unit}" + (f", leveres {o.due_date}" if o.due_date else ""),
+                key="produce_planned_order"
+            )
             if not bom_items:
                 st.error("Ingen stykliste fundet for det valgte produkt.")
             else:
@@ -1026,10 +1194,16 @@ elif action == "Producer noget":
                     required_total = bom.quantity_required * scaling_factor
                     if bom.component_material_id:
                         component = materials_map[bom.component_material_id]
-                        available_batches = [b for b in st.session_state.material_batches if b.material_id == component.id and b.quantity > 0]
+                        available_batches = [b for b in st.session_state.material_batches if b.material_id == component.id]
+                        blocked = [b for b in available_batches if b.qc_status != QC_RELEASED]
+                        if blocked:
+                            st.caption(f"{len(blocked)} batch(es) af {component.name} er ikke frigivet af kvalitetskontrollen og kan ikke bruges.")
+                        available_batches = [b for b in available_batches if b.qc_status == QC_RELEASED]
                     else:
                         component = products_map[bom.component_product_id]
-                        available_batches = [b for b in st.session_state.product_batches if b.product_id == component.id and b.quantity > 0]
+                        available_batches = [b for b in st.session_state.product_batches if b.product_id == component.id]
+                    # First expired, first out: batches closest to expiry are offered first
+                    available_batches.sort(key=lambda b: (b.expiry_date is None, b.expiry_date or b.date))
 
                     st.write(f"**Komponent: {component.name}**")
                     st.write(f"Krævet mængde: {required_total} {bom.unit}")
@@ -1038,7 +1212,8 @@ elif action == "Producer noget":
                         batch_options = []
                         for b in available_batches:
                             converted_available = convert_units(b.quantity, b.unit, bom.unit)
-                            batch_options.append((b.id, f"Batch {b.batch_id} - Tilgængelig: {converted_available} {bom.unit}"))
+                            expiry_text = f" - Bedst før: {b.expiry_date}" if b.expiry_date else ""
+                            batch_options.append((b.id, f"Batch {b.batch_id} - Tilgængelig: {converted_available} {bom.unit}{expiry_text}"))
 
                         selected_batch_id = st.selectbox(
                             f"Vælg batch for {component.name}",
@@ -1077,74 +1252,58 @@ elif action == "Producer noget":
                         component_allocations[bom.id] = None
 
                 if st.button("Opret produktionsordre", key="create_production"):
-                    if batch_id.strip() == "":
-                        st.error("Batch ID er påkrævet.")
-                    else:
-                        sufficient_inventory = True
-                        for bom_id, alloc in component_allocations.items():
-                            if alloc is None or alloc['allocated_quantity'] < alloc['required_total']:
-                                sufficient_inventory = False
-                                break
-
-                        if not sufficient_inventory:
-                            st.error("Der er ikke nok komponenter tildelt til at producere den ønskede mængde.")
-                        else:
-                            try:
-                                new_order = ProductionOrder(product_id=product_id, quantity=quantity, status='Afsluttet', batch_id=batch_id, date=date)
-                                session.add(new_order)
-                                session.flush()
-                                for bom_id, alloc in component_allocations.items():
-                                    if alloc['component_material_id']:
-                                        batch = session.query(MaterialBatch).filter_by(id=alloc['batch_id']).first()
-                                        batch_quantity_to_deduct = convert_units(alloc['allocated_quantity'], alloc['bom_unit'], batch.unit)
-                                        batch.quantity -= batch_quantity_to_deduct
-                                        material = session.query(Material).filter_by(id=alloc['component_material_id']).first()
-                                        material.quantity -= batch_quantity_to_deduct
-                                        production_component = ProductionOrderComponent(
-                                            production_order_id=new_order.id,
-                                            component_material_id=alloc['component_material_id'],
-                                            batch_id=batch.id,
-                                            quantity_used=alloc['allocated_quantity'],
-                                            unit=alloc['bom_unit']
-                                        )
-                                        session.add(production_component)
-                                    else:
-                                        batch = session.query(ProductBatch).filter_by(id=alloc['batch_id']).first()
-                                        batch_quantity_to_deduct = convert_units(alloc['allocated_quantity'], alloc['bom_unit'], batch.unit)
-                                        batch.quantity -= batch_quantity_to_deduct
-                                        product_comp = session.query(Product).filter_by(id=alloc['component_product_id']).first()
-                                        product_comp.quantity -= batch_quantity_to_deduct
-                                        production_component = ProductionOrderComponent(
-                                            production_order_id=new_order.id,
-                                            component_product_id=alloc['component_product_id'],
-                                            batch_id=batch.id,
-                                            quantity_used=alloc['allocated_quantity'],
-                                            unit=alloc['bom_unit']
-                                        )
-                                        session.add(production_component)
-
-                                product_to_update = session.query(Product).filter_by(id=product_id).first()
-                                product_to_update.quantity += quantity
-                                new_product_batch = ProductBatch(
-                                    product_id=product_id,
-                                    batch_id=batch_id,
-                                    quantity=quantity,
-                                    unit=product_unit,
-                                    date=date
-                                )
-                                session.add(new_product_batch)
-                                session.commit()
-                                refresh_materials()
-                                refresh_products()
-                                refresh_product_batches()
-                                refresh_production_orders()
-                                st.success("Produktion og batch oprettet med succes!")
-                            except Exception as e:
-                                session.rollback()
-                                st.error(f"Der opstod en fejl under afslutning af produktion: {str(e)}")
+                    allocations = [
+                        {'bom_id': bom_id, 'batch_id': alloc['batch_id'], 'quantity': alloc['allocated_quantity']}
+                        for bom_id, alloc in component_allocations.items() if alloc is not None
+                    ]
+                    try:
+                        services.produce(session, product_id, quantity, batch_id, date, allocations, expiry_date=expiry_date,
+                                         production_order_id=planned_order.id if planned_order else None)
+                        session.commit()
+                        refresh_materials()
+                        refresh_products()
+                        refresh_material_batches()
+                        refresh_product_batches()
+                        refresh_production_orders()
+                        st.success("Produktion og batch oprettet med succes!")
+                    except services.ServiceError as e:
+                        session.rollback()
+                        st.error(str(e))
+                    except Exception as e:
+                        session.rollback()
+                        st.error(f"Der opstod en fejl under afslutning af produktion: {str(e)}")
     else:
         st.error("Ingen produkter tilgængelige for produktion.")
 
+elif action == "Kan produceres":
+    st.header("Kan produceres")
+    st.caption("Hvor meget af hvert produkt med en opskrift der kan produceres af de batches, stedet har. "
+               "'Nu' bruger komponenterne på lager, som under 'Producer noget'. 'Med mellemprodukter' producerer også "
+               "mellemprodukter af deres egne komponenter, hvor lageret af dem ikke rækker; bruger flere mellemprodukter "
+               "samme materiale, er tallet en øvre grænse. Materialer tæller først, når kvalitetskontrollen har frigivet dem.")
+    force_availability = st.button("Opdater", key="availability_refresh",
+                                   help="Læs lageret igen, fx efter ændringer via API'et eller baggrundsjob")
+    feasibility = production_availability(force=force_availability)
+    feasibility_df = feasibility['frame']
+    if feasibility_df.empty:
+        st.info("Ingen produkter har en opskrift.")
+    else:
+        only_short = st.checkbox("Vis kun produkter der ikke kan produceres nu", key="availability_only_short")
+        if only_short:
+            feasibility_df = feasibility_df[~(feasibility_df['direct'] > 0)]
+        st.dataframe(pd.DataFrame({
+            "ID": feasibility_df['product_id'],
+            "Produkt": feasibility_df['name'],
+            "Enhed": feasibility_df['unit'],
+            "På lager": feasibility_df['on_hand'].round(2),
+            "Kan produceres nu": feasibility_df['direct'],
+            "Med mellemprodukter": feasibility_df['tree'],
+            "Begrænset af": feasibility_df['bottleneck'].fillna("Ingen stykliste"),
+            "Type": feasibility_df['bottleneck_kind'].map({'material': "Materiale", 'product': "Produkt"}),
+        }), hide_index=True)
+        st.caption(f"{len(feasibility_df)} produkter. Lageret blev sidst læst {feasibility['updated_at']:%H:%M:%S}; "
+                   f"{feasibility['evaluated']} produkter blev beregnet igen på {feasibility['seconds'] * 1000:.0f} ms.")
+
 elif action == "Opret en ny opskrift / stykliste":
     st.header("Opret stykliste (BoM)")
     if "bom_components" not in st.session_state:
@@ -1156,9 +1315,8 @@ elif action == "Opret en ny opskrift / stykliste":
         create_product_button = st.form_submit_button("Opret produkt")
     if create_product_button:
         if product_name and unit:
-            new_product = Product(name=product_name, unit=unit)
             try:
-                session.add(new_product)
+                new_product = services.create_product(session, product_name, unit)
                 session.commit()
                 refresh_products()
                 st.success(f"Produkt '{product_name}' oprettet med succes!")
@@ -1174,16 +1332,12 @@ elif action == "Opret en ny opskrift / stykliste":
         with st.form("recipe_form"):
             method = st.text_area("Fremgangsmåde", key="recipe_method")
             output_quantity = st.number_input("Mængde produceret af opskriften", min_value=0.0, step=0.1, key="recipe_output_quantity")
+            duration_minutes = st.number_input("Varighed pr. opskrift (minutter)", min_value=0.0, step=5.0, value=60.0, key="recipe_duration")
             save_recipe = st.form_submit_button("Gem opskrift")
         if save_recipe:
             if method and output_quantity > 0:
-                new_recipe = Recipe(
-                    product_id=product_id,
-                    method=method,
-                    output_quantity=output_quantity
-                )
                 try:
-                    session.add(new_recipe)
+                    new_recipe = services.create_recipe(session, product_id, method, output_quantity, duration_minutes or None)
                     session.commit()
                     st.success("Opskrift gemt med succes!")
                     st.session_state['recipe_id'] = new_recipe.id
@@ -1242,22 +1396,14 @@ elif action == "Opret en ny opskrift / stykliste":
 
         if st.button("Afslut stykliste", key="finalize_bom"):
             try:
-                for component in st.session_state.bom_components:
-                    if component["component_type"] == "Materiale":
-                        new_bom = BoM(
-                            recipe_id=recipe_id,
-                            component_material_id=component["item_id"],
-                            quantity_required=component["quantity_required"],
-                            unit=component["unit"]
-                        )
-                    else:
-                        new_bom = BoM(
-                            recipe_id=recipe_id,
-                            component_product_id=component["item_id"],
-                            quantity_required=component["quantity_required"],
-                            unit=component["unit"]
-                        )
-                    session.add(new_bom)
+                services.add_bom_components(session, recipe_id, [
+                    {
+                        "material_id" if component["component_type"] == "Materiale" else "product_id": component["item_id"],
+                        "quantity_required": component["quantity_required"],
+                        "unit": component["unit"]
+                    }
+                    for component in st.session_state.bom_components
+                ])
                 session.commit()
                 refresh_boms()
                 st.session_state.bom_components = []
@@ -1295,6 +1441,10 @@ elif action == "Sælg noget":
                 proceed_to_batches = st.form_submit_button("Vælg batches")
 
             if proceed_to_batches:
+                st.session_state.sales_allocation_open = True
+
+            # Keep the allocation step open across reruns, otherwise the order button below is never reached
+            if st.session_state.get("sales_allocation_open"):
                 # Fetch customers
                 customers = st.session_state.customers
                 if not customers:
@@ -1328,7 +1478,7 @@ elif action == "Sælg noget":
                             sufficient_inventory = False
 
                         # Get available batches
-                        available_batches = [b for b in st.session_state.product_batches if b.product_id == prod_id and b.quantity > 0]
+                        available_batches = [b for b in st.session_state.product_batches if b.product_id == prod_id]
                         if not available_batches:
                             st.error(f"Ingen batches tilgængelige for {product_obj.name}.")
                             sufficient_inventory = False
@@ -1369,70 +1519,29 @@ elif action == "Sælg noget":
                         if not sufficient_inventory:
                             st.error("Kan ikke oprette salgsordre, da der ikke er tilstrækkelig batchallokering.")
                         else:
+                            lines = [
+                                {
+                                    'product_id': prod_id,
+                                    'quantity': req_qty,
+                                    'unit': req_unit,
+                                    'allocations': [
+                                        {'batch_id': alloc['batch_id'], 'quantity': alloc['allocated_quantity']}
+                                        for alloc in product_allocations.get(prod_id, [])
+                                    ]
+                                }
+                                for prod_id, (req_qty, req_unit) in desired_quantities.items() if req_qty > 0
+                            ]
                             try:
-                                # Create SalesOrder (assuming you don't have a SalesOrderItem table,
-                                # you can create one similar to PurchaseOrderItem)
-                                new_sales_order = SalesOrder(
-                                    product_id=None,  # This field won't be used if we create line items
-                                    customer_id=customer_id,
-                                    quantity=0,  # Not used if we have multiple line items
-                                    status='Afsluttet',
-                                    date=sale_date
-                                )
-                                session.add(new_sales_order)
-                                session.flush()
-
-                                # If you haven't defined SalesOrderItem yet, define it similarly:
-                                # class SalesOrderItem(Base):
-                                #     __tablename__ = 'sales_order_item'
-                                #     id = Column(Integer, primary_key=True)
-                                #     sales_order_id = Column(Integer, ForeignKey('sales_order.id'), nullable=False)
-                                #     product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
-                                #     quantity = Column(Float, nullable=False)
-                                #     unit = Column(String(20), nullable=False)
-                                #
-                                # Make sure to create the table in your DB and reflect changes.
-
-                                # Now process each product and its allocations
-                                for prod_id, (req_qty, req_unit) in desired_quantities.items():
-                                    product_obj = next((p for p in products if p.id == prod_id), None)
-                                    if not product_obj or req_qty <= 0:
-                                        # Skip products with zero quantity
-                                        continue
-                                    converted_required = convert_units(req_qty, req_unit, product_obj.unit)
-
-                                    # Create a SalesOrderItem record for each product
-                                    # sum allocated quantities in product_obj.unit
-                                    total_allocated_in_native = 0.0
-                                    for alloc in product_allocations.get(prod_id, []):
-                                        total_allocated_in_native += alloc['allocated_quantity']
-
-                                    new_line = SalesOrder(  # or SalesOrderItem if you have it
-                                        product_id=prod_id,
-                                        customer_id=customer_id,
-                                        quantity=req_qty,   # In requested unit
-                                        status='Afsluttet',
-                                        date=sale_date
-                                    )
-                                    session.add(new_line)
-                                    session.flush()
-
-                                    # Deduct product quantity and update batches
-                                    product_obj.quantity -= total_allocated_in_native
-
-                                    for alloc in product_allocations[prod_id]:
-                                        batch = session.query(ProductBatch).filter_by(id=alloc['batch_id']).first()
-                                        # Convert allocated_quantity back to the batch's unit
-                                        deduct_qty = convert_units(alloc['allocated_quantity'], product_obj.unit, batch.unit)
-                                        batch.quantity -= deduct_qty
-                                        # If you need a record of which batch was sold, create a corresponding table
-                                        # to store these details, similar to ProductionOrderComponent or PurchaseOrderItem.
-
+                                services.sell(session, customer_id, sale_date, lines)
                                 session.commit()
                                 refresh_products()
                                 refresh_product_batches()
                                 refresh_sales_orders()
+                                st.session_state.sales_allocation_open = False
                                 st.success("Salgsordre oprettet med succes!")
+                            except services.ServiceError as e:
+                                session.rollback()
+                                st.error(str(e))
                             except Exception as e:
                                 session.rollback()
                                 st.error(f"Der opstod en fejl under oprettelse af salgsordren: {str(e)}")
@@ -1452,7 +1561,7 @@ elif action == "Smid noget ud":
         if materials:
             material = st.selectbox("Vælg materiale", [(m.id, m.name) for m in materials], key="dispose_material")
             material_id, material_name = material
-            batches = [b for b in st.session_state.material_batches if b.material_id == material_id and b.quantity > 0]
+            batches = [b for b in st.session_state.material_batches if b.material_id == material_id]
             if batches:
                 batch = st.selectbox(
                     "Vælg batch at bortskaffe fra",
@@ -1471,19 +1580,7 @@ elif action == "Smid noget ud":
                         st.error("Årsag er påkrævet.")
                     else:
                         try:
-                            batch_to_update = session.query(MaterialBatch).filter_by(id=batch_id).first()
-                            batch_to_update.quantity -= quantity
-                            material_to_update = session.query(Material).filter_by(id=material_id).first()
-                            material_to_update.quantity -= convert_units(quantity, batch_unit, material_to_update.unit)
-                            disposal_record = DisposalRecord(
-                                material_id=material_id,
-                                batch_id=batch_id,
-                                quantity=quantity,
-                                unit=batch_unit,
-                                reason=reason,
-                                date=date
-                            )
-                            session.add(disposal_record)
+                            services.dispose(session, 'material', batch_id, quantity, reason, date)
                             session.commit()
                             refresh_materials()
                             refresh_material_batches()
@@ -1500,7 +1597,7 @@ elif action == "Smid noget ud":
         if products:
             product = st.selectbox("Vælg produkt", [(p.id, p.name) for p in products], key="dispose_product")
             product_id, product_name = product
-            batches = [b for b in st.session_state.product_batches if b.product_id == product_id and b.quantity > 0]
+            batches = [b for b in st.session_state.product_batches if b.product_id == product_id]
             if batches:
                 batch = st.selectbox(
                     "Vælg batch at bortskaffe fra",
@@ -1519,19 +1616,7 @@ elif action == "Smid noget ud":
                         st.error("Årsag er påkrævet.")
                     else:
                         try:
-                            batch_to_update = session.query(ProductBatch).filter_by(id=batch_id).first()
-                            batch_to_update.quantity -= quantity
-                            product_to_update = session.query(Product).filter_by(id=product_id).first()
-                            product_to_update.quantity -= convert_units(quantity, batch_unit, product_to_update.unit)
-                            disposal_record = DisposalRecord(
-                                product_id=product_id,
-                                batch_id=batch_id,
-                                quantity=quantity,
-                                unit=batch_unit,
-                                reason=reason,
-                                date=date
-                            )
-                            session.add(disposal_record)
+                            services.dispose(session, 'product', batch_id, quantity, reason, date)
                             session.commit()
                             refresh_products()
                             refresh_product_batches()
@@ -1544,6 +1629,75 @@ elif action == "Smid noget ud":
         else:
             st.error("Ingen produkter tilgængelige.")
 
+    st.subheader("Bortskaf mange batches på én gang")
+    bulk_kind = 'material' if disposal_type == "Materiale" else 'product'
+    if bulk_kind == 'material':
+        names = {m.id: m.name for m in st.session_state.materials}
+        live_batches = st.session_state.material_batches
+    else:
+        names = {p.id: p.name for p in st.session_state.products}
+        live_batches = st.session_state.product_batches
+    bulk_reason = st.text_input("Årsag (bruges hvor linjen ikke selv har en årsag)", key="bulk_dispose_reason")
+    bulk_date = st.date_input("Dato for bortskaffelse", datetime.now(), key="bulk_dispose_date")
+    select_tab, csv_tab = st.tabs(["Vælg batches", "CSV-fil"])
+    bulk_lines = None
+    with select_tab:
+        if live_batches:
+            bulk_df = pd.DataFrame([{
+                "Bortskaf": False,
+                "ID": b.id,
+                "Navn": names.get(b.material_id if bulk_kind == 'material' else b.product_id, "Ukendt"),
+                "Batch ID": b.batch_id,
+                "Tilgængelig": b.quantity,
+                "Mængde": b.quantity,
+                "Enhed": b.unit,
+                "Bedst før": b.expiry_date,
+            } for b in live_batches])
+            edited = st.data_editor(
+                bulk_df,
+                disabled=["ID", "Navn", "Batch ID", "Tilgængelig", "Enhed", "Bedst før"],
+                hide_index=True,
+                key=f"bulk_dispose_editor_{bulk_kind}"
+            )
+            chosen = edited[edited["Bortskaf"]]
+            st.caption(f"{len(chosen)} batches valgt.")
+            if st.button("Bortskaf valgte batches", key="bulk_dispose_selected"):
+                bulk_lines = [{'batch_id': row["ID"], 'quantity': row["Mængde"]} for _, row in chosen.iterrows()]
+        else:
+            st.info("Ingen batches med lager.")
+    with csv_tab:
+        st.caption("Kolonner: id (batchens database-ID som vist under Administrationsside), quantity (tom = hele restmængden) og eventuelt reason.")
+        bulk_file = st.file_uploader("Upload CSV", type=["csv"], key="bulk_dispose_csv")
+        if bulk_file is not None:
+            try:
+                csv_df = pd.read_csv(bulk_file, sep=None, engine="python")
+                csv_df.columns = [c.strip().lower() for c in csv_df.columns]
+                if "id" not in csv_df.columns:
+                    st.error("CSV-filen mangler kolonnen 'id'.")
+                else:
+                    st.dataframe(csv_df)
+                    if st.button("Bortskaf batches fra fil", key="bulk_dispose_file"):
+                        bulk_lines = csv_df.rename(columns={"id": "batch_id"})
+            except Exception as e:
+                st.error(f"Kunne ikke læse CSV-filen: {str(e)}")
+    if bulk_lines is not None:
+        try:
+            bulk_result = services.dispose_many(session, bulk_kind, bulk_lines, bulk_date, reason=bulk_reason)
+            session.commit()
+            if bulk_kind == 'material':
+                refresh_materials()
+                refresh_material_batches()
+            else:
+                refresh_products()
+                refresh_product_batches()
+            st.success(f"{bulk_result['lines']} linjer bortskaffet fra {bulk_result['batches']} batches.")
+        except services.ServiceError as e:
+            session.rollback()
+            st.error(str(e))
+        except Exception as e:
+            session.rollback()
+            st.error(f"Der opstod en fejl under bortskaffelsen: {str(e)}")
+
 elif action == "Opret en ny kunde":
     st.header("Opret en ny kunde")
     customer_name = st.text_input("Kundens navn")
@@ -1553,15 +1707,8 @@ elif action == "Opret en ny kunde":
     vat_number = st.text_input("CVR-nummer")
     if st.button("Tilføj kunde"):
         if all([customer_name, customer_address, contact_email, phone_number, vat_number]):
-            new_customer = Customer(
-                name=customer_name,
-                address=customer_address,
-                contact_email=contact_email,
-                phone_number=phone_number,
-                vat_number=vat_number
-            )
             try:
-                session.add(new_customer)
+                services.create_customer(session, customer_name, customer_address, contact_email, phone_number, vat_number)
                 session.commit()
                 refresh_customers()
                 st.success("Kunde tilføjet med succes!")
@@ -1582,26 +1729,18 @@ elif action == "Opret en ny leverandør":
     report_file = st.file_uploader("Upload leverandørrapport (PDF eller billede)", type=["pdf", "png", "jpg", "jpeg"], key="supplier_report")
     if st.button("Tilføj leverandør"):
         if all([supplier_name, supplier_address, contact_email, phone_number, vat_number]):
-            report_file_data = None
-            report_filename = None
-            report_mimetype = None
-            if report_file is not None:
-                report_file_data = report_file.read()
-                report_filename = report_file.name
-                report_mimetype = report_file.type
-            new_supplier = Supplier(
-                name=supplier_name,
-                address=supplier_address,
-                contact_email=contact_email,
-                phone_number=phone_number,
-                vat_number=vat_number,
-                organic_number=organic_number,
-                report_file=report_file_data,
-                report_filename=report_filename,
-                report_mimetype=report_mimetype
-            )
             try:
-                session.add(new_supplier)
+                report_attachment_id = attachments.store_upload(engine, report_file)
+                services.create_supplier(
+                    session,
+                    supplier_name,
+                    supplier_address,
+                    contact_email,
+                    phone_number,
+                    vat_number,
+                    organic_number=organic_number,
+                    report_attachment_id=report_attachment_id
+                )
                 session.commit()
                 refresh_suppliers()
                 st.success("Leverandør tilføjet med succes!")
@@ -1610,3 +1749,438 @@ elif action == "Opret en ny leverandør":
                 st.error(f"Der opstod en fejl under tilføjelse: {str(e)}")
         else:
             st.error("Udfyld venligst alle felter.")
+
+elif action == "Produktionsplan":
+    st.header("Produktionsplan")
+    products_map = {p.id: p for p in st.session_state.products}
+
+    with st.expander("Produktionslinjer"):
+        lines = read_session.query(ProductionLine).order_by(ProductionLine.id).all()
+        if lines:
+            st.dataframe(pd.DataFrame([{"ID": l.id, "Navn": l.name, "Minutter pr. dag": l.minutes_per_day,
+                                        "Aktiv": "Ja" if l.active else "Nej"} for l in lines]))
+        else:
+            st.info(f"Ingen linjer oprettet; planen bruger én linje med {planning.DEFAULT_LINE['minutes_per_day']:.0f} minutter pr. dag.")
+        with st.form("production_line_form"):
+            line_name = st.text_input("Linjens navn", key="line_name")
+            line_minutes = st.number_input("Kapacitet (minutter pr. dag)", min_value=1.0, value=480.0, step=30.0, key="line_minutes")
+            add_line = st.form_submit_button("Opret linje")
+        if add_line:
+            if not line_name.strip():
+                st.error("Navn er påkrævet.")
+            else:
+                try:
+                    services.create_production_line(session, line_name, line_minutes)
+                    session.commit()
+                    st.success("Linje oprettet.")
+                except services.ServiceError as e:
+                    session.rollback()
+                    st.error(str(e))
+
+    with st.expander("Opskrifters varighed"):
+        recipes = session.query(Recipe).order_by(Recipe.id).all()
+        durations_df = pd.DataFrame([{
+            "ID": r.id,
+            "Produkt": products_map[r.product_id].name if r.product_id in products_map else "Ukendt",
+            "Mængde pr. opskrift": r.output_quantity,
+            "Minutter pr. opskrift": r.duration_minutes,
+        } for r in recipes])
+        if not durations_df.empty:
+            edited_durations = st.data_editor(durations_df, disabled=["ID", "Produkt", "Mængde pr. opskrift"], hide_index=True, key="recipe_durations")
+            if st.button("Gem varigheder", key="save_durations"):
+                recipe_map = {r.id: r for r in recipes}
+                for _, row in edited_durations.iterrows():
+                    minutes = row["Minutter pr. opskrift"]
+                    recipe_map[row["ID"]].duration_minutes = None if pd.isna(minutes) else float(minutes)
+                session.commit()
+                st.success("Varigheder gemt.")
+
+    st.subheader("Planlæg produktionsordre")
+    if st.session_state.products:
+        with st.form("plan_order_form"):
+            plan_product = st.selectbox("Produkt", [(p.id, p.name) for p in st.session_state.products], format_func=lambda x: x[1], key="plan_product")
+            plan_quantity = st.number_input("Mængde", min_value=0.0, step=0.1, key="plan_quantity")
+            plan_due_date = st.date_input("Leveringsdato", datetime.now() + timedelta(days=7), key="plan_due_date")
+            plan_priority = st.selectbox("Prioritet", [0, 1, 2], format_func=lambda p: ["Normal", "Høj", "Haster"][p], key="plan_priority")
+            plan_submit = st.form_submit_button("Tilføj til plan")
+        if plan_submit:
+            try:
+                services.plan_production_order(session, plan_product[0], plan_quantity, plan_due_date, plan_priority)
+                session.commit()
+                refresh_production_orders()
+                st.success("Produktionsordre tilføjet til planen.")
+            except services.ServiceError as e:
+                session.rollback()
+                st.error(str(e))
+
+    st.subheader("Tidslinje")
+    if st.button("Beregn plan", key="compute_schedule"):
+        try:
+            started = datetime.now()
+            scheduled, unscheduled = planning.build_schedule(session)
+            planning.apply_schedule(session, scheduled, unscheduled)
+            session.commit()
+            refresh_production_orders()
+            st.session_state.unscheduled_orders = unscheduled
+            st.success(f"{len(scheduled)} ordrer planlagt, {len(unscheduled)} kunne ikke planlægges "
+                       f"({(datetime.now() - started).total_seconds():.2f} s).")
+        except Exception as e:
+            session.rollback()
+            st.error(f"Fejl under planlægning: {str(e)}")
+
+    line_names = {l.id: l.name for l in read_session.query(ProductionLine).all()}
+    planned = [o for o in st.session_state.production_orders if o.status == planning.PLANNED and o.planned_start]
+    if planned:
+        timeline_df = pd.DataFrame([{
+            "Ordre": o.id,
+            "Produkt": products_map[o.product_id].name if o.product_id in products_map else "Ukendt",
+            "Mængde": o.quantity,
+            "Linje": line_names.get(o.line_id, planning.DEFAULT_LINE['name']),
+            "Start": o.planned_start,
+            "Slut": o.planned_end,
+            "Leveringsdato": o.due_date,
+            "Forsinket": "Ja" if o.due_date and o.planned_end.date() > o.due_date else "Nej",
+        } for o in planned])
+        chart = alt.Chart(timeline_df).mark_bar().encode(
+            x="Start:T",
+            x2="Slut:T",
+            y="Linje:N",
+            color=alt.Color("Forsinket:N", scale=alt.Scale(domain=["Nej", "Ja"], range=["#4c78a8", "#e45756"])),
+            tooltip=["Ordre", "Produkt", "Mængde", "Start", "Slut", "Leveringsdato"]
+        ).interactive()
+        st.altair_chart(chart)
+        st.dataframe(timeline_df.sort_values("Start"))
+    else:
+        st.info("Ingen planlagte ordrer. Tilføj ordrer og tryk 'Beregn plan'.")
+
+    if st.session_state.get("unscheduled_orders"):
+        st.subheader("Kunne ikke planlægges")
+        materials_map = {m.id: m for m in st.session_state.materials}
+
+        def shortage_text(order):
+            parts = []
+            for (kind, item_id), missing in order.get('shortages', []):
+                item = (materials_map if kind == 'material' else products_map).get(item_id)
+                parts.append(f"{item.name if item else item_id}: mangler {missing:.2f} {item.unit if item else ''}")
+            return ", ".join(parts)
+
+        st.dataframe(pd.DataFrame([{
+            "Ordre": o['id'],
+            "Produkt": products_map[o['product_id']].name if o['product_id'] in products_map else "Ukendt",
+            "Mængde": o['quantity'],
+            "Leveringsdato": o['due_date'],
+            "Årsag": o['reason'],
+            "Mangler": shortage_text(o),
+        } for o in st.session_state.unscheduled_orders]))
+
+elif action == "Genbestilling":
+    st.header("Genbestilling")
+    st.caption(f"Forbrug de seneste {replenishment.WINDOW_DAYS} dage fra produktionsordrerne. "
+               f"Sikkerhedslager = {replenishment.SERVICE_LEVEL_Z} × spredning × √leveringstid; "
+               f"genbestillingspunkt = gns. dagsforbrug × leveringstid + sikkerhedslager.")
+    if st.button("Genberegn alt", key="replenishment_recompute"):
+        try:
+            count = replenishment.refresh_stats(session)
+            session.commit()
+            st.success(f"Nøgletal beregnet for {count} materialer.")
+        except Exception as e:
+            session.rollback()
+            st.error(f"Fejl under beregning: {str(e)}")
+
+    suppliers_map = {s.id: s for s in st.session_state.suppliers}
+    overview_df = replenishment.overview(read_session)
+    if overview_df.empty:
+        st.info("Ingen materialer oprettet.")
+    else:
+        stats_df = pd.DataFrame({
+            "ID": overview_df["material_id"],
+            "Materiale": overview_df["name"],
+            "Enhed": overview_df["unit"],
+            "På lager": overview_df["quantity"].round(2),
+            "I kladder": overview_df["on_order"].round(2),
+            "Gns. dagsforbrug": overview_df["daily_mean"].round(3),
+            "Spredning": overview_df["daily_std"].round(3),
+            "Leveringstid (dage)": overview_df["lead_time_days"],
+            "Sikkerhedslager": overview_df["safety_stock"].round(2),
+            "Genbestillingspunkt": overview_df["reorder_point"].round(2),
+            "Under punkt": overview_df["below_reorder_point"].map({True: "Ja", False: "Nej"}),
+        })
+        edited_stats = st.data_editor(stats_df, disabled=[c for c in stats_df.columns if c != "Leveringstid (dage)"],
+                                      hide_index=True, key="replenishment_stats")
+        if st.button("Gem leveringstider", key="save_lead_times"):
+            try:
+                changed = edited_stats[edited_stats["Leveringstid (dage)"] != stats_df["Leveringstid (dage)"]]
+                for _, row in changed.iterrows():
+                    replenishment.set_lead_time(session, int(row["ID"]), float(row["Leveringstid (dage)"]))
+                session.commit()
+                st.success(f"{len(changed)} leveringstider gemt.")
+            except services.ServiceError as e:
+                session.rollback()
+                st.error(str(e))
+
+        proposals_df = overview_df[overview_df["below_reorder_point"]]
+        st.subheader("Indkøbsforslag")
+        if proposals_df.empty:
+            st.info("Ingen materialer under genbestillingspunktet.")
+        else:
+            st.dataframe(pd.DataFrame({
+                "Materiale": proposals_df["name"],
+                "Leverandør": proposals_df["supplier_id"].map(
+                    lambda s: suppliers_map[s].name if s in suppliers_map else "Ingen tidligere leverandør"),
+                "Foreslået mængde": proposals_df["proposed_quantity"].round(2),
+                "Enhed": proposals_df["unit"],
+            }), hide_index=True)
+            if st.button("Opret indkøbskladder", key="create_proposals"):
+                try:
+                    drafts, skipped = replenishment.create_proposals(session, datetime.now().date())
+                    session.commit()
+                    refresh_purchase_orders()
+                    st.success(f"{len(drafts)} indkøbskladder oprettet.")
+                    if skipped:
+                        st.warning(f"{skipped} materialer har ingen tidligere leverandør og skal bestilles manuelt.")
+                except services.ServiceError as e:
+                    session.rollback()
+                    st.error(str(e))
+
+    st.subheader("Indkøbskladder")
+    drafts = read_session.query(PurchaseOrder).filter_by(status=services.DRAFT).order_by(PurchaseOrder.id).all()
+    if not drafts:
+        st.info("Ingen åbne kladder.")
+    materials_map = {m.id: m for m in st.session_state.materials}
+    for draft in drafts:
+        supplier = suppliers_map.get(draft.supplier_id)
+        with st.expander(f"Kladde {draft.id} - {supplier.name if supplier else 'Ukendt'} ({draft.date})"):
+            lines = read_session.query(PurchaseOrderItem).filter_by(purchase_order_id=draft.id).order_by(PurchaseOrderItem.id).all()
+            lines_df = pd.DataFrame([{
+                "ID": line.id,
+                "Materiale": materials_map[line.material_id].name if line.material_id in materials_map else "Ukendt",
+                "Mængde": line.quantity,
+                "Enhed": line.unit,
+                "Stykpris": line.unit_cost,
+            } for line in lines])
+            edited_lines = st.data_editor(lines_df, disabled=["ID", "Materiale", "Enhed"], hide_index=True,
+                                          key=f"draft_lines_{draft.id}")
+            place_date = st.date_input("Bestillingsdato", datetime.now(), key=f"draft_date_{draft.id}")
+            col1, col2 = st.columns(2)
+            if col1.button("Afgiv ordre", key=f"place_draft_{draft.id}"):
+                try:
+                    services.place_purchase_order(session, draft.id, [{
+                        "id": int(row["ID"]),
+                        "quantity": float(row["Mængde"]),
+                        "unit_cost": None if pd.isna(row["Stykpris"]) else float(row["Stykpris"]),
+                    } for _, row in edited_lines.iterrows()], place_date)
+                    session.commit()
+                    refresh_purchase_orders()
+                    st.success("Indkøbsordre bestilt. Varerne modtages under 'Varemodtagelse'.")
+                except services.ServiceError as e:
+                    session.rollback()
+                    st.error(str(e))
+            if col2.button("Slet kladde", key=f"delete_draft_{draft.id}"):
+                try:
+                    services.delete_purchase_order(session, draft.id)
+                    session.commit()
+                    refresh_purchase_orders()
+                    st.success("Kladde slettet.")
+                except services.ServiceError as e:
+                    session.rollback()
+                    st.error(str(e))
+
+elif action == "Kostpriser":
+    st.header("Kostpriser")
+    st.caption("Standardkostpris: seneste indkøbspris pr. materiale, rullet op gennem styklisterne. "
+               "Faktisk kostpris: hvad de forbrugte batches kostede, pr. produceret batch.")
+    col1, col2 = st.columns(2)
+    if col1.button("Genberegn standardkostpriser", key="roll_standard_costs"):
+        try:
+            result = costing.roll_standard_costs(session)
+            session.commit()
+            refresh_materials()
+            refresh_products()
+            st.success(f"{result['products']} produkter beregnet ({result['unknown']} uden kendt pris) på {result['seconds']} s.")
+        except Exception as e:
+            session.rollback()
+            st.error(f"Fejl under beregning: {str(e)}")
+    if col2.button("Genberegn faktiske kostpriser", key="roll_actual_costs"):
+        try:
+            result = costing.roll_actual_costs(session)
+            session.commit()
+            refresh_product_batches()
+            st.success(f"{result['updated']} af {result['batches']} batches opdateret på {result['seconds']} s.")
+        except Exception as e:
+            session.rollback()
+            st.error(f"Fejl under beregning: {str(e)}")
+
+    st.subheader("Produkter")
+    products_df = pd.DataFrame([{
+        "ID": p.id,
+        "Produkt": p.name,
+        "Enhed": p.unit,
+        "Standardkostpris pr. enhed": p.standard_cost,
+        "Lagerværdi (standard)": None if p.standard_cost is None else p.quantity * p.standard_cost,
+    } for p in st.session_state.products])
+    if not products_df.empty:
+        st.dataframe(products_df, hide_index=True)
+
+    st.subheader("Materialer")
+    materials_df = pd.DataFrame([{
+        "ID": m.id,
+        "Materiale": m.name,
+        "Enhed": m.unit,
+        "Standardkostpris pr. enhed": m.standard_cost,
+        "Lagerværdi (standard)": None if m.standard_cost is None else m.quantity * m.standard_cost,
+    } for m in st.session_state.materials])
+    if not materials_df.empty:
+        st.dataframe(materials_df, hide_index=True)
+
+    st.subheader("Produktbatches")
+    products_map = {p.id: p for p in st.session_state.products}
+    batches_df = pd.DataFrame([{
+        "ID": b.id,
+        "Produkt": products_map[b.product_id].name if b.product_id in products_map else "Ukendt",
+        "Batch ID": b.batch_id,
+        "Dato": b.date,
+        "Faktisk kostpris pr. enhed": b.unit_cost,
+        "Standardkostpris pr. enhed": products_map[b.product_id].standard_cost if b.product_id in products_map else None,
+    } for b in read_session.query(ProductBatch).order_by(ProductBatch.id)])
+    if not batches_df.empty:
+        batches_df["Afvigelse"] = (pd.to_numeric(batches_df["Faktisk kostpris pr. enhed"])
+                                   - pd.to_numeric(batches_df["Standardkostpris pr. enhed"]))
+        st.dataframe(batches_df, hide_index=True)
+
+elif action == "Eksporter data":
+    st.header("Eksporter data")
+    # With several sites only the site's rows and the shared data; logs and attachments mixing all sites are not offered
+    export_site_id = sites.current(read_session) if len(all_sites) > 1 else None
+    source = st.selectbox(
+        "Vælg tabel eller rapport",
+        export.export_sources(export_site_id),
+        key="export_source"
+    )
+    export_format = st.radio("Format", export.EXPORT_FORMATS, format_func=str.upper, key="export_format")
+    include_blobs = st.checkbox("Medtag filer (fakturaer og rapporter)", key="export_include_blobs")
+    st.caption("Data streames i bidder direkte fra databasen. Store eksporter kan også køres med `python export.py`.")
+    export_in_background = st.checkbox("Kør i baggrunden", key="export_in_background")
+    export_clicked = st.button("Eksporter", key="export_submit")
+    if export_clicked and export_in_background:
+        job_id = get_job_queue().submit('export', {'source': source, 'format': export_format, 'include_blobs': include_blobs,
+                                                   'site_id': export_site_id})
+        st.info(f"Eksporten kører i baggrunden (job #{job_id}). Hent filen under 'Baggrundsjob'.")
+    elif export_clicked:
+        file_name = f"{source.replace('report:', '')}.{export_format}"
+        export_path = os.path.join(tempfile.mkdtemp(), file_name)
+        try:
+            with st.spinner("Eksporterer..."):
+                row_count = export.export_to_file(read_engine or engine, source, export_path, export_format, include_blobs,
+                                                   site_id=export_site_id)
+            st.success(f"{row_count} rækker eksporteret.")
+            with open(export_path, "rb") as f:
+                st.download_button("Download eksport", data=f, file_name=file_name, key="export_download")
+        except Exception as e:
+            st.error(f"Der opstod en fejl under eksporten: {str(e)}")
+
+elif action == "Analyse" and "SITE_ID" in st.secrets and not st.secrets.get("ANALYTICS_ALL_SITES", False):
+    # The DuckDB copy and its SQL cover every site, so a deployment pinned to one site does not offer it
+    st.header("Analyse")
+    st.info("Analysen dækker alle produktionssteder og er kun tilgængelig i en installation med ANALYTICS_ALL_SITES.")
+
+elif action == "Analyse":
+    st.header("Analyse")
+    st.caption("Analysen dækker alle produktionssteder.")
+    store = get_analytics_store()
+    sync_now = st.button("Synkroniser nu", key="analytics_sync")
+    try:
+        # Sync from the replica when there is one; the queries themselves only run against the local DuckDB file
+        if sync_now:
+            sync_result = store.sync(read_engine or engine)
+        else:
+            sync_result = store.sync_if_stale(read_engine or engine)
+        if sync_result:
+            st.caption(f"Synkroniserede {sum(sync_result['rows'].values())} rækker på {sync_result['seconds']} s.")
+    except Exception as e:
+        st.error(f"Fejl under synkronisering: {str(e)}")
+    last_synced = store.last_synced()
+    st.caption(f"Data senest synkroniseret: {last_synced:%Y-%m-%d %H:%M:%S}" if last_synced else "Data er ikke synkroniseret endnu.")
+
+    report_name = st.selectbox("Vælg rapport", list(analytics.REPORTS), format_func=lambda name: analytics.REPORTS[name][0], key="analytics_report")
+    try:
+        started = datetime.now()
+        report_df = store.report(report_name)
+        st.dataframe(report_df)
+        st.caption(f"{len(report_df)} rækker på {(datetime.now() - started).total_seconds() * 1000:.0f} ms")
+    except analytics.AnalyticsError as e:
+        st.error(str(e))
+
+    with st.expander("Egen forespørgsel (SQL)"):
+        st.caption("Tabeller: " + ", ".join(store.tables()))
+        sql = st.text_area("SELECT-forespørgsel", value="SELECT * FROM material LIMIT 100", key="analytics_sql")
+        if st.button("Kør forespørgsel", key="analytics_run"):
+            try:
+                st.dataframe(store.query(sql))
+            except analytics.AnalyticsError as e:
+                st.error(str(e))
+
+elif action == "Baggrundsjob":
+    st.header("Baggrundsjob")
+    st.button("Opdater", key="jobs_refresh")
+    job_session = DBSession()
+    try:
+        recent = jobs.recent_jobs(job_session)
+        if not recent:
+            st.info("Ingen baggrundsjob endnu.")
+        seen_done = st.session_state.setdefault("jobs_seen_done", set())
+        for db_job in recent:
+            with st.container(border=True):
+                st.write(f"**#{db_job.id} {db_job.kind}** - {db_job.status} (oprettet {db_job.created_at:%Y-%m-%d %H:%M})")
+                if db_job.status in (jobs.PENDING, jobs.RUNNING):
+                    st.progress(db_job.progress, text=db_job.message or "")
+                elif db_job.status == jobs.FAILED:
+                    st.error(db_job.message or "Ukendt fejl")
+                else:
+                    result = jobs.job_result(db_job) or {}
+                    if db_job.kind == 'purchase_order' and db_job.id not in seen_done:
+                        refresh_materials()
+                        refresh_purchase_orders()
+                        refresh_material_batches()
+                    seen_done.add(db_job.id)
+                    if result.get('path') and os.path.exists(result['path']):
+                        with open(result['path'], "rb") as f:
+                            st.download_button("Download resultat", data=f, file_name=result['file_name'], key=f"job_download_{db_job.id}")
+                    else:
+                        st.json(result)
+    finally:
+        job_session.close()
+
+session.close()
+read_session.close()
+# Memory this session keeps between reruns; also releases the lists of sessions that have gone idle
+script_ctx = get_script_run_ctx()
+if script_ctx is not None:
+    snapshots.track(script_ctx.session_id, script_ctx.session_state,
+                    budget_bytes=float(st.secrets.get("SESSION_BUDGET_MB", snapshots.SESSION_BUDGET_BYTES / 2 ** 20)) * 2 ** 20,
+                    idle_seconds=float(st.secrets.get("SESSION_IDLE_MINUTES", snapshots.IDLE_SECONDS / 60)) * 60)
+rerun_stats = instrumentation.finish()
+if st.secrets.get("DEBUG_PANEL", False) or st.query_params.get("debug") == "1":
+    with st.sidebar.expander("Debug: databaseforbrug", expanded=False):
+        if rerun_stats:
+            st.write(f"**Side:** {rerun_stats.label}")
+            st.write(f"**Kørselstid:** {rerun_stats.duration_ms:.0f} ms")
+            st.write(f"**Forespørgsler:** {rerun_stats.queries} ({rerun_stats.db_time_ms:.0f} ms i databasen)")
+            st.write(f"**Rækker hentet:** {rerun_stats.rows}")
+            st.write(f"**Filer hentet:** {rerun_stats.blob_bytes / 1024:.0f} KB")
+            st.write(f"**Cache:** {rerun_stats.cache_hits} hits, {rerun_stats.cache_misses} misses")
+            slowest = rerun_stats.slowest_queries()
+            if slowest:
+                st.write("**Langsomste forespørgsler:**")
+                st.dataframe(pd.DataFrame(slowest))
+        recent = instrumentation.history()[-20:]
+        if recent:
+            st.write("**Seneste kørsler:**")
+            st.dataframe(pd.DataFrame(recent)[["label", "duration_ms", "queries", "db_time_ms", "rows", "blob_bytes", "cache_hits", "cache_misses"]])
+        memory = snapshots.usage()
+        st.write(f"**Hukommelse:** {memory['total_bytes'] / 2 ** 20:.2f} MB i alt, heraf {memory['snapshot_bytes'] / 2 ** 20:.2f} MB "
+                 f"delte lister, {memory['stale_snapshot_bytes'] / 2 ** 20:.2f} MB ældre listeversioner og "
+                 f"{memory['session_bytes'] / 2 ** 20:.2f} MB i {len(memory['sessions'])} sessioner "
+                 f"({memory['active_sessions']} aktive)")
+        if memory['sessions']:
+            st.dataframe(pd.DataFrame(memory['sessions']))
+        st.download_button("Download Prometheus-metrikker", data=instrumentation.prometheus_text(), file_name="metrics.txt", mime="text/plain")
@@ -0,0 +1,114 @@
+import hashlib
+import io
+import os
+import zlib
+from datetime import datetime, timedelta
+from PIL import Image, ImageOps
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models import Attachment, PurchaseOrder, Supplier
+
+# Uploaded invoices and supplier reports.
+# Files are stored once per content hash in the attachment table, on their own connection and
+# before the business transaction, so committing an order only writes an attachment id no matter
+# how big the scan is. Images are downsized and re-encoded with Pillow, other files are compressed
+# with zlib when that saves space. Attachments nothing refers to (an upload whose order then failed)
+# are removed by prune_orphans.
+
+MAX_IMAGE_SIDE = 2000
+JPEG_QUALITY = 85
+ZLIB = 'zlib'
+MIN_SAVING = 0.1
+ORPHAN_GRACE_HOURS = 24
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def shrink_image(data):
+    # -> (data, mimetype), or None when Pillow cannot read the file or not make it smaller
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception:
+        return None
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    out = io.BytesIO()
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image.save(out, 'PNG', optimize=True)
+        mimetype = 'image/png'
+    else:
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        mimetype = 'image/jpeg'
+    if out.tell() >= len(data):
+        return None
+    return out.getvalue(), mimetype
+
+def prepare(data, filename, mimetype):
+    # The attachment row for an upload; the hash is of the uploaded bytes, so uploading the same file again finds it
+    row = {'sha256': digest(data), 'filename': filename, 'mimetype': mimetype, 'size': len(data), 'compression': None}
+    if mimetype and mimetype.startswith('image/'):
+        shrunk = shrink_image(data)
+        if shrunk is not None:
+            data, new_mimetype = shrunk
+            if new_mimetype != mimetype and filename:
+                filename = os.path.splitext(filename)[0] + ('.jpg' if new_mimetype == 'image/jpeg' else '.png')
+            row.update(filename=filename, mimetype=new_mimetype)
+    else:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data) * (1 - MIN_SAVING):
+            data, row['compression'] = compressed, ZLIB
+    row.update(data=data, stored_size=len(data), created_at=datetime.now())
+    return row
+
+def find(conn, sha256):
+    return conn.execute(select(Attachment.id).where(Attachment.sha256 == sha256)).scalar()
+
+def store_in(conn, data, filename, mimetype):
+    # Inside the caller's transaction on conn (migrations); returns the attachment id
+    return find(conn, digest(data)) or conn.execute(insert(Attachment).values(**prepare(data, filename, mimetype))).inserted_primary_key[0]
+
+def store(engine, data, filename, mimetype):
+    # In short transactions of its own; the image work happens outside any transaction
+    sha256 = digest(data)
+    with engine.begin() as conn:
+        attachment_id = find(conn, sha256)
+        if attachment_id:
+            # Reused uploads count as new, so prune_orphans leaves them alone until the order is saved
+            conn.execute(update(Attachment).where(Attachment.id == attachment_id).values(created_at=datetime.now()))
+            return attachment_id
+    row = prepare(data, filename, mimetype)
+    try:
+        with engine.begin() as conn:
+            return conn.execute(insert(Attachment).values(**row)).inserted_primary_key[0]
+    except IntegrityError:
+        # The same file was uploaded at the same time
+        with engine.begin() as conn:
+            return find(conn, sha256)
+
+def store_upload(engine, uploaded_file):
+    # Streamlit UploadedFile -> attachment id, or None when nothing was uploaded
+    if uploaded_file is None:
+        return None
+    return store(engine, uploaded_file.getvalue(), uploaded_file.name, uploaded_file.type)
+
+def load(session, attachment_id):
+    # -> (data, filename, mimetype), or None
+    if not attachment_id:
+        return None
+    attachment = session.get(Attachment, attachment_id)
+    if attachment is None or attachment.data is None:
+        return None
+    data = zlib.decompress(attachment.data) if attachment.compression == ZLIB else attachment.data
+    return data, attachment.filename, attachment.mimetype
+
+def prune_orphans(session, grace_hours=ORPHAN_GRACE_HOURS):
+    # Uploads younger than the grace period may belong to an order that is still being saved
+    used = (select(PurchaseOrder.invoice_attachment_id).where(PurchaseOrder.invoice_attachment_id.isnot(None))
+            .union(select(Supplier.report_attachment_id).where(Supplier.report_attachment_id.isnot(None))))
+    result = session.execute(delete(Attachment).where(
+        Attachment.created_at < datetime.now() - timedelta(hours=grace_hours),
+        Attachment.id.notin_(used)))
+    return result.rowcount
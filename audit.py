@@ -0,0 +1,284 @@
+import atexit
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import event, insert, inspect, select
+from sqlalchemy.orm import Session
+from models import AuditLog
+from db import create_erp_engine
+from export import is_blob_column
+
+logger = logging.getLogger("erp.audit")
+
+# Change audit: who changed what, with the values before and after.
+# Session events collect the changes of every flush; when the transaction commits they are handed
+# to a background writer that inserts them in batches on its own connection, so a commit only pays
+# for reading the attribute history. Rolled back changes (also savepoints) are never written.
+# Bulk UPDATE/DELETE/INSERT statements are recorded once per statement with their parameters.
+
+SKIPPED_TABLES = {'audit_log', 'job', 'api_idempotency_key', 'schema_migration'}
+BATCH_SIZE = 500
+FLUSH_SECONDS = 1.0
+WRITE_ATTEMPTS = 3
+MAX_VALUE_LENGTH = 1000
+MAX_BULK_PARAMETERS = 50
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+_writer = None
+_start_lock = threading.Lock()
+
+class AuditWriter:
+    def __init__(self, url, source, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS):
+        self.engine = create_erp_engine(url, pool_pre_ping=True)
+        self.source = source
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue()
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, records):
+        # One item per committed transaction
+        self.queue.put(records)
+
+    def flush(self):
+        # Blocks until everything committed so far is written (or given up on)
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            # Collect for a moment so busy periods become a few large inserts
+            deadline = time.monotonic() + self.flush_seconds
+            while sum(len(item) for item in items) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write([record for item in items for record in item])
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _write(self, records):
+        rows = [dict(record, source=self.source, changes=json.dumps(record['changes'], default=str)) for record in records]
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(insert(AuditLog), rows)
+                self.written += len(rows)
+                return
+            except Exception:
+                logger.exception("Writing %d audit records failed (attempt %d)", len(rows), attempt + 1)
+                time.sleep(2 ** attempt)
+        self.dropped += len(rows)
+
+def start(url, source):
+    # One writer per process; the first caller decides the source recorded on the rows
+    global _writer
+    with _start_lock:
+        if _writer is None:
+            _writer = AuditWriter(url, source)
+            event.listen(Session, "before_flush", _before_flush)
+            event.listen(Session, "after_flush", _after_flush)
+            event.listen(Session, "do_orm_execute", _do_orm_execute)
+            event.listen(Session, "after_commit", _after_commit)
+            event.listen(Session, "after_soft_rollback", _after_soft_rollback)
+            event.listen(Session, "after_transaction_end", _after_transaction_end)
+            atexit.register(_writer.flush)
+    return _writer
+
+def flush():
+    if _writer is not None:
+        _writer.flush()
+
+def set_actor(session, actor):
+    session.info['audit_actor'] = actor
+    return session
+
+# Capture
+def _value(column, value):
+    if value is None:
+        return None
+    if is_blob_column(column):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, str) and len(value) > MAX_VALUE_LENGTH:
+        return value[:MAX_VALUE_LENGTH] + "…"
+    return value
+
+def _entity_id(mapper, obj):
+    identity = mapper.primary_key_from_instance(obj)
+    return identity[0] if len(identity) == 1 and isinstance(identity[0], int) else None
+
+def _changed_keys(state):
+    # Only the attributes touched since the last flush; walking every column's history costs more
+    return [key for key in state.committed_state if key in state.mapper.column_attrs]
+
+def _object_record(session, obj, action):
+    state = inspect(obj)
+    mapper = state.mapper
+    if mapper.local_table.name in SKIPPED_TABLES:
+        return None
+    unloaded = session.info.get('audit_unloaded', {}).get(state.key, {})
+    changes = {}
+    if action == UPDATE:
+        for key in _changed_keys(state):
+            history = state.attrs[key].history
+            before = history.deleted[0] if history.deleted else unloaded.get(key)
+            after = history.added[0] if history.added else None
+            if before != after:
+                column = mapper.column_attrs[key].columns[0]
+                changes[key] = [_value(column, before), _value(column, after)]
+    else:
+        for attr in mapper.column_attrs:
+            if state.dict.get(attr.key) is not None:
+                value = _value(attr.columns[0], state.dict[attr.key])
+                changes[attr.key] = [None, value] if action == INSERT else [value, None]
+    if not changes:
+        return None
+    return {
+        'occurred_at': datetime.now(),
+        'actor': session.info.get('audit_actor'),
+        'entity': mapper.local_table.name,
+        'entity_id': _entity_id(mapper, obj),
+        'action': action,
+        'changes': changes,
+    }
+
+def _pending(session):
+    # Records are tagged with the savepoint they were made in, or None outside savepoints
+    return session.info.setdefault('audit_pending', [])
+
+def _before_flush(session, flush_context, instances):
+    # Attributes assigned without being loaded first (e.g. after a commit expired them) have no
+    # old value in their history; fetch those in one query per table
+    if _writer is None:
+        return
+    missing = {}
+    for obj in session.dirty:
+        state = inspect(obj)
+        mapper = state.mapper
+        if state.key is None or mapper.local_table.name in SKIPPED_TABLES or len(mapper.primary_key) != 1:
+            continue
+        keys = []
+        for key in _changed_keys(state):
+            history = state.attrs[key].history
+            if history.added and not history.deleted:
+                keys.append(key)
+        if keys:
+            missing.setdefault(mapper, {})[state.key] = keys
+    unloaded = session.info.setdefault('audit_unloaded', {})
+    for mapper, by_key in missing.items():
+        primary_key = mapper.primary_key[0]
+        columns = {attr.key: attr.columns[0] for attr in mapper.column_attrs}
+        with session.no_autoflush:
+            rows = session.execute(select(primary_key, *columns.values())
+                                   .where(primary_key.in_([key[1][0] for key in by_key]))).all()
+        for row in rows:
+            key = mapper.identity_key_from_primary_key([row[0]])
+            if key in by_key:
+                unloaded[key] = {name: row[index + 1] for index, name in enumerate(columns) if name in by_key[key]}
+
+def _after_flush(session, flush_context):
+    if _writer is None:
+        return
+    savepoint = session.get_nested_transaction()
+    for objects, action in ((session.new, INSERT), (session.dirty, UPDATE), (session.deleted, DELETE)):
+        for obj in objects:
+            record = _object_record(session, obj, action)
+            if record is not None:
+                _pending(session).append((savepoint, record))
+    session.info.pop('audit_unloaded', None)
+
+def _statement_text(statement):
+    try:
+        text = str(statement.compile(compile_kwargs={'literal_binds': True}))
+    except Exception:
+        try:
+            text = str(statement)
+        except Exception:
+            # ORM bulk inserts (insert(Model) with a list of rows) only compile together with their rows
+            text = str(statement.table.insert())
+    return re.sub(r"\s+", " ", text).strip()[:MAX_VALUE_LENGTH]
+
+def _do_orm_execute(orm_execute_state):
+    if _writer is None or not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    statement = orm_execute_state.statement
+    table = statement.table
+    if table.name in SKIPPED_TABLES:
+        return
+    parameters = orm_execute_state.parameters or []
+    if isinstance(parameters, dict):
+        parameters = [parameters]
+    action = INSERT if orm_execute_state.is_insert else UPDATE if orm_execute_state.is_update else DELETE
+    session = orm_execute_state.session
+    _pending(session).append((session.get_nested_transaction(), {
+        'occurred_at': datetime.now(),
+        'actor': session.info.get('audit_actor'),
+        'entity': table.name,
+        'entity_id': None,
+        'action': action,
+        'changes': {
+            'statement': _statement_text(statement),
+            'rows': len(parameters) or None,
+            'parameters': [dict(p) for p in parameters[:MAX_BULK_PARAMETERS]],
+        },
+    }))
+
+def _after_commit(session):
+    pending = session.info.pop('audit_pending', None)
+    if pending and _writer is not None:
+        _writer.put([record for _, record in pending])
+
+def _inside(savepoint, ended):
+    while savepoint is not None:
+        if savepoint is ended:
+            return True
+        savepoint = savepoint.parent
+    return False
+
+def _after_soft_rollback(session, previous_transaction):
+    pending = session.info.get('audit_pending')
+    if pending and previous_transaction.nested:
+        pending[:] = [(savepoint, record) for savepoint, record in pending if not _inside(savepoint, previous_transaction)]
+
+def _after_transaction_end(session, transaction):
+    # Whatever is left when the outer transaction ends without a commit was rolled back
+    if transaction.parent is None:
+        session.info.pop('audit_pending', None)
+
+# Lookups
+def history(session, entity=None, entity_id=None, actor=None, since=None, until=None, limit=500):
+    query = session.query(AuditLog)
+    if entity:
+        query = query.filter(AuditLog.entity == entity)
+        if entity_id is not None:
+            query = query.filter(AuditLog.entity_id == entity_id)
+    if actor:
+        query = query.filter(AuditLog.actor == actor)
+    if since is not None:
+        query = query.filter(AuditLog.occurred_at >= since)
+    if until is not None:
+        query = query.filter(AuditLog.occurred_at < until)
+    return query.order_by(AuditLog.occurred_at.desc(), AuditLog.id.desc()).limit(limit).all()
+
+def describe_changes(changes):
+    # "quantity: 5.0 → 3.0; name: … → …" for display
+    changes = json.loads(changes) if isinstance(changes, str) else changes or {}
+    if 'statement' in changes:
+        return changes['statement']
+    return "; ".join(f"{key}: {before} → {after}" for key, (before, after) in changes.items())
@@ -0,0 +1,213 @@
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, true
+from models import Material, Product, Recipe, BoM, MaterialBatch, ProductBatch, QC_RELEASED
+from units import convert_units
+
+# How much of every product with a recipe can be made from the batches at hand.
+# "Direct" is what "Producer noget" can make now from the components in stock. "Tree" also makes
+# intermediate products from their own components where their stock runs short, down the whole BoM:
+#   producible(p) = min over the components c of p of available(c) / required(c) per unit of p
+#   available(c)  = stock(c), plus producible(c) for products with a recipe
+# The BoM lines are compiled into arrays once per catalog version and evaluated with numpy, one BoM
+# level at a time, so the whole catalog is a handful of array operations. When batches change, only
+# the products whose tree contains an item with changed stock are evaluated again.
+# Materials that several intermediate products of one tree need are offered to each of them, so
+# the tree figure is an upper bound there; the direct figure is exact.
+
+EPSILON = 1e-9
+
+class Feasibility:
+    # recipes: rows with id, product_id and output_quantity; the first recipe of a product is used, as when producing
+    # boms: rows with recipe_id, component_material_id, component_product_id, quantity_required and unit
+    # materials, products: rows with id, name and unit. Items are addressed by position in the arrays
+    def __init__(self, recipes, boms, materials, products):
+        self.keys = [('material', m.id) for m in materials] + [('product', p.id) for p in products]
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.names = [m.name for m in materials] + [p.name for p in products]
+        self.units = [m.unit for m in materials] + [p.unit for p in products]
+        first = {}
+        for recipe in sorted(recipes, key=lambda r: r.id):
+            first.setdefault(recipe.product_id, recipe)
+        by_recipe = {r.id: r for r in first.values()}
+        parents, children, per_unit = [], [], []
+        for bom in boms:
+            recipe = by_recipe.get(bom.recipe_id)
+            key = ('material', bom.component_material_id) if bom.component_material_id else ('product', bom.component_product_id)
+            if recipe is None or key not in self.index or ('product', recipe.product_id) not in self.index:
+                continue
+            child = self.index[key]
+            parents.append(self.index[('product', recipe.product_id)])
+            children.append(child)
+            per_unit.append(convert_units(bom.quantity_required, bom.unit, self.units[child]) / (recipe.output_quantity or 1))
+        self.products = np.array(sorted(self.index[('product', p)] for p in first if ('product', p) in self.index), dtype=np.int64)
+        self.parents = np.array(parents, dtype=np.int64)
+        self.children = np.array(children, dtype=np.int64)
+        self.per_unit = np.array(per_unit, dtype=float)
+        self.level, self.levels = self._levels()
+        self.with_bom = np.zeros(len(self.keys), dtype=bool)
+        self.with_bom[self.parents] = True
+
+        count = len(self.keys)
+        self.stock = np.zeros(count)
+        self.available = np.zeros(count)
+        self.direct = np.full(count, np.nan)
+        self.tree = np.full(count, np.nan)
+        self.bottleneck = np.full(count, -1, dtype=np.int64)
+        self.evaluated = False
+
+    def _levels(self):
+        # BoM level of each product with BoM lines: 1 when it only needs materials and products without
+        # BoM lines, otherwise one above its highest component. Products in a cycle (or above one) keep 0
+        with_bom = set(self.parents.tolist())
+        needs = defaultdict(set)
+        users = defaultdict(list)
+        for parent, child in zip(self.parents.tolist(), self.children.tolist()):
+            if child in with_bom and child not in needs[parent]:
+                needs[parent].add(child)
+                users[child].append(parent)
+        waiting = {item: len(needs[item]) for item in with_bom}
+        level = np.zeros(len(self.keys), dtype=np.int64)
+        ready = [item for item, count in waiting.items() if count == 0]
+        depth = 0
+        while ready:
+            depth += 1
+            level[ready] = depth
+            next_ready = []
+            for item in ready:
+                for user in users[item]:
+                    waiting[user] -= 1
+                    if waiting[user] == 0:
+                        next_ready.append(user)
+            ready = next_ready
+        return level, depth
+
+    def _stale(self, changed):
+        # Every product whose tree contains one of the changed items, and the changed products themselves,
+        # as what is available of them is their stock plus what can be made
+        frontier = np.zeros(len(self.keys), dtype=bool)
+        frontier[changed] = True
+        dirty = frontier & self.with_bom
+        while frontier.any():
+            up = np.zeros(len(self.keys), dtype=bool)
+            up[self.parents[frontier[self.children]]] = True
+            frontier = up & ~dirty
+            dirty |= up
+        return dirty
+
+    def update(self, stock):
+        # stock: (kind, item_id) -> quantity in the item unit. Returns how many products were evaluated
+        new = np.zeros(len(self.keys))
+        for key, quantity in stock.items():
+            i = self.index.get(key)
+            if i is not None:
+                new[i] = quantity
+        changed = np.flatnonzero(np.abs(new - self.stock) > EPSILON)
+        if self.evaluated:
+            dirty = self._stale(changed)
+        else:
+            dirty = self.with_bom.copy()
+            self.evaluated = True
+        self.stock = new
+        self.available[changed] = new[changed]
+        if dirty.any():
+            self._evaluate(dirty)
+        return int(dirty.sum())
+
+    def _evaluate(self, dirty):
+        entries = dirty[self.parents]
+        parents, children, per_unit = self.parents[entries], self.children[entries], self.per_unit[entries]
+        safe = np.where(per_unit > 0, per_unit, 1.0)
+
+        # Direct: from the stock of the components, and the component that runs out first
+        ratio = np.where(per_unit > 0, self.stock[children] / safe, np.inf)
+        direct = np.full(len(self.keys), np.inf)
+        np.minimum.at(direct, parents, ratio)
+        self.direct[dirty] = direct[dirty]
+        order = np.lexsort((ratio, parents))
+        first = order[np.r_[True, parents[order][1:] != parents[order][:-1]]]
+        self.bottleneck[parents[first]] = children[first]
+
+        # Through the tree, from the lowest BoM level up, so components are done before the products using them
+        levels = self.level[parents]
+        self.tree[dirty & (self.level == 0)] = np.nan
+        for level in range(1, self.levels + 1):
+            at = levels == level
+            if not at.any():
+                continue
+            rows = parents[at]
+            make = np.full(len(self.keys), np.inf)
+            np.minimum.at(make, rows, np.where(per_unit[at] > 0, self.available[children[at]] / safe[at], np.inf))
+            rows = np.unique(rows)
+            self.tree[rows] = make[rows]
+            self.available[rows] = self.stock[rows] + make[rows]
+
+    def frame(self):
+        rows = self.products
+        # Recipes without BoM lines (or with only zero quantities) have no figure. Rounded down, so what is shown can be made
+        direct = np.where(np.isfinite(self.direct[rows]), np.floor(self.direct[rows] * 100 + EPSILON) / 100, np.nan)
+        tree = np.where(np.isfinite(self.tree[rows]), np.floor(self.tree[rows] * 100 + EPSILON) / 100, np.nan)
+        bottleneck = self.bottleneck[rows]
+        return pd.DataFrame({
+            'product_id': [self.keys[i][1] for i in rows],
+            'name': [self.names[i] for i in rows],
+            'unit': [self.units[i] for i in rows],
+            'on_hand': self.stock[rows],
+            'direct': direct,
+            'tree': tree,
+            'bottleneck': [self.names[b] if b >= 0 else None for b in bottleneck],
+            'bottleneck_kind': [self.keys[b][0] if b >= 0 else None for b in bottleneck],
+        })
+
+def build(session):
+    recipes = session.query(Recipe.id, Recipe.product_id, Recipe.output_quantity).all()
+    boms = session.query(BoM.recipe_id, BoM.component_material_id, BoM.component_product_id, BoM.quantity_required, BoM.unit).all()
+    materials = session.query(Material.id, Material.name, Material.unit).order_by(Material.id).all()
+    products = session.query(Product.id, Product.name, Product.unit).order_by(Product.id).all()
+    return Feasibility(recipes, boms, materials, products)
+
+def load_stock(session, feasibility):
+    # The session's site: available batches, materials only once quality control released them; grouped
+    # per item and unit in the database and converted to the item unit
+    stock = defaultdict(float)
+    queries = (
+        ('material', session.query(MaterialBatch.material_id, MaterialBatch.unit, func.sum(MaterialBatch.quantity))
+         .filter(MaterialBatch.available == true(), MaterialBatch.qc_status == QC_RELEASED)
+         .group_by(MaterialBatch.material_id, MaterialBatch.unit)),
+        ('product', session.query(ProductBatch.product_id, ProductBatch.unit, func.sum(ProductBatch.quantity))
+         .filter(ProductBatch.available == true())
+         .group_by(ProductBatch.product_id, ProductBatch.unit)),
+    )
+    for kind, query in queries:
+        for item_id, unit, quantity in query:
+            i = feasibility.index.get((kind, item_id))
+            if i is not None:
+                stock[(kind, item_id)] += convert_units(quantity, unit, feasibility.units[i])
+    return stock
+
+# One engine per site and process, shared by the sessions like the lists in snapshots.py
+_lock = threading.Lock()
+_engines = {}
+
+def current(session, key, catalog_version, stock_version, force=False):
+    # key: the site. The versions tell whether the catalog (materials, products, BoMs) or the batches changed
+    # since the last call; force reloads both, e.g. after changes made through the API or the worker
+    with _lock:
+        entry = _engines.get(key)
+        if force or entry is None or entry['catalog'] != catalog_version:
+            entry = _engines[key] = {'feasibility': build(session), 'catalog': catalog_version, 'stock': None}
+        if force or entry['stock'] != stock_version:
+            started = time.monotonic()
+            feasibility = entry['feasibility']
+            evaluated = feasibility.update(load_stock(session, feasibility))
+            entry.update(stock=stock_version, frame=feasibility.frame(), evaluated=evaluated,
+                         seconds=round(time.monotonic() - started, 3), updated_at=datetime.now())
+        return entry
+
+def clear():
+    with _lock:
+        _engines.clear()
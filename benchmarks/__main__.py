@@ -0,0 +1,4 @@
+import sys
+from benchmarks.runner import main
+
+sys.exit(main())
@@ -0,0 +1,168 @@
+import random
+from datetime import date, timedelta
+from sqlalchemy import insert
+from models import (
+    Product, Material, Customer, Supplier, Recipe, BoM, ProductionOrder, ProductionOrderComponent,
+    SalesOrder, SalesOrderItem, SalesOrderItemBatch, MaterialBatch, ProductBatch, PurchaseOrder, PurchaseOrderItem, Site, QC_RELEASED
+)
+import search
+
+SCALES = {
+    'small': dict(materials=200, suppliers=20, customers=50, bom_levels=3, products_per_level=40, components_per_bom=5,
+                  purchase_orders=500, items_per_purchase=4, production_orders=500, sales_orders=500, days=365),
+    'medium': dict(materials=2000, suppliers=100, customers=500, bom_levels=4, products_per_level=250, components_per_bom=8,
+                   purchase_orders=10000, items_per_purchase=6, production_orders=10000, sales_orders=10000, days=730),
+    'large': dict(materials=10000, suppliers=300, customers=3000, bom_levels=5, products_per_level=1000, components_per_bom=10,
+                  purchase_orders=100000, items_per_purchase=8, production_orders=100000, sales_orders=100000, days=1095),
+}
+
+INSERT_CHUNK = 5000
+
+def bulk_insert(session, model, rows):
+    for start in range(0, len(rows), INSERT_CHUNK):
+        session.execute(insert(model), rows[start:start + INSERT_CHUNK])
+
+def generate(session, scale='small', seed=42, sites=1, **overrides):
+    # Orders and batches are spread round-robin over the sites; production and sales use their own site's batches
+    sizes = dict(SCALES[scale], **overrides)
+    rng = random.Random(seed)
+    start_date = date.today() - timedelta(days=sizes['days'])
+
+    def random_date():
+        return start_date + timedelta(days=rng.randrange(sizes['days']))
+
+    def site_of(row_id):
+        return (row_id - 1) % sites + 1
+
+    suppliers = [dict(id=i, name=f"Leverandør {i}", address=f"Vej {i}", contact_email=f"lev{i}@example.com",
+                      phone_number=f"{10000000 + i}", vat_number=f"DK{20000000 + i}", organic_number=f"ØKO-{i}")
+                 for i in range(1, sizes['suppliers'] + 1)]
+    customers = [dict(id=i, name=f"Kunde {i}", address=f"Gade {i}", contact_email=f"kunde{i}@example.com",
+                      phone_number=f"{30000000 + i}", vat_number=f"DK{40000000 + i}")
+                 for i in range(1, sizes['customers'] + 1)]
+    materials = [dict(id=i, name=f"Materiale {i}", producer_name=f"Producent {i % 50}",
+                      unit=rng.choice(["kg", "l", "stk"]), quantity=0.0)
+                 for i in range(1, sizes['materials'] + 1)]
+    material_units = {m['id']: m['unit'] for m in materials}
+
+    # Multi-level BoMs: level 0 products use materials only, higher levels also use products from lower levels
+    products, recipes, boms = [], [], []
+    product_units = {}
+    levels = []
+    bom_id = 1
+    for level in range(sizes['bom_levels']):
+        level_ids = []
+        lower = [p for lvl in levels for p in lvl]
+        for _ in range(sizes['products_per_level']):
+            product_id = len(products) + 1
+            unit = rng.choice(["kg", "stk"])
+            products.append(dict(id=product_id, name=f"Produkt {product_id} (niveau {level})", quantity=0.0, unit=unit))
+            product_units[product_id] = unit
+            recipes.append(dict(id=product_id, product_id=product_id, method=f"Fremgangsmåde for produkt {product_id}",
+                                output_quantity=float(rng.randint(1, 20))))
+            for _ in range(sizes['components_per_bom']):
+                if lower and rng.random() < 0.3:
+                    component_product_id = rng.choice(lower)
+                    boms.append(dict(id=bom_id, recipe_id=product_id, component_material_id=None,
+                                     component_product_id=component_product_id,
+                                     quantity_required=round(rng.uniform(0.1, 5), 2), unit=product_units[component_product_id]))
+                else:
+                    material_id = rng.randint(1, sizes['materials'])
+                    boms.append(dict(id=bom_id, recipe_id=product_id, component_material_id=material_id,
+                                     component_product_id=None,
+                                     quantity_required=round(rng.uniform(0.1, 5), 2), unit=material_units[material_id]))
+                bom_id += 1
+            level_ids.append(product_id)
+        levels.append(level_ids)
+
+    purchase_orders, purchase_items, material_batches = [], [], []
+    for po_id in range(1, sizes['purchase_orders'] + 1):
+        po_date = random_date()
+        purchase_orders.append(dict(id=po_id, supplier_id=rng.randint(1, sizes['suppliers']), date=po_date, checked=True,
+                                    site_id=site_of(po_id)))
+        for _ in range(sizes['items_per_purchase']):
+            material_id = rng.randint(1, sizes['materials'])
+            quantity = round(rng.uniform(10, 500), 1)
+            batch_id = f"MB-{len(material_batches) + 1}"
+            purchase_items.append(dict(purchase_order_id=po_id, material_id=material_id, batch_id=batch_id,
+                                       quantity=quantity, unit=material_units[material_id], quantity_received=quantity))
+            material_batches.append(dict(id=len(material_batches) + 1, material_id=material_id, batch_id=batch_id,
+                                         quantity=quantity, unit=material_units[material_id], date=po_date, checked=True,
+                                         qc_status=QC_RELEASED, site_id=site_of(po_id)))
+
+    production_orders, production_components, product_batches = [], [], []
+    batches_by_material = {}
+    for batch in material_batches:
+        batches_by_material.setdefault((batch['site_id'], batch['material_id']), []).append(batch)
+    for order_id in range(1, sizes['production_orders'] + 1):
+        product = rng.choice(products)
+        quantity = float(rng.randint(1, 50))
+        order_date = random_date()
+        batch_id = f"PB-{order_id}"
+        production_orders.append(dict(id=order_id, product_id=product['id'], quantity=quantity, status='Afsluttet',
+                                      batch_id=batch_id, date=order_date, site_id=site_of(order_id)))
+        product_batches.append(dict(id=order_id, product_id=product['id'], batch_id=batch_id,
+                                    quantity=quantity, unit=product['unit'], date=order_date, site_id=site_of(order_id)))
+        for material_id in rng.sample(range(1, sizes['materials'] + 1), k=min(3, sizes['materials'])):
+            candidates = batches_by_material.get((site_of(order_id), material_id))
+            if not candidates:
+                continue
+            batch = rng.choice(candidates)
+            used = min(batch['quantity'], round(rng.uniform(0.5, 5), 2))
+            batch['quantity'] -= used
+            production_components.append(dict(production_order_id=order_id, component_material_id=material_id,
+                                              component_product_id=None, batch_id=batch['id'],
+                                              quantity_used=used, unit=batch['unit']))
+
+    sales_orders, sales_items, sales_item_batches = [], [], []
+    product_batches_by_site = {}
+    for batch in product_batches:
+        product_batches_by_site.setdefault(batch['site_id'], []).append(batch)
+    for so_id in range(1, sizes['sales_orders'] + 1):
+        sales_orders.append(dict(id=so_id, customer_id=rng.randint(1, sizes['customers']), status='Afsluttet', date=random_date(),
+                                 site_id=site_of(so_id)))
+        batch = rng.choice(product_batches_by_site[site_of(so_id)])
+        sold = min(batch['quantity'], float(rng.randint(1, 5)))
+        batch['quantity'] -= sold
+        sales_items.append(dict(id=so_id, sales_order_id=so_id, product_id=batch['product_id'], quantity=sold, unit=batch['unit']))
+        sales_item_batches.append(dict(sales_order_item_id=so_id, batch_id=batch['id'], quantity_used=sold, unit=batch['unit']))
+
+    # Denormalized totals match the batch sums, like a consistent production database would
+    material_totals = {}
+    for batch in material_batches:
+        material_totals[batch['material_id']] = material_totals.get(batch['material_id'], 0.0) + batch['quantity']
+    for material in materials:
+        material['quantity'] = material_totals.get(material['id'], 0.0)
+    product_totals = {}
+    for batch in product_batches:
+        product_totals[batch['product_id']] = product_totals.get(batch['product_id'], 0.0) + batch['quantity']
+    for product in products:
+        product['quantity'] = product_totals.get(product['id'], 0.0)
+
+    bulk_insert(session, Site, [dict(id=i, name=f"Site {i}") for i in range(1, sites + 1)])
+    bulk_insert(session, Supplier, suppliers)
+    bulk_insert(session, Customer, customers)
+    bulk_insert(session, Material, materials)
+    bulk_insert(session, Product, products)
+    bulk_insert(session, Recipe, recipes)
+    bulk_insert(session, BoM, boms)
+    bulk_insert(session, PurchaseOrder, purchase_orders)
+    bulk_insert(session, PurchaseOrderItem, purchase_items)
+    bulk_insert(session, MaterialBatch, material_batches)
+    bulk_insert(session, ProductionOrder, production_orders)
+    bulk_insert(session, ProductionOrderComponent, production_components)
+    bulk_insert(session, ProductBatch, product_batches)
+    bulk_insert(session, SalesOrder, sales_orders)
+    bulk_insert(session, SalesOrderItem, sales_items)
+    bulk_insert(session, SalesOrderItemBatch, sales_item_batches)
+    # Bulk inserts do not go through the flush that maintains the search index
+    search.rebuild(session.connection())
+    session.commit()
+
+    counts = {
+        'materials': len(materials), 'products': len(products), 'boms': len(boms),
+        'material_batches': len(material_batches), 'product_batches': len(product_batches),
+        'purchase_orders': len(purchase_orders), 'production_orders': len(production_orders),
+        'production_order_components': len(production_components), 'sales_orders': len(sales_orders),
+    }
+    return counts
@@ -0,0 +1,460 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+import streamlit as st
+import streamlit_option_menu
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from streamlit import config
+from streamlit.runtime import Runtime
+from streamlit.runtime.secrets import Secrets
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+from models import Base, BoM, MaterialBatch, ProductBatch, Recipe, SalesOrder, QC_RELEASED
+from db import create_erp_engine
+from units import convert_units
+import availability
+import migrations
+import services
+import snapshots
+from benchmarks.datagen import SCALES, generate
+from benchmarks.runner import percentile
+
+# Load test for app.py: simulated operators click through the pages with Streamlit's AppTest, each on
+# its own thread like the script threads of a Streamlit server, so one process shows what one server
+# process can take. Every interaction is one rerun of the script and is timed as one step. Afterwards
+# the database is checked for writes the app confirmed that are missing, stock totals that no longer
+# match their batches and batches that went below zero.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+PAGE_KEY = '_loadtest_page'
+RUN_TIMEOUT = 300
+DEFAULT_MIX = 'buy=2,produce=1,sell=2,browse=5'
+BROWSE_OPTIONS = ["Materialer", "Produktionsordrer", "Salgsordrer", "Indkøbsordrer", "Materiale Batches", "Produkt Batches",
+                  "Lagerafstemning"]
+
+def _menu(menu_title, options, **kwargs):
+    # AppTest cannot click the option menu component; operators choose their page through session state
+    return st.session_state.get(PAGE_KEY) or options[kwargs.get('default_index', 0)]
+
+def _share_app_test_globals(url):
+    # AppTest runs one test at a time: each run installs a runtime, the secrets and the appTest option
+    # globally and removes them when it finishes, under the feet of the other operators' runs. Here every
+    # run sees the same secrets, the option stays on and the last runtime a run installed stays available.
+    # Runs also share one script cache, as sessions of a server do, instead of compiling app.py every time.
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+    secrets = Secrets()
+    secrets._secrets = {'DATABASE_URL': url}
+    st.secrets = secrets
+    config.set_option("global.appTest", True)
+    last = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            last[:] = [cls._instance]
+        if not last:
+            raise RuntimeError("Runtime hasn't been created!")
+        return last[0]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(last))
+
+def _find(widgets, key):
+    try:
+        return widgets(key=key)
+    except KeyError:
+        return None
+
+def _button(at, label):
+    return next(b for b in at.button if b.label == label)
+
+class ScenarioSkipped(Exception):
+    pass
+
+def load_catalog(engine):
+    # What the operators know without looking: product id -> (recipe output, {bom id: (quantity, unit, material id, product id)})
+    with Session(engine) as session:
+        components = defaultdict(dict)
+        for bom in session.query(BoM):
+            components[bom.recipe_id][bom.id] = (bom.quantity_required, bom.unit, bom.component_material_id, bom.component_product_id)
+        return {recipe.product_id: (recipe.output_quantity, components[recipe.id])
+                for recipe in session.query(Recipe) if components[recipe.id] and recipe.output_quantity}
+
+class Operator:
+    def __init__(self, name, catalog, seed, think_time):
+        self.name = name
+        self.catalog = catalog
+        self.rng = random.Random(f"{seed}-{name}")
+        self.think_time = think_time
+        self.batch_count = 0
+        self.steps = []
+        self.scenarios = []
+        self.written = []
+        self.at = AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT)
+        self.at.session_state['audit_user'] = name
+
+    def step(self, scenario, step):
+        started = time.perf_counter()
+        self.at.run()
+        self.steps.append((scenario, step, (time.perf_counter() - started) * 1000))
+        return self.at
+
+    def open(self, scenario, page):
+        self.at.session_state[PAGE_KEY] = page
+        return self.step(scenario, 'open')
+
+    def next_batch_id(self, prefix):
+        self.batch_count += 1
+        return f"LT{prefix}-{self.name}-{self.batch_count}"
+
+    def buy(self):
+        self.at.session_state['purchase_order_items'] = []
+        at = self.open('buy', "Køb noget")
+        suppliers = at.selectbox(key='buy_supplier')
+        suppliers.select_index(self.rng.randrange(len(suppliers.options)))
+        batch_ids = []
+        for _ in range(self.rng.randint(1, 3)):
+            index = self.rng.randrange(len(at.session_state['materials']))
+            material = at.session_state['materials'][index]
+            batch_id = self.next_batch_id('K')
+            at.selectbox(key='buy_material').select_index(index)
+            at.selectbox(key='buy_unit').set_value(material.unit)
+            at.text_input(key='buy_batch_id').input(batch_id)
+            at.number_input(key='buy_quantity').set_value(round(self.rng.uniform(5, 200), 1))
+            _button(at, "Tilføj til indkøbsordre").click()
+            at = self.step('buy', 'add_item')
+            batch_ids.append(batch_id)
+        _button(at, "Afgiv indkøbsordre").click()
+        self.step('buy', 'place_order')
+        return [('material_batch', batch_id) for batch_id in batch_ids]
+
+    def produce(self):
+        at = self.open('produce', "Producer noget")
+        # Only products whose components are all on the shelf and released; the rest would be rejected before anything is written
+        stocked = ({('material', b.material_id) for b in at.session_state['material_batches'] if b.qc_status == QC_RELEASED} |
+                   {('product', b.product_id) for b in at.session_state['product_batches']})
+        products = [p for p in at.session_state['products'] if p.id in self.catalog and all(
+            ('material', material_id) in stocked if material_id else ('product', product_id) in stocked
+            for _, _, material_id, product_id in self.catalog[p.id][1].values())]
+        if not products:
+            raise ScenarioSkipped()
+        product = self.rng.choice(products)
+        output_quantity, components = self.catalog[product.id]
+        quantity = round(output_quantity * self.rng.uniform(0.05, 0.2), 2)
+        batch_id = self.next_batch_id('P')
+        at.selectbox(key='produce_product').set_value((product.id, product.name, product.quantity, product.unit))
+        at.number_input(key='produce_quantity').set_value(quantity)
+        at.text_input(key='produce_batch_id').input(batch_id)
+        at = self.step('produce', 'choose_product')
+        # The fullest batch of each component, as an operator takes what is on the shelf
+        for bom_id, (_, unit, material_id, product_id) in components.items():
+            select = _find(at.selectbox, f"select_batch_{bom_id}")
+            if select is None:
+                continue
+            if material_id:
+                batches = [b for b in at.session_state['material_batches'] if b.material_id == material_id and b.qc_status == QC_RELEASED]
+            else:
+                batches = [b for b in at.session_state['product_batches'] if b.product_id == product_id]
+            best = max(batches, key=lambda b: convert_units(b.quantity, b.unit, unit))
+            label = next(o for o in select.options if o.startswith(f"Batch {best.batch_id} - "))
+            select.set_value((best.id, label))
+        at = self.step('produce', 'choose_batches')
+        for bom_id, (quantity_required, _, _, _) in components.items():
+            allocation = _find(at.number_input, f"allocate_quantity_{bom_id}")
+            if allocation is not None:
+                # The page's own arithmetic, so the allocation is not a rounding error short of the requirement
+                allocation.set_value(min(quantity_required * (quantity / output_quantity), allocation.max))
+        at.button(key='create_production').click()
+        self.step('produce', 'create')
+        return [('product_batch', batch_id)]
+
+    def sell(self):
+        self.at.session_state['sales_allocation_open'] = False
+        at = self.open('sell', "Sælg noget")
+        in_stock = [p for p in at.session_state['products'] if p.quantity >= 1]
+        if not in_stock:
+            raise ScenarioSkipped()
+        chosen = self.rng.sample(in_stock, min(len(in_stock), self.rng.randint(1, 2)))
+        at.multiselect[0].set_value([(p.id, p.name, p.quantity, p.unit) for p in chosen])
+        at = self.step('sell', 'choose_products')
+        quantities = {p.id: round(self.rng.uniform(0.1, min(p.quantity, 5.0)), 1) for p in chosen}
+        for p in chosen:
+            at.selectbox(key=f"sale_unit_{p.id}").set_value(p.unit)
+            at.number_input(key=f"sale_qty_{p.id}").set_value(quantities[p.id])
+        _button(at, "Vælg batches").click()
+        at = self.step('sell', 'choose_quantities')
+        customers = at.selectbox(key='sales_customer')
+        customers.select_index(self.rng.randrange(len(customers.options)))
+        for product_id, remaining in quantities.items():
+            for allocation in at.number_input:
+                if allocation.key and allocation.key.startswith(f"allocate_{product_id}_") and remaining > 0:
+                    take = min(remaining, allocation.max)
+                    allocation.set_value(take)
+                    remaining = round(remaining - take, 9)
+        at.button(key='create_sales_order').click()
+        self.step('sell', 'create')
+        return [('sales_order', 1)]
+
+    def browse(self):
+        if self.rng.random() < 0.3:
+            word = self.rng.choice(self.at.session_state['products']).name.split()[0][:4]
+            self.at.text_input(key='global_search').input(word)
+            self.step('browse', 'search')
+            self.at.text_input(key='global_search').input("")
+        at = self.open('browse', "Administrationsside")
+        next(s for s in at.selectbox if s.label == "Vælg, hvad du vil administrere").set_value(self.rng.choice(BROWSE_OPTIONS))
+        self.step('browse', 'list')
+        return None
+
+    def run_scenario(self, name):
+        started = time.perf_counter()
+        message = None
+        try:
+            written = getattr(self, name)()
+            if self.at.exception:
+                outcome, message = 'exception', self.at.exception[0].value
+            elif self.at.success:
+                outcome = 'ok'
+                self.written.extend(written or [])
+            elif self.at.error:
+                outcome, message = 'rejected', self.at.error[0].value
+            elif written is None:
+                outcome = 'ok'
+            else:
+                outcome, message = 'no_result', "no confirmation or error shown"
+        except ScenarioSkipped:
+            outcome = 'skipped'
+        except Exception as e:
+            # The page did not show what the operator expected (a widget missing after an error, a timeout)
+            outcome, message = 'failed', f"{type(e).__name__}: {e}"
+            if self.at.exception:
+                outcome, message = 'exception', self.at.exception[0].value
+        self.scenarios.append((name, outcome, (time.perf_counter() - started) * 1000, message))
+
+    def session_state_bytes(self):
+        # What the session keeps between reruns besides the lists it shares with the other sessions
+        return sum(snapshots.own_bytes(self.at.session_state._state.filtered_state).values())
+
+    def work(self, mix, deadline, start):
+        start.wait()
+        self.step('login', 'open')
+        names, weights = zip(*mix.items())
+        while time.monotonic() < deadline:
+            self.run_scenario(self.rng.choices(names, weights)[0])
+            if self.think_time:
+                time.sleep(self.rng.expovariate(1 / self.think_time))
+
+def _rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak resident size; kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_users(url, names, catalog, mix, duration, think_time, seed, barrier=None):
+    # One process: a warm-up run fills the shared caches, then every operator starts at once
+    streamlit_option_menu.option_menu = _menu
+    _share_app_test_globals(url)
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    snapshots.clear()
+    availability.clear()
+    AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT).run()
+    operators = [Operator(name, catalog, seed, think_time) for name in names]
+    rss_before = _rss_mb()
+    if barrier is not None:
+        barrier.wait()
+    start = threading.Event()
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=operator.work, args=(mix, deadline, start), daemon=True) for operator in operators]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    rss_after = _rss_mb()
+    memory = snapshots.usage()
+    return {
+        'steps': [s for o in operators for s in o.steps],
+        'scenarios': [s for o in operators for s in o.scenarios],
+        'written': [w for o in operators for w in o.written],
+        'session_state_bytes': [o.session_state_bytes() for o in operators],
+        'shared_bytes': memory['snapshot_bytes'] + memory['stale_snapshot_bytes'],
+        'rss_mb': rss_after,
+        'rss_growth_mb': rss_after - rss_before if rss_before is not None else None,
+    }
+
+def _process_main(queue, *args):
+    queue.put(run_users(*args))
+
+def check_consistency(engine, written, sales_orders_before):
+    confirmed = defaultdict(set)
+    for table, value in written:
+        confirmed[table].add(value)
+    with Session(engine) as session:
+        material_batches = {b for (b,) in session.query(MaterialBatch.batch_id).filter(MaterialBatch.batch_id.like('LTK-%'))}
+        product_batches = {b for (b,) in session.query(ProductBatch.batch_id).filter(ProductBatch.batch_id.like('LTP-%'))}
+        new_sales_orders = session.query(func.count(SalesOrder.id)).scalar() - sales_orders_before
+        return {
+            'confirmed_writes': sum(len(v) for k, v in confirmed.items() if k != 'sales_order') +
+                                sum(1 for table, _ in written if table == 'sales_order'),
+            'missing_purchases': len(confirmed['material_batch'] - material_batches),
+            'missing_production': len(confirmed['product_batch'] - product_batches),
+            'missing_sales_orders': max(0, sum(1 for table, _ in written if table == 'sales_order') - new_sales_orders),
+            'stock_totals_off': len(services.stock_discrepancies(session, 'material')) +
+                                len(services.stock_discrepancies(session, 'product')),
+            'negative_batches': session.query(MaterialBatch).filter(MaterialBatch.quantity < -1e-9).count() +
+                                session.query(ProductBatch).filter(ProductBatch.quantity < -1e-9).count(),
+        }
+
+def _latency(values):
+    values = sorted(values)
+    return {'count': len(values), 'p50_ms': percentile(values, 50), 'p95_ms': percentile(values, 95),
+            'p99_ms': percentile(values, 99), 'max_ms': values[-1] if values else 0.0}
+
+def summarize(users, processes, duration, results, consistency):
+    steps = [s for r in results for s in r['steps']]
+    scenarios = [s for r in results for s in r['scenarios']]
+    by_scenario = defaultdict(list)
+    for name, outcome, ms, _ in scenarios:
+        by_scenario[name].append((outcome, ms))
+    by_step = defaultdict(list)
+    for scenario, step, ms in steps:
+        by_step[f"{scenario}/{step}"].append(ms)
+    state_bytes = [b for r in results for b in r['session_state_bytes']]
+    growth = [r['rss_growth_mb'] for r in results if r['rss_growth_mb'] is not None]
+    lost = sum(v for k, v in consistency.items() if k != 'confirmed_writes')
+    return {
+        'users': users,
+        'processes': processes,
+        'duration_s': duration,
+        'scenarios_per_s': len(scenarios) / duration,
+        'steps_per_s': len(steps) / duration,
+        'step_latency': _latency([ms for scenario, _, ms in steps if scenario != 'login']),
+        'scenarios': {name: dict(_latency([ms for _, ms in rows]), **Counter(outcome for outcome, _ in rows))
+                      for name, rows in sorted(by_scenario.items())},
+        'steps': {name: _latency(values) for name, values in sorted(by_step.items())},
+        'session_state_mb': sum(state_bytes) / len(state_bytes) / 2 ** 20 if state_bytes else 0.0,
+        'shared_mb': max(r['shared_bytes'] for r in results) / 2 ** 20,
+        'rss_mb': max((r['rss_mb'] or 0) for r in results),
+        'rss_growth_per_user_mb': sum(growth) / users if growth else None,
+        'errors': Counter(message for _, outcome, _, message in scenarios if message).most_common(5),
+        'consistency': consistency,
+        'lost_updates': lost,
+    }
+
+def run_load_test(url, users_levels, scale='small', duration=60, think_time=1.0, seed=42, mix=None, processes=1, reuse=False):
+    mix = mix or parse_mix(DEFAULT_MIX)
+    engine = create_erp_engine(url)
+    levels = []
+    for users in users_levels:
+        if not reuse:
+            Base.metadata.drop_all(engine)
+            Base.metadata.create_all(engine)
+            with Session(engine) as session:
+                generate(session, scale, seed)
+        # Migrated before the app processes start, as in a deployment, so they do not race to do it
+        with engine.connect() as conn:
+            migrations.upgrade(conn)
+        catalog = load_catalog(engine)
+        with Session(engine) as session:
+            sales_orders_before = session.query(func.count(SalesOrder.id)).scalar()
+        # Operator names carry the level, so batch ids stay unique when the data is reused
+        names = [f"u{users}-{i}" for i in range(users)]
+        if processes == 1:
+            results = [run_users(url, names, catalog, mix, duration, think_time, seed)]
+        else:
+            context = multiprocessing.get_context('spawn')
+            queue = context.Queue()
+            barrier = context.Barrier(processes)
+            workers = [context.Process(target=_process_main,
+                                       args=(queue, url, names[p::processes], catalog, mix, duration, think_time, seed, barrier))
+                       for p in range(processes)]
+            for worker in workers:
+                worker.start()
+            results = [queue.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+        written = [w for r in results for w in r['written']]
+        levels.append(summarize(users, processes, duration, results, check_consistency(engine, written, sales_orders_before)))
+    engine.dispose()
+    return {'scale': scale, 'think_time_s': think_time, 'mix': mix, 'levels': levels}
+
+def format_report(report):
+    lines = [f"Scale: {report['scale']}, think time {report['think_time_s']} s, mix "
+             + ",".join(f"{k}={v}" for k, v in report['mix'].items())]
+    for level in report['levels']:
+        lines.append("")
+        lines.append(f"{level['users']} operators in {level['processes']} process(es), {level['duration_s']} s: "
+                     f"{level['scenarios_per_s']:.2f} scenarios/s, {level['steps_per_s']:.2f} interactions/s")
+        lines.append(f"{'scenario':<26}{'count':>7}{'ok':>6}{'rejected':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, r in level['scenarios'].items():
+            errors = r.get('exception', 0) + r.get('failed', 0) + r.get('no_result', 0)
+            lines.append(f"{name:<26}{r['count']:>7}{r.get('ok', 0):>6}{r.get('rejected', 0):>10}{errors:>8}"
+                         f"{r['p50_ms']:>10.0f}{r['p95_ms']:>10.0f}{r['p99_ms']:>10.0f}{r['max_ms']:>10.0f}")
+        lines.append(f"{'interaction':<26}{'count':>7}{'':>24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, r in level['steps'].items():
+            lines.append(f"{name:<26}{r['count']:>7}{'':>24}{r['p50_ms']:>10.0f}{r['p95_ms']:>10.0f}{r['p99_ms']:>10.0f}{r['max_ms']:>10.0f}")
+        growth = level['rss_growth_per_user_mb']
+        lines.append(f"Memory: {level['session_state_mb']:.1f} MB session state per operator, {level['shared_mb']:.1f} MB shared lists per process, peak RSS {level['rss_mb']:.0f} MB"
+                     + (f" ({growth:.1f} MB per operator)" if growth is not None else ""))
+        c = level['consistency']
+        lines.append(f"Consistency: {c['confirmed_writes']} confirmed writes, {c['missing_purchases']} purchases, "
+                     f"{c['missing_production']} productions and {c['missing_sales_orders']} sales orders missing, "
+                     f"{c['stock_totals_off']} stock totals off, {c['negative_batches']} negative batches")
+        for message, count in level['errors']:
+            lines.append(f"  {count:>4} x {message[:150]}")
+    if len(report['levels']) > 1:
+        lines.append("")
+        lines.append(f"{'operators':>9}{'scen/s':>9}{'steps/s':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}{'lost':>6}{'MB/op':>7}")
+        for level in report['levels']:
+            errors = sum(r.get('exception', 0) + r.get('failed', 0) + r.get('no_result', 0) + r.get('rejected', 0)
+                         for r in level['scenarios'].values())
+            lines.append(f"{level['users']:>9}{level['scenarios_per_s']:>9.2f}{level['steps_per_s']:>9.2f}"
+                         f"{level['step_latency']['p95_ms']:>9.0f}{level['step_latency']['p99_ms']:>9.0f}"
+                         f"{errors:>8}{level['lost_updates']:>6}{level['session_state_mb']:>7.1f}")
+    return "\n".join(lines)
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ('buy', 'produce', 'sell', 'browse'):
+            raise argparse.ArgumentTypeError(f"unknown scenario: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test app.py with simulated operators against a local database.")
+    parser.add_argument("--url", help="Database URL (default: a temporary SQLite file). Never point this at production.")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 4, 8], help="Concurrent operators; one run per number")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds per run")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Mean pause between scenarios in seconds (0: back to back)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"Scenario weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--processes", type=int, default=1, help="Spread the operators over this many app processes")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reuse", action="store_true", help="Run against existing data instead of regenerating it")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "loadtest.db")
+    report = run_load_test(url, args.users, args.scale, args.duration, args.think_time, args.seed, args.mix,
+                           args.processes, args.reuse)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
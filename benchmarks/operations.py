@@ -0,0 +1,110 @@
+from datetime import date
+from sqlalchemy import func
+from models import (
+    Product, Material, Customer, Supplier, Recipe, BoM, ProductionOrder, SalesOrder,
+    MaterialBatch, ProductBatch, PurchaseOrder, QC_RELEASED
+)
+from units import convert_units
+import availability
+import search
+import services
+
+# Each operation picks its inputs the way an operator would and then runs the same
+# service call as the matching page in app.py.
+
+def load_page_data(session, rng):
+    session.expire_all()
+    for model in (Material, Product, Customer, Supplier, BoM, ProductionOrder, SalesOrder,
+                  PurchaseOrder, MaterialBatch, ProductBatch):
+        session.query(model).all()
+
+def commit_purchase_order(session, rng, items_per_order=5):
+    supplier_count = session.query(func.count(Supplier.id)).scalar()
+    material_count = session.query(func.count(Material.id)).scalar()
+    materials = session.query(Material).filter(
+        Material.id.in_([rng.randint(1, material_count) for _ in range(items_per_order)])).all()
+    items = [
+        {'material_id': m.id, 'batch_id': f"BENCH-{m.id}-{rng.random():.8f}",
+         'quantity': round(rng.uniform(10, 500), 1), 'unit': m.unit}
+        for m in materials
+    ]
+    with services.transaction(session):
+        services.create_purchase_order(session, rng.randint(1, supplier_count), items, date.today(), checked=True)
+
+def create_production_order(session, rng):
+    recipe_count = session.query(func.count(Recipe.id)).scalar()
+    recipe = session.query(Recipe).filter_by(id=rng.randint(1, recipe_count)).first()
+    _, requirements = services.required_components(session, recipe.product_id, recipe.output_quantity)
+    allocations = []
+    for bom, required_total in requirements:
+        # Allocate from the largest batches first; skip the order if stock is short so runs stay comparable
+        if bom.component_material_id:
+            batches = (session.query(MaterialBatch).filter(MaterialBatch.material_id == bom.component_material_id,
+                                                           MaterialBatch.quantity > 0, MaterialBatch.qc_status == QC_RELEASED)
+                       .order_by(MaterialBatch.quantity.desc()).all())
+        else:
+            batches = (session.query(ProductBatch).filter(ProductBatch.product_id == bom.component_product_id,
+                                                          ProductBatch.quantity > 0)
+                       .order_by(ProductBatch.quantity.desc()).all())
+        remaining = required_total
+        for batch in batches:
+            take = min(convert_units(batch.quantity, batch.unit, bom.unit), remaining)
+            allocations.append({'bom_id': bom.id, 'batch_id': batch.id, 'quantity': take})
+            remaining -= take
+            if remaining <= 1e-9:
+                break
+        if remaining > 1e-9:
+            return
+    with services.transaction(session):
+        services.produce(session, recipe.product_id, recipe.output_quantity, f"BENCH-{rng.random():.8f}",
+                         date.today(), allocations)
+
+def allocate_sale(session, rng, lines=3):
+    customer_count = session.query(func.count(Customer.id)).scalar()
+    product_count = session.query(func.count(Product.id)).scalar()
+    sale_lines = []
+    for product_id in {rng.randint(1, product_count) for _ in range(lines)}:
+        product = session.get(Product, product_id)
+        batches = session.query(ProductBatch).filter(ProductBatch.product_id == product_id, ProductBatch.quantity > 0).all()
+        remaining = 1.0
+        allocations = []
+        for batch in batches:
+            take = min(convert_units(batch.quantity, batch.unit, product.unit), remaining)
+            allocations.append({'batch_id': batch.id, 'quantity': take})
+            remaining -= take
+            if remaining <= 1e-9:
+                break
+        if remaining <= 1e-9:
+            sale_lines.append({'product_id': product_id, 'quantity': 1.0, 'unit': product.unit, 'allocations': allocations})
+    if not sale_lines:
+        return
+    with services.transaction(session):
+        services.sell(session, rng.randint(1, customer_count), date.today(), sale_lines)
+
+def delete_production_order(session, rng):
+    order_id = session.query(func.max(ProductionOrder.id)).scalar()
+    if order_id is None:
+        return
+    with services.transaction(session):
+        services.delete_production_order(session, order_id)
+
+def search_catalog(session, rng):
+    # What someone types in the search box: a word and the start of a number
+    word = rng.choice(["materiale", "produkt", "kunde", "leverandør", "vej", "gade"])
+    search.search(session, f"{word} {rng.randint(1, 99)}")
+
+def compute_availability(session, rng):
+    # The whole catalog from scratch, as after a BoM change; when batches change only the affected products are evaluated
+    feasibility = availability.build(session)
+    feasibility.update(availability.load_stock(session, feasibility))
+    feasibility.frame()
+
+OPERATIONS = {
+    'page_load': load_page_data,
+    'purchase_commit': commit_purchase_order,
+    'production_create': create_production_order,
+    'sales_allocation': allocate_sale,
+    'production_delete': delete_production_order,
+    'search': search_catalog,
+    'availability': compute_availability,
+}
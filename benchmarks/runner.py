@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from sqlalchemy.orm import sessionmaker
+from models import Base
+from db import create_erp_engine
+import instrumentation
+import sites
+from benchmarks.datagen import SCALES, generate
+from benchmarks.operations import OPERATIONS
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def run_operation(session, name, operation, iterations, rng, warmup=3):
+    for _ in range(warmup):
+        operation(session, rng)
+    latencies = []
+    queries = []
+    rows = []
+    for _ in range(iterations):
+        with instrumentation.record(f"benchmark:{name}") as stats:
+            started = time.perf_counter()
+            operation(session, rng)
+            latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(stats.queries)
+        rows.append(stats.rows)
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else 0.0,
+        'queries_per_op': sum(queries) / len(queries) if queries else 0.0,
+        'rows_per_op': sum(rows) / len(rows) if rows else 0.0,
+    }
+
+def run_benchmarks(url, scale='small', iterations=50, seed=42, operations=None, reuse=False, site_count=1):
+    engine = create_erp_engine(url)
+    instrumentation.install(engine, Base)
+    DBSession = sessionmaker(bind=engine)
+    session = DBSession()
+    sizes = None
+    if not reuse:
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        sizes = generate(session, scale, seed, sites=site_count)
+    # Operations run as a user of the first site, so with --sites their cost shows what one site pays
+    sites.scope(session, 1)
+    results = {}
+    for name in operations or OPERATIONS:
+        # Every operation gets its own seeded generator so results are repeatable in isolation
+        results[name] = run_operation(session, name, OPERATIONS[name], iterations, random.Random(seed))
+    session.close()
+    engine.dispose()
+    return {'scale': scale, 'sizes': sizes, 'results': results}
+
+def format_report(report):
+    lines = [f"Scale: {report['scale']}"]
+    if report['sizes']:
+        lines.append("Data: " + ", ".join(f"{k}={v}" for k, v in report['sizes'].items()))
+    lines.append(f"{'operation':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'queries':>10}{'rows':>10}")
+    for name, r in report['results'].items():
+        lines.append(f"{name:<20}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['max_ms']:>10.2f}{r['queries_per_op']:>10.1f}{r['rows_per_op']:>10.1f}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the core ERP operations against a local database.")
+    parser.add_argument("--url", help="Database URL (default: a temporary SQLite file). Never point this at production.")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--operation", action="append", choices=sorted(OPERATIONS), help="Only run these operations")
+    parser.add_argument("--reuse", action="store_true", help="Run against existing data instead of regenerating it")
+    parser.add_argument("--sites", type=int, default=1, help="Spread the generated orders and batches over this many sites")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    report = run_benchmarks(url, args.scale, args.iterations, args.seed, args.operation, args.reuse, args.sites)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import time
+import pandas as pd
+from sqlalchemy import update, bindparam
+from models import (
+    Material, Product, Recipe, BoM, ProductionOrder, ProductionOrderComponent, MaterialBatch, ProductBatch,
+    PurchaseOrder, PurchaseOrderItem
+)
+from units import convert_units
+import services
+import sites
+
+# Costing.
+# Standard cost: the latest purchase price per material unit, rolled up the BoM graph to a cost per
+# product unit. Actual cost: what the consumed batches cost, rolled from material batches through
+# production_order_component into each product batch, and on through intermediate products.
+# Both load the tables in a few queries, compute in memory with memoization and write back with
+# one executemany UPDATE, so a full recompute after a price change stays fast on large catalogs.
+
+def material_standard_costs(session):
+    # Latest priced order line per material (drafts are only proposals) at any site, converted to the material unit
+    with sites.unscoped(session):
+        rows = (session.query(PurchaseOrderItem.material_id, PurchaseOrderItem.unit, PurchaseOrderItem.unit_cost, Material.unit)
+                .join(PurchaseOrder, PurchaseOrder.id == PurchaseOrderItem.purchase_order_id)
+                .join(Material, Material.id == PurchaseOrderItem.material_id)
+                .filter(PurchaseOrderItem.unit_cost.isnot(None), PurchaseOrder.status != services.DRAFT)
+                .order_by(PurchaseOrder.date, PurchaseOrderItem.id).all())
+    lines = pd.DataFrame(rows, columns=['material_id', 'unit', 'unit_cost', 'material_unit']).drop_duplicates('material_id', keep='last')
+    return {int(row.material_id): row.unit_cost / convert_units(1.0, row.unit, row.material_unit) for row in lines.itertuples()}
+
+def standard_costs(material_costs, recipes, units):
+    # material_costs: material_id -> cost per material unit
+    # recipes: product_id -> (output_quantity, [(kind, item_id, quantity_required, unit)])
+    # units: (kind, item_id) -> unit. Returns product_id -> cost per product unit (None if any input is unknown)
+    costs = {}
+    for product_id in recipes:
+        # Depth-first without recursion, so deep BoMs do not hit the recursion limit
+        stack, visiting = [product_id], set()
+        while stack:
+            current = stack[-1]
+            if current in costs:
+                stack.pop()
+                continue
+            output_quantity, components = recipes.get(current, (None, None))
+            if components is None:
+                costs[current] = None
+                stack.pop()
+                continue
+            pending = [item_id for kind, item_id, _, _ in components
+                       if kind == 'product' and item_id not in costs and item_id not in visiting]
+            if pending and current not in visiting:
+                visiting.add(current)
+                stack.extend(pending)
+                continue
+            visiting.discard(current)
+            total = 0.0
+            for kind, item_id, quantity_required, unit in components:
+                cost = material_costs.get(item_id) if kind == 'material' else costs.get(item_id)
+                if cost is None:
+                    total = None
+                    break
+                total += convert_units(quantity_required, unit, units.get((kind, item_id), unit)) * cost
+            costs[current] = None if total is None or not output_quantity else total / output_quantity
+            stack.pop()
+    return costs
+
+def load_recipes(session):
+    # The first recipe of each product, as used when producing
+    recipes = {}
+    recipe_ids = {}
+    for recipe in session.query(Recipe).order_by(Recipe.id):
+        if recipe.product_id not in recipes:
+            recipes[recipe.product_id] = (recipe.output_quantity, [])
+            recipe_ids[recipe.id] = recipe.product_id
+    for bom in session.query(BoM).order_by(BoM.id):
+        product_id = recipe_ids.get(bom.recipe_id)
+        if product_id is None:
+            continue
+        if bom.component_material_id:
+            recipes[product_id][1].append(('material', bom.component_material_id, bom.quantity_required, bom.unit))
+        else:
+            recipes[product_id][1].append(('product', bom.component_product_id, bom.quantity_required, bom.unit))
+    return recipes
+
+def roll_standard_costs(session):
+    started = time.monotonic()
+    material_costs = material_standard_costs(session)
+    units = {('material', i): u for i, u in session.query(Material.id, Material.unit)}
+    units.update({('product', i): u for i, u in session.query(Product.id, Product.unit)})
+    product_costs = standard_costs(material_costs, load_recipes(session), units)
+
+    for model, costs in ((Material, material_costs), (Product, product_costs)):
+        table = model.__table__
+        rows = [{'c_id': item_id, 'c_cost': cost} for item_id, cost in costs.items()]
+        if rows:
+            session.execute(update(table).where(table.c.id == bindparam('c_id')).values(standard_cost=bindparam('c_cost')), rows)
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, model):
+                session.expire(obj, ['standard_cost'])
+    return {'materials': len(material_costs), 'products': len(product_costs),
+            'unknown': sum(1 for cost in product_costs.values() if cost is None),
+            'seconds': round(time.monotonic() - started, 2)}
+
+def actual_costs(material_batch_costs, product_batches, orders, components):
+    # material_batch_costs: batch id -> (unit, cost per batch unit)
+    # product_batches: batch id -> (product_id, batch_id, unit, stored unit_cost)
+    # orders: (product_id, batch_id) -> (order id, quantity); components: order id -> [(kind, batch id, quantity, unit)]
+    # Returns product batch id -> cost per batch unit (None if any consumed batch has no cost)
+    costs = {}
+    for batch in product_batches:
+        stack = [batch]
+        while stack:
+            current = stack[-1]
+            if current in costs:
+                stack.pop()
+                continue
+            product_id, batch_id, _, stored = product_batches[current]
+            order = orders.get((product_id, batch_id))
+            if order is None:
+                # Not produced here (opening stock); keep whatever cost was entered
+                costs[current] = stored
+                stack.pop()
+                continue
+            order_id, quantity = order
+            pending = [b for kind, b, _, _ in components.get(order_id, [])
+                       if kind == 'product' and b in product_batches and b not in costs and b not in stack]
+            if pending:
+                stack.extend(pending)
+                continue
+            total = 0.0
+            for kind, component_batch, quantity_used, unit in components.get(order_id, []):
+                if kind == 'material':
+                    batch_unit, cost = material_batch_costs.get(component_batch, (unit, None))
+                elif component_batch in product_batches:
+                    batch_unit, cost = product_batches[component_batch][2], costs.get(component_batch)
+                else:
+                    batch_unit, cost = unit, None
+                if cost is None:
+                    total = None
+                    break
+                total += convert_units(quantity_used, unit, batch_unit) * cost
+            costs[current] = None if total is None or not quantity else total / quantity
+            stack.pop()
+    return costs
+
+def roll_actual_costs(session):
+    started = time.monotonic()
+    material_batch_costs = {i: (unit, cost) for i, unit, cost in session.query(MaterialBatch.id, MaterialBatch.unit, MaterialBatch.unit_cost)}
+    product_batches = {i: (product_id, batch_id, unit, cost) for i, product_id, batch_id, unit, cost in
+                       session.query(ProductBatch.id, ProductBatch.product_id, ProductBatch.batch_id, ProductBatch.unit, ProductBatch.unit_cost)}
+    orders = {(product_id, batch_id): (order_id, quantity) for order_id, product_id, batch_id, quantity in
+              session.query(ProductionOrder.id, ProductionOrder.product_id, ProductionOrder.batch_id, ProductionOrder.quantity)
+              .filter(ProductionOrder.batch_id != '')}
+    components = {}
+    for order_id, material_id, batch_id, quantity_used, unit in session.query(
+            ProductionOrderComponent.production_order_id, ProductionOrderComponent.component_material_id,
+            ProductionOrderComponent.batch_id, ProductionOrderComponent.quantity_used, ProductionOrderComponent.unit):
+        components.setdefault(order_id, []).append(('material' if material_id else 'product', batch_id, quantity_used, unit))
+    costs = actual_costs(material_batch_costs, product_batches, orders, components)
+
+    table = ProductBatch.__table__
+    rows = [{'c_id': batch, 'c_cost': cost} for batch, cost in costs.items() if cost != product_batches[batch][3]]
+    if rows:
+        session.execute(update(table).where(table.c.id == bindparam('c_id')).values(unit_cost=bindparam('c_cost')), rows)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, ProductBatch):
+            session.expire(obj, ['unit_cost'])
+    return {'batches': len(costs), 'updated': len(rows), 'unknown': sum(1 for cost in costs.values() if cost is None),
+            'seconds': round(time.monotonic() - started, 2)}
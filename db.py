@@ -0,0 +1,116 @@
+import os
+import ssl
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+cert_path = os.path.join(os.path.dirname(__file__), "certs", "DigiCertGlobalRootCA.crt.pem")
+
+def build_database_url(db_user, db_password, db_host, db_port, db_name):
+    return f'mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
+
+def database_url_from_secrets(secrets):
+    # Works with st.secrets as well as os.environ, so scripts can run without Streamlit
+    if 'DATABASE_URL' in secrets:
+        return secrets['DATABASE_URL']
+    return build_database_url(
+        secrets['DB_USER'],
+        secrets['DB_PASSWORD'],
+        secrets['DB_HOST'],
+        secrets['DB_PORT'],
+        secrets['DB_NAME']
+    )
+
+def create_erp_engine(url, **kwargs):
+    if url.startswith('mysql'):
+        kwargs.setdefault('connect_args', {
+            'ssl': {
+                'ssl_ca': cert_path
+            }
+        })
+    return create_engine(url, **kwargs)
+
+# Read/write split: reporting reads can go to a replica or a local SQLite mirror,
+# everything that writes stays on the primary.
+READ_STICKY_SECONDS = 30
+MIRROR_REFRESH_SECONDS = 300
+
+def read_database_url_from_secrets(secrets):
+    if 'READ_DATABASE_URL' in secrets:
+        return secrets['READ_DATABASE_URL']
+    if 'READ_MIRROR_PATH' in secrets:
+        return f"sqlite:///{secrets['READ_MIRROR_PATH']}"
+    return None
+
+def read_sticky_seconds(secrets):
+    if 'READ_STICKY_SECONDS' in secrets:
+        return float(secrets['READ_STICKY_SECONDS'])
+    if 'READ_DATABASE_URL' not in secrets and 'READ_MIRROR_PATH' in secrets:
+        # A mirror can be a whole refresh interval behind
+        return float(secrets.get('MIRROR_REFRESH_SECONDS', MIRROR_REFRESH_SECONDS)) + READ_STICKY_SECONDS
+    return READ_STICKY_SECONDS
+
+def create_read_engine(url, **kwargs):
+    if url.startswith('sqlite'):
+        # The mirror file is replaced on refresh; pooled connections would keep reading the old one
+        kwargs.setdefault('poolclass', NullPool)
+    return create_erp_engine(url, **kwargs)
+
+class ReadYourWrites:
+    # Pins reads to the primary for a while after the acting user commits a write,
+    # so lists refreshed right after a commit do not come from a lagging replica.
+    def __init__(self, sticky_seconds=READ_STICKY_SECONDS):
+        self.sticky_seconds = sticky_seconds
+        self.primary_until = 0.0
+
+    def pinned(self):
+        return time.monotonic() < self.primary_until
+
+    def track(self, session):
+        event.listen(session, "after_flush", self._after_flush)
+        event.listen(session, "after_commit", self._after_commit)
+        event.listen(session, "after_rollback", self._after_rollback)
+        return session
+
+    def _after_flush(self, session, flush_context):
+        session.info['wrote'] = True
+
+    def _after_commit(self, session):
+        if session.info.pop('wrote', False):
+            self.primary_until = time.monotonic() + self.sticky_seconds
+
+    def _after_rollback(self, session):
+        session.info.pop('wrote', None)
+
+class ReadSession(Session):
+    # Session for read-only pages: queries go to the replica unless reads are pinned to the primary.
+    # Flushes always go to the primary (the bind the session was created with).
+    def __init__(self, replica=None, consistency=None, **kwargs):
+        super().__init__(**kwargs)
+        self.replica = replica
+        self.consistency = consistency
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.replica is None or self._flushing or (self.consistency is not None and self.consistency.pinned()):
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        return self.replica
+
+ASYNC_DRIVERS = {
+    'mysql+pymysql': 'mysql+aiomysql',
+    'mysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+def async_database_url(url):
+    scheme, rest = url.split('://', 1)
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+def create_async_erp_engine(url, **kwargs):
+    from sqlalchemy.ext.asyncio import create_async_engine
+    url = async_database_url(url)
+    if url.startswith('mysql'):
+        kwargs.setdefault('connect_args', {
+            'ssl': ssl.create_default_context(cafile=cert_path)
+        })
+    return create_async_engine(url, **kwargs)
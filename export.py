@@ -0,0 +1,247 @@
+import argparse
+import csv
+import os
+import sys
+from sqlalchemy import select, func, Boolean, Integer, Float, Date, DateTime
+from sqlalchemy.orm import aliased
+from models import (
+    Base, Product, Material, ProductionOrder, ProductionOrderComponent, MaterialBatch, ProductBatch, DisposalRecord
+)
+from db import create_erp_engine, database_url_from_secrets
+
+DEFAULT_CHUNK_SIZE = 10000
+EXPORT_FORMATS = ["csv", "parquet"]
+
+def is_blob_column(column):
+    try:
+        return column.type.python_type is bytes
+    except NotImplementedError:
+        return False
+
+# Exports for one site (site_id) contain that site's rows and the data all sites share. Export queries are Core
+# statements on the engine, so sites.scope does not limit them; the site is filtered here.
+# Line tables have no site_id and belong to the site of their order or receipt
+SITE_PARENTS = {
+    'production_order_component': ('production_order_id', 'production_order'),
+    'sales_order_item': ('sales_order_id', 'sales_order'),
+    'sales_order_item_batch': ('sales_order_item_id', 'sales_order_item'),
+    'purchase_order_item': ('purchase_order_id', 'purchase_order'),
+    'goods_receipt_line': ('goods_receipt_id', 'goods_receipt'),
+}
+SHARED_TABLES = {'material', 'product', 'customer', 'supplier', 'recipe', 'bom', 'site', 'material_replenishment'}
+
+def site_filter(table, site_id):
+    # None for tables shared by all sites
+    if 'site_id' in table.c:
+        return table.c.site_id == site_id
+    if table.name in SITE_PARENTS:
+        key, parent_name = SITE_PARENTS[table.name]
+        parent = Base.metadata.tables[parent_name]
+        return table.c[key].in_(select(parent.c.id).where(site_filter(parent, site_id)))
+    return None
+
+def table_query(table_name, include_blobs=False, site_id=None):
+    table = Base.metadata.tables[table_name]
+    columns = [c for c in table.columns if include_blobs or not is_blob_column(c)]
+    query = select(*columns).order_by(*table.primary_key.columns)
+    if site_id is not None:
+        criterion = site_filter(table, site_id)
+        if criterion is None and table_name not in SHARED_TABLES:
+            # Logs, jobs and attachments mix all sites' data
+            raise ValueError(f"{table_name} covers all sites and cannot be exported for one site")
+        if criterion is not None:
+            query = query.where(criterion)
+    return query
+
+# Joined reports
+def production_components_report():
+    component_product = aliased(Product)
+    return (
+        select(
+            ProductionOrder.id.label('production_order_id'),
+            ProductionOrder.date,
+            ProductionOrder.batch_id.label('production_batch'),
+            Product.name.label('product'),
+            Material.name.label('component_material'),
+            component_product.name.label('component_product'),
+            ProductionOrderComponent.batch_id.label('component_batch_id'),
+            ProductionOrderComponent.quantity_used,
+            ProductionOrderComponent.unit
+        )
+        .select_from(ProductionOrderComponent)
+        .join(ProductionOrder, ProductionOrder.id == ProductionOrderComponent.production_order_id)
+        .join(Product, Product.id == ProductionOrder.product_id)
+        .outerjoin(Material, Material.id == ProductionOrderComponent.component_material_id)
+        .outerjoin(component_product, component_product.id == ProductionOrderComponent.component_product_id)
+        .order_by(ProductionOrderComponent.id)
+    )
+
+def material_batches_report():
+    return (
+        select(
+            MaterialBatch.id,
+            Material.name.label('material'),
+            MaterialBatch.batch_id,
+            MaterialBatch.quantity,
+            MaterialBatch.unit,
+            MaterialBatch.date,
+            MaterialBatch.checked
+        )
+        .join(Material, Material.id == MaterialBatch.material_id)
+        .order_by(MaterialBatch.id)
+    )
+
+def product_batches_report():
+    return (
+        select(
+            ProductBatch.id,
+            Product.name.label('product'),
+            ProductBatch.batch_id,
+            ProductBatch.quantity,
+            ProductBatch.unit,
+            ProductBatch.date
+        )
+        .join(Product, Product.id == ProductBatch.product_id)
+        .order_by(ProductBatch.id)
+    )
+
+def disposals_report():
+    return (
+        select(
+            DisposalRecord.id,
+            DisposalRecord.date,
+            Material.name.label('material'),
+            Product.name.label('product'),
+            DisposalRecord.batch_id,
+            DisposalRecord.quantity,
+            DisposalRecord.unit,
+            DisposalRecord.reason
+        )
+        .outerjoin(Material, Material.id == DisposalRecord.material_id)
+        .outerjoin(Product, Product.id == DisposalRecord.product_id)
+        .order_by(DisposalRecord.id)
+    )
+
+REPORTS = {
+    'report:production_components': production_components_report,
+    'report:material_batches': material_batches_report,
+    'report:product_batches': product_batches_report,
+    'report:disposals': disposals_report,
+}
+# The site column each report is filtered on
+REPORT_SITE_COLUMNS = {
+    'report:production_components': ProductionOrder.site_id,
+    'report:material_batches': MaterialBatch.site_id,
+    'report:product_batches': ProductBatch.site_id,
+    'report:disposals': DisposalRecord.site_id,
+}
+
+def export_sources(site_id=None):
+    tables = sorted(Base.metadata.tables)
+    if site_id is not None:
+        tables = [t for t in tables if t in SHARED_TABLES or site_filter(Base.metadata.tables[t], site_id) is not None]
+    return tables + list(REPORTS)
+
+def source_query(source, include_blobs=False, site_id=None):
+    if source in REPORTS:
+        query = REPORTS[source]()
+        if site_id is not None:
+            query = query.where(REPORT_SITE_COLUMNS[source] == site_id)
+        return query
+    if source in Base.metadata.tables:
+        return table_query(source, include_blobs, site_id)
+    raise ValueError(f"Unknown export source: {source}")
+
+def count_rows(engine, query):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(query.order_by(None).subquery())).scalar()
+
+def iter_chunks(engine, query, chunk_size=DEFAULT_CHUNK_SIZE):
+    # stream_results makes pymysql use an unbuffered SSCursor, so only one chunk is held in memory
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(query)
+        for chunk in result.partitions(chunk_size):
+            yield chunk
+
+def write_csv(engine, query, fileobj, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    writer = csv.writer(fileobj)
+    writer.writerow([c.name for c in query.selected_columns])
+    row_count = 0
+    for chunk in iter_chunks(engine, query, chunk_size):
+        writer.writerows(chunk)
+        row_count += len(chunk)
+        if progress:
+            progress(row_count)
+    return row_count
+
+def arrow_type(sql_type):
+    import pyarrow as pa
+    if isinstance(sql_type, Boolean):
+        return pa.bool_()
+    if isinstance(sql_type, Integer):
+        return pa.int64()
+    if isinstance(sql_type, Float):
+        return pa.float64()
+    if isinstance(sql_type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(sql_type, Date):
+        return pa.date32()
+    try:
+        if sql_type.python_type is bytes:
+            return pa.binary()
+    except NotImplementedError:
+        pass
+    return pa.string()
+
+def write_parquet(engine, query, target, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # The schema comes from the SQL column types, so chunks with only NULLs in a column still line up
+    schema = pa.schema([(c.name, arrow_type(c.type)) for c in query.selected_columns])
+    row_count = 0
+    with pq.ParquetWriter(target, schema) as writer:
+        for chunk in iter_chunks(engine, query, chunk_size):
+            columns = list(zip(*chunk))
+            arrays = [pa.array(col, type=field.type) for col, field in zip(columns, schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            row_count += len(chunk)
+            if progress:
+                progress(row_count)
+    return row_count
+
+def export_to_file(engine, source, path, fmt="csv", include_blobs=False, chunk_size=DEFAULT_CHUNK_SIZE, progress=None,
+                   site_id=None):
+    query = source_query(source, include_blobs, site_id)
+    if fmt == "csv":
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            return write_csv(engine, query, f, chunk_size, progress)
+    if fmt == "parquet":
+        return write_parquet(engine, query, path, chunk_size, progress)
+    raise ValueError(f"Unknown export format: {fmt}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream an ERP table or report to CSV/Parquet.")
+    parser.add_argument("source", nargs="?", help="Table name or report (see --list)")
+    parser.add_argument("-o", "--output", help="Output file (default: <source>.<format>)")
+    parser.add_argument("-f", "--format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--include-blobs", action="store_true", help="Include LONGBLOB columns such as invoices")
+    parser.add_argument("--url", help="Database URL (default: DATABASE_URL or DB_* environment variables)")
+    parser.add_argument("--site", type=int, help="Only this site's rows (default: all sites)")
+    parser.add_argument("--list", action="store_true", help="List exportable tables and reports")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print("\n".join(export_sources(args.site)))
+        return 0
+    if not args.source:
+        parser.error("source is required")
+
+    engine = create_erp_engine(args.url or database_url_from_secrets(os.environ))
+    output = args.output or f"{args.source.replace('report:', '')}.{args.format}"
+    row_count = export_to_file(engine, args.source, output, args.format, args.include_blobs, args.chunk_size, site_id=args.site)
+    print(f"Exported {row_count} rows from {args.source} to {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+import functools
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event, inspect
+
+logger = logging.getLogger("erp.instrumentation")
+
+SLOW_RERUN_MS = 1000
+TOP_QUERIES = 5
+HISTORY_SIZE = 200
+
+_local = threading.local()
+_lock = threading.Lock()
+_history = deque(maxlen=HISTORY_SIZE)
+_totals = {}
+_blob_keys = {}
+_installed_bases = set()
+_gauges = {}
+_metrics_server = None
+
+class RerunStats:
+    def __init__(self, label):
+        self.label = label
+        self.started = time.perf_counter()
+        self.duration_ms = 0.0
+        self.queries = 0
+        self.db_time_ms = 0.0
+        self.rows = 0
+        self.blob_bytes = 0
+        self.cache_calls = 0
+        self.cache_misses = 0
+        self.statements = {}
+
+    @property
+    def cache_hits(self):
+        return self.cache_calls - self.cache_misses
+
+    def add_query(self, statement, elapsed_ms):
+        self.queries += 1
+        self.db_time_ms += elapsed_ms
+        entry = self.statements.setdefault(normalize_statement(statement), [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed_ms
+
+    def slowest_queries(self, limit=TOP_QUERIES):
+        ranked = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)
+        return [{'statement': s, 'count': c, 'total_ms': round(ms, 2)} for s, (c, ms) in ranked[:limit]]
+
+    def as_dict(self):
+        return {
+            'label': self.label,
+            'duration_ms': round(self.duration_ms, 2),
+            'queries': self.queries,
+            'db_time_ms': round(self.db_time_ms, 2),
+            'rows': self.rows,
+            'blob_bytes': self.blob_bytes,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'slowest_queries': self.slowest_queries(),
+        }
+
+def normalize_statement(statement):
+    return re.sub(r"\s+", " ", statement).strip()[:300]
+
+def current():
+    return getattr(_local, "stats", None)
+
+# Engine and ORM hooks
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start"].pop()
+    stats = current()
+    if stats is not None:
+        stats.add_query(statement, (time.perf_counter() - started) * 1000)
+
+def _on_error(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+def _blob_attributes(cls):
+    if cls not in _blob_keys:
+        keys = []
+        for column_attr in inspect(cls).column_attrs:
+            try:
+                if column_attr.columns[0].type.python_type is bytes:
+                    keys.append(column_attr.key)
+            except NotImplementedError:
+                pass
+        _blob_keys[cls] = keys
+    return _blob_keys[cls]
+
+def _on_load(instance, context):
+    stats = current()
+    if stats is None:
+        return
+    stats.rows += 1
+    for key in _blob_attributes(type(instance)):
+        # Read from __dict__ so deferred blobs are not loaded just to be measured
+        value = instance.__dict__.get(key)
+        if value:
+            stats.blob_bytes += len(value)
+
+def install(engine, base=None):
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _on_error)
+    if base is not None and base not in _installed_bases:
+        event.listen(base, "load", _on_load, propagate=True)
+        _installed_bases.add(base)
+
+def cached(cache_decorator):
+    # Wraps a cache decorator such as st.cache_data so cache hits and misses are counted per rerun
+    def decorator(func):
+        @functools.wraps(func)
+        def load(*args, **kwargs):
+            stats = current()
+            if stats is not None:
+                stats.cache_misses += 1
+            return func(*args, **kwargs)
+        cached_load = cache_decorator(load)
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            stats = current()
+            if stats is not None:
+                stats.cache_calls += 1
+            return cached_load(*args, **kwargs)
+        call.clear = cached_load.clear
+        return call
+    return decorator
+
+# Rerun lifecycle
+def start(label):
+    _local.stats = RerunStats(label)
+    return _local.stats
+
+def set_label(label):
+    stats = current()
+    if stats is not None:
+        stats.label = label
+
+def finish():
+    stats = current()
+    if stats is None:
+        return None
+    _local.stats = None
+    stats.duration_ms = (time.perf_counter() - stats.started) * 1000
+    record = stats.as_dict()
+    with _lock:
+        _history.append(record)
+        totals = _totals.setdefault(stats.label, dict.fromkeys(
+            ['reruns', 'duration_ms', 'queries', 'db_time_ms', 'rows', 'blob_bytes', 'cache_hits', 'cache_misses'], 0))
+        totals['reruns'] += 1
+        for key in ['duration_ms', 'queries', 'db_time_ms', 'rows', 'blob_bytes', 'cache_hits', 'cache_misses']:
+            totals[key] += record[key]
+    logger.info(json.dumps(record, default=str))
+    if stats.duration_ms > SLOW_RERUN_MS:
+        logger.warning("Slow rerun %s (%.0f ms, %d queries); slowest queries: %s",
+                       stats.label, stats.duration_ms, stats.queries, json.dumps(record['slowest_queries']))
+    return stats
+
+@contextmanager
+def record(label):
+    previous = current()
+    stats = start(label)
+    try:
+        yield stats
+    finally:
+        finish()
+        _local.stats = previous
+
+def history():
+    with _lock:
+        return list(_history)
+
+# Prometheus text exposition
+METRICS = [
+    ('erp_reruns_total', 'reruns', 'Number of recorded reruns'),
+    ('erp_rerun_seconds_total', 'duration_ms', 'Total rerun wall time in seconds'),
+    ('erp_queries_total', 'queries', 'Number of SQL statements executed'),
+    ('erp_db_seconds_total', 'db_time_ms', 'Total time spent in SQL statements in seconds'),
+    ('erp_rows_fetched_total', 'rows', 'Number of ORM rows loaded'),
+    ('erp_blob_bytes_total', 'blob_bytes', 'Bytes of blob columns loaded'),
+    ('erp_cache_hits_total', 'cache_hits', 'Number of cache hits'),
+    ('erp_cache_misses_total', 'cache_misses', 'Number of cache misses'),
+]
+
+def add_gauge(name, help_text, read):
+    # Values read when the metrics are served, such as the memory the sessions hold
+    with _lock:
+        _gauges[name] = (help_text, read)
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def prometheus_text():
+    with _lock:
+        totals = {label: dict(values) for label, values in _totals.items()}
+    lines = []
+    for name, key, help_text in METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for label, values in sorted(totals.items()):
+            value = values[key]
+            if key.endswith('_ms'):
+                value = value / 1000
+            lines.append(f'{name}{{page="{_escape_label(label)}"}} {value}')
+    with _lock:
+        gauges = sorted(_gauges.items())
+    for name, (help_text, read) in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {read()}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port, host="127.0.0.1"):
+    # Unauthenticated, so only on the loopback interface unless a scraper elsewhere needs another address
+    global _metrics_server
+    with _lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+            threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return _metrics_server
@@ -0,0 +1,361 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from sqlalchemy import update, func
+from sqlalchemy.orm import sessionmaker
+from models import Job
+from db import MIRROR_REFRESH_SECONDS, create_erp_engine, database_url_from_secrets
+import attachments
+import audit
+import costing
+import export
+import migrations
+import mirror
+import search
+import services
+import sites
+
+# Background jobs run in a process pool so heavy work does not block Streamlit reruns.
+# Jobs are rows in the job table: pages submit them and poll the row for progress and results.
+
+PENDING = 'Afventer'
+RUNNING = 'Kører'
+DONE = 'Afsluttet'
+FAILED = 'Fejlet'
+
+JOBS_DIR = os.environ.get('ERP_JOBS_DIR', os.path.join(tempfile.gettempdir(), 'erp-jobs'))
+POLL_INTERVAL = 2.0
+# A running job's process updates heartbeat_at this often; a job that has not done so for
+# STALE_SECONDS belongs to a process that died or hangs, and is failed by recover()
+HEARTBEAT_SECONDS = 30
+STALE_SECONDS = 120
+
+HANDLERS = {}
+SCHEDULES = []
+
+def job(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+def schedule(kind, every_seconds, params=None):
+    SCHEDULES.append((kind, every_seconds, params or {}))
+
+def job_file(job_id, name):
+    directory = os.path.join(JOBS_DIR, str(job_id))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+# Worker side: each process keeps one engine per database URL
+_engines = {}
+
+def _engine(url):
+    if url not in _engines:
+        _engines[url] = create_erp_engine(url, pool_pre_ping=True)
+        audit.start(url, 'worker')
+    return _engines[url]
+
+class Progress:
+    def __init__(self, engine, job_id, min_interval=0.5):
+        self.engine = engine
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.last = 0.0
+
+    def __call__(self, progress, message=None):
+        # Throttled so a tight loop does not turn into one UPDATE per row
+        now = time.monotonic()
+        if now - self.last < self.min_interval and progress < 1:
+            return
+        self.last = now
+        with self.engine.begin() as conn:
+            conn.execute(update(Job).where(Job.id == self.job_id).values(progress=min(max(progress, 0.0), 1.0), message=message))
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _heartbeat(engine, job_id, owner, stop):
+    while not stop.wait(HEARTBEAT_SECONDS):
+        with engine.begin() as conn:
+            conn.execute(update(Job).where(Job.id == job_id, Job.owner == owner).values(heartbeat_at=datetime.now()))
+
+def run_job(url, job_id):
+    engine = _engine(url)
+    owner = _owner()
+    now = datetime.now()
+    with engine.begin() as conn:
+        claimed = conn.execute(
+            update(Job).where(Job.id == job_id, Job.status == PENDING)
+            .values(status=RUNNING, started_at=now, owner=owner, heartbeat_at=now)
+        ).rowcount
+    if not claimed:
+        return
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(engine, job_id, owner, stop), daemon=True).start()
+    DBSession = sessionmaker(bind=engine)
+    session = DBSession()
+    try:
+        db_job = session.get(Job, job_id)
+        audit.set_actor(session, f"job {job_id} ({db_job.kind})")
+        params = json.loads(db_job.params or '{}')
+        # Jobs submitted from a site's pages work on that site; scheduled jobs cover all sites
+        sites.scope(session, params.get('site_id'))
+        handler = HANDLERS[db_job.kind]
+        result = handler(session, params, Progress(engine, job_id), job_id)
+        session.rollback()
+        values = dict(status=DONE, progress=1.0, result=json.dumps(result, default=str), finished_at=datetime.now())
+    except Exception as e:
+        session.rollback()
+        values = dict(status=FAILED, message=str(e)[:255], result=json.dumps({'traceback': traceback.format_exc()}),
+                      finished_at=datetime.now())
+    finally:
+        stop.set()
+        session.close()
+    # Pool processes exit without atexit hooks, so the job's changes are written before it is marked done
+    audit.flush()
+    with engine.begin() as conn:
+        conn.execute(update(Job).where(Job.id == job_id, Job.owner == owner).values(**values))
+
+# Submitting side
+def create_job(session, kind, params=None):
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    db_job = Job(kind=kind, status=PENDING, params=json.dumps(params or {}, default=str), progress=0.0,
+                 created_at=datetime.now())
+    session.add(db_job)
+    session.commit()
+    return db_job
+
+class JobQueue:
+    # run_jobs=False when a standalone worker (run_worker) runs the jobs: then submitted jobs are only
+    # queued in the table, so exactly one process picks up pending jobs
+    def __init__(self, url, max_workers=None, run_jobs=True):
+        self.url = url
+        self.executor = None
+        if run_jobs:
+            # spawn instead of fork: the parent is a threaded Streamlit server
+            self.executor = ProcessPoolExecutor(max_workers=max_workers or max(1, (os.cpu_count() or 2) - 1),
+                                                mp_context=multiprocessing.get_context('spawn'))
+        self.DBSession = sessionmaker(bind=_engine(url))
+
+    def submit(self, kind, params=None):
+        session = self.DBSession()
+        try:
+            db_job = create_job(session, kind, params)
+            job_id = db_job.id
+        finally:
+            session.close()
+        if self.executor:
+            self.executor.submit(run_job, self.url, job_id)
+        return job_id
+
+    def recover(self):
+        # Jobs left running by a dead process are failed; pending ones are picked up again unless the worker runs them
+        session = self.DBSession()
+        try:
+            fail_abandoned(session)
+            session.commit()
+            pending = [job_id for (job_id,) in session.query(Job.id).filter(Job.status == PENDING).order_by(Job.id)] if self.executor else []
+        finally:
+            session.close()
+        for job_id in pending:
+            self.executor.submit(run_job, self.url, job_id)
+        return len(pending)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+def _owner_alive(owner):
+    # Only processes on this host can be checked directly; others are judged by their heartbeat
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def fail_abandoned(session):
+    # Running jobs whose process is gone (on this host) or has not sent a heartbeat for STALE_SECONDS.
+    # Jobs that other live processes are running are left alone. Returns how many were failed
+    stale_before = datetime.now() - timedelta(seconds=STALE_SECONDS)
+    running = session.query(Job.id, Job.owner, func.coalesce(Job.heartbeat_at, Job.started_at)).filter(Job.status == RUNNING).all()
+    abandoned = [job_id for job_id, owner, heartbeat_at in running
+                 if heartbeat_at is None or heartbeat_at < stale_before or not _owner_alive(owner)]
+    if abandoned:
+        session.execute(update(Job).where(Job.id.in_(abandoned), Job.status == RUNNING)
+                        .values(status=FAILED, message='Afbrudt: processen kører ikke længere', finished_at=datetime.now()))
+    return len(abandoned)
+
+def get_job(session, job_id):
+    return session.get(Job, job_id)
+
+def recent_jobs(session, limit=50):
+    return session.query(Job).order_by(Job.id.desc()).limit(limit).all()
+
+def job_result(db_job):
+    return json.loads(db_job.result) if db_job.result else None
+
+# Handlers
+@job('export')
+def export_job(session, params, progress, job_id):
+    engine = session.get_bind()
+    source = params['source']
+    fmt = params.get('format', 'csv')
+    # Core queries on the engine: the site of the page that submitted the export is filtered in export.py
+    site_id = params.get('site_id')
+    query = export.source_query(source, params.get('include_blobs', False), site_id)
+    total = export.count_rows(engine, query) or 1
+    path = job_file(job_id, f"{source.replace('report:', '')}.{fmt}")
+    row_count = export.export_to_file(
+        engine, source, path, fmt, params.get('include_blobs', False),
+        progress=lambda rows: progress(rows / total, f"{rows} af {total} rækker"), site_id=site_id
+    )
+    return {'rows': row_count, 'path': path, 'file_name': os.path.basename(path)}
+
+@job('purchase_order')
+def purchase_order_job(session, params, progress, job_id):
+    invoice_attachment_id = None
+    if params.get('invoice_path'):
+        progress(0.05, "Gemmer faktura")
+        with open(params['invoice_path'], 'rb') as f:
+            invoice_attachment_id = attachments.store(session.get_bind(), f.read(), params.get('invoice_filename'),
+                                                      params.get('invoice_mimetype'))
+    progress(0.1, "Opretter indkøbsordre")
+    with services.transaction(session):
+        purchase_order = services.create_purchase_order(
+            session,
+            params['supplier_id'],
+            params['items'],
+            date.fromisoformat(params['date']),
+            checked=params.get('checked', False),
+            invoice_attachment_id=invoice_attachment_id,
+            status=params.get('status', services.RECEIVED)
+        )
+        purchase_order_id = purchase_order.id
+    if params.get('invoice_path'):
+        os.remove(params['invoice_path'])
+    return {'purchase_order_id': purchase_order_id}
+
+@job('refresh_mirror')
+def refresh_mirror_job(session, params, progress, job_id):
+    return mirror.refresh_mirror(session.get_bind(), params['path'], params.get('include_blobs', False),
+                                 progress=lambda fraction, table: progress(fraction, f"Kopierer {table}"))
+
+if os.environ.get('READ_MIRROR_PATH'):
+    schedule('refresh_mirror', int(os.environ.get('MIRROR_REFRESH_SECONDS', MIRROR_REFRESH_SECONDS)),
+             {'path': os.environ['READ_MIRROR_PATH']})
+
+@job('expiry_sweep')
+def expiry_sweep_job(session, params, progress, job_id):
+    with services.transaction(session):
+        return services.expiry_sweep(session, date.today(), dispose=params.get('dispose', False))
+
+if os.environ.get('EXPIRY_SWEEP'):
+    # EXPIRY_SWEEP=flag only marks expired batches, EXPIRY_SWEEP=dispose also writes them off
+    schedule('expiry_sweep', 24 * 3600, {'dispose': os.environ['EXPIRY_SWEEP'] == 'dispose'})
+
+@job('reconcile_stock')
+def reconcile_stock_job(session, params, progress, job_id):
+    with services.transaction(session):
+        result = services.reconcile_stock(session, repair=params.get('repair', False))
+    # The job row keeps counts and the first discrepancies; the admin page shows the full list
+    return {kind: {'count': len(r['discrepancies']), 'repaired': r['repaired'], 'stale_flags': r['stale_flags'],
+                   'discrepancies': r['discrepancies'][:100]}
+            for kind, r in result.items()}
+
+if os.environ.get('RECONCILE_STOCK'):
+    # RECONCILE_STOCK=report only records the discrepancies, RECONCILE_STOCK=repair also fixes the totals
+    schedule('reconcile_stock', int(os.environ.get('RECONCILE_STOCK_SECONDS', 3600)),
+             {'repair': os.environ['RECONCILE_STOCK'] == 'repair'})
+
+@job('prune_attachments')
+def prune_attachments_job(session, params, progress, job_id):
+    with services.transaction(session):
+        return {'deleted': attachments.prune_orphans(session)}
+
+schedule('prune_attachments', 24 * 3600)
+
+@job('search_rebuild')
+def search_rebuild_job(session, params, progress, job_id):
+    with services.transaction(session):
+        return search.rebuild(session.connection(), params.get('entities'))
+
+@job('cost_rollup')
+def cost_rollup_job(session, params, progress, job_id):
+    with services.transaction(session):
+        progress(0.1, "Standardkostpriser")
+        standard = costing.roll_standard_costs(session)
+        progress(0.5, "Faktiske kostpriser")
+        actual = costing.roll_actual_costs(session)
+    return {'standard': standard, 'actual': actual}
+
+def run_worker(url, max_workers=None):
+    # Standalone worker: picks up jobs submitted from any process and enqueues scheduled jobs
+    # Run the app with JOB_WORKER set in its secrets so only this process picks up pending jobs
+    queue = JobQueue(url, max_workers)
+    session = queue.DBSession()
+    next_run = {kind: 0.0 for kind, _, _ in SCHEDULES}
+    # Pending jobs already handed to the pool; a job leaves the set once it is no longer pending
+    seen = set()
+    try:
+        while True:
+            now = time.monotonic()
+            for kind, every_seconds, params in SCHEDULES:
+                if now >= next_run[kind]:
+                    create_job(session, kind, params)
+                    next_run[kind] = now + every_seconds
+            session.expire_all()
+            fail_abandoned(session)
+            session.commit()
+            pending = [job_id for (job_id,) in session.query(Job.id).filter(Job.status == PENDING).order_by(Job.id)]
+            for job_id in pending:
+                if job_id not in seen:
+                    queue.executor.submit(run_job, url, job_id)
+            seen = set(pending)
+            session.rollback()
+            time.sleep(POLL_INTERVAL)
+    finally:
+        session.close()
+        queue.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run or submit ERP background jobs.")
+    parser.add_argument("--url", help="Database URL (default: DATABASE_URL or DB_* environment variables)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="Process pending and scheduled jobs")
+    worker.add_argument("--workers", type=int)
+    submit = sub.add_parser("submit", help="Queue a job for a running worker")
+    submit.add_argument("kind", choices=sorted(HANDLERS))
+    submit.add_argument("--params", default="{}", help="Job parameters as JSON")
+    args = parser.parse_args(argv)
+
+    url = args.url or database_url_from_secrets(os.environ)
+    engine = _engine(url)
+    with engine.connect() as conn:
+        migrations.upgrade(conn)
+    if args.command == "worker":
+        run_worker(url, args.workers)
+    else:
+        session = sessionmaker(bind=engine)()
+        db_job = create_job(session, args.kind, json.loads(args.params))
+        print(f"Queued job {db_job.id}")
+        session.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
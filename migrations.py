@@ -0,0 +1,337 @@
+import argparse
+import contextlib
+import os
+import sys
+import time
+from datetime import datetime
+from sqlalchemy import inspect, text, select, update, func
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from models import (
+    Base, SchemaMigration, MaterialBatch, ProductBatch, AuditLog, ProductionOrder, PurchaseOrder, PurchaseOrderItem,
+    GoodsReceipt, GoodsReceiptLine, Attachment, Supplier, SearchTerm, Site, QualityInspection, IdempotencyKey, SalesOrderItemBatch, Job, AVAILABLE_EPSILON, DEFAULT_SITE_ID
+)
+from db import create_erp_engine, database_url_from_secrets
+import attachments
+import search
+
+# Versioned schema and data migrations.
+# Schema migrations run in one short transaction each; DDL on MySQL is issued as online ALTERs
+# (instant or in-place, without locking the table for writes). Data migrations walk a table by
+# id in chunks, each chunk in its own transaction together with its progress, so a big backfill
+# holds no long locks and continues where it stopped after a crash or Ctrl-C.
+# Applied versions are recorded in schema_migration. Migrations must be idempotent: a fresh
+# database gets the current models from the baseline, and later migrations run on top of it.
+
+APPLIED = 'Udført'
+RUNNING = 'Kører'
+DEFAULT_CHUNK_SIZE = 5000
+LOCK_NAME = 'erp_schema_migration'
+LOCK_TIMEOUT_SECONDS = 600
+
+MIGRATIONS = []
+
+def migration(version, description):
+    # func(conn) runs inside a transaction
+    def register(func):
+        MIGRATIONS.append((version, description, func, None, None))
+        return func
+    return register
+
+def data_migration(version, description, table, chunk_size=DEFAULT_CHUNK_SIZE):
+    # func(conn, start_id, end_id) migrates the rows with start_id < id <= end_id of table.
+    # Rows written after the migration started are the application's job, not the migration's.
+    def register(func):
+        MIGRATIONS.append((version, description, func, table, chunk_size))
+        return func
+    return register
+
+# DDL helpers; all of them do nothing when the change is already there
+def _table_name(conn, table):
+    return conn.dialect.identifier_preparer.format_table(table)
+
+def add_column(conn, table, column):
+    if column.name in {c['name'] for c in inspect(conn).get_columns(table.name)}:
+        return False
+    statement = f"ALTER TABLE {_table_name(conn, table)} ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}"
+    if conn.dialect.name != 'mysql':
+        conn.execute(text(statement))
+        return True
+    try:
+        # MySQL 8: metadata-only change
+        conn.execute(text(f"{statement}, ALGORITHM=INSTANT"))
+    except DBAPIError:
+        # Older servers or column types INSTANT cannot add: rebuild online, writes keep going
+        conn.execute(text(f"{statement}, ALGORITHM=INPLACE, LOCK=NONE"))
+    return True
+
+def create_index(conn, index):
+    if index.name in {i['name'] for i in inspect(conn).get_indexes(index.table.name)}:
+        return False
+    # Indexes on columns a later migration adds are created by that migration
+    if not {c.name for c in index.columns} <= {c['name'] for c in inspect(conn).get_columns(index.table.name)}:
+        return False
+    statement = str(CreateIndex(index).compile(dialect=conn.dialect))
+    if conn.dialect.name == 'mysql':
+        statement += " ALGORITHM=INPLACE LOCK=NONE"
+    conn.execute(text(statement))
+    return True
+
+def drop_index(conn, table, name):
+    if name not in {i['name'] for i in inspect(conn).get_indexes(table.name)}:
+        return False
+    if conn.dialect.name == 'mysql':
+        conn.execute(text(f"DROP INDEX {conn.dialect.identifier_preparer.quote(name)} ON {_table_name(conn, table)} ALGORITHM=INPLACE LOCK=NONE"))
+    else:
+        conn.execute(text(f"DROP INDEX {conn.dialect.identifier_preparer.quote(name)}"))
+    return True
+
+def create_table(conn, table):
+    table.create(conn, checkfirst=True)
+    for index in table.indexes:
+        create_index(conn, index)
+
+def sync_schema(conn, metadata):
+    # Creates missing tables, columns and indexes from the models. New columns must be nullable
+    # or have a server_default; filling them for existing rows belongs in a data migration.
+    existing_tables = set(inspect(conn).get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            create_table(conn, table)
+            continue
+        for column in table.columns:
+            add_column(conn, table, column)
+        for index in table.indexes:
+            create_index(conn, index)
+
+# Runner
+@contextlib.contextmanager
+def _migration_lock(conn):
+    # Only one process migrates at a time; the others wait and then find nothing left to do
+    if conn.dialect.name != 'mysql':
+        yield
+        return
+    with conn.begin():
+        acquired = conn.execute(text("SELECT GET_LOCK(:name, :timeout)"), {'name': LOCK_NAME, 'timeout': LOCK_TIMEOUT_SECONDS}).scalar()
+    if not acquired:
+        raise RuntimeError("Timed out waiting for another process to finish migrating")
+    try:
+        yield
+    finally:
+        with conn.begin():
+            conn.execute(text("SELECT RELEASE_LOCK(:name)"), {'name': LOCK_NAME})
+
+def _states(conn):
+    return {row.version: row for row in conn.execute(select(SchemaMigration.__table__))}
+
+def _run_data_migration(conn, version, description, migrate, table, chunk_size, state, progress):
+    with conn.begin():
+        end_id = conn.execute(select(func.max(table.c.id))).scalar() or 0
+        if state is None:
+            conn.execute(SchemaMigration.__table__.insert().values(
+                version=version, description=description, status=RUNNING, last_id=0, started_at=datetime.now()))
+    start_id = state.last_id if state is not None and state.last_id else 0
+    first_id, started = start_id, time.monotonic()
+    while start_id < end_id:
+        stop_id = min(start_id + chunk_size, end_id)
+        with conn.begin():
+            migrate(conn, start_id, stop_id)
+            conn.execute(update(SchemaMigration).where(SchemaMigration.version == version).values(last_id=stop_id))
+        start_id = stop_id
+        if progress:
+            progress(version, (start_id - first_id) / max(end_id - first_id, 1),
+                     f"{table.name}: id {start_id} af {end_id} ({time.monotonic() - started:.1f} s)")
+
+def upgrade(conn, target=None, chunk_size=None, progress=None):
+    # conn: a Connection outside any transaction. Returns the versions applied.
+    applied = []
+    with _migration_lock(conn):
+        with conn.begin():
+            SchemaMigration.__table__.create(conn, checkfirst=True)
+        with conn.begin():
+            states = _states(conn)
+        for version, description, migrate, table, default_chunk_size in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if target is not None and version > target:
+                break
+            state = states.get(version)
+            if state is not None and state.status == APPLIED:
+                continue
+            if table is None:
+                with conn.begin():
+                    migrate(conn)
+                    conn.execute(SchemaMigration.__table__.insert().values(
+                        version=version, description=description, status=APPLIED, started_at=datetime.now(), applied_at=datetime.now()))
+            else:
+                _run_data_migration(conn, version, description, migrate, table, chunk_size or default_chunk_size, state, progress)
+                with conn.begin():
+                    conn.execute(update(SchemaMigration).where(SchemaMigration.version == version)
+                                 .values(status=APPLIED, applied_at=datetime.now()))
+            applied.append(version)
+            if progress:
+                progress(version, 1.0, description)
+    return applied
+
+# Migrations
+@migration(1, "Baseline: tables, columns and indexes of the models")
+def baseline(conn):
+    sync_schema(conn, Base.metadata)
+
+def _backfill_available(conn, table, start_id, end_id):
+    conn.execute(update(table).where(table.c.id > start_id, table.c.id <= end_id)
+                 .values(available=table.c.quantity > AVAILABLE_EPSILON))
+
+@data_migration(2, "Batch availability for material batches", MaterialBatch.__table__)
+def material_batch_available(conn, start_id, end_id):
+    _backfill_available(conn, MaterialBatch.__table__, start_id, end_id)
+
+@data_migration(3, "Batch availability for product batches", ProductBatch.__table__)
+def product_batch_available(conn, start_id, end_id):
+    _backfill_available(conn, ProductBatch.__table__, start_id, end_id)
+
+@migration(4, "Audit log")
+def audit_log(conn):
+    create_table(conn, AuditLog.__table__)
+
+@migration(5, "Goods receipts and received quantities on purchase order lines")
+def goods_receipts(conn):
+    create_table(conn, GoodsReceipt.__table__)
+    create_table(conn, GoodsReceiptLine.__table__)
+    add_column(conn, PurchaseOrderItem.__table__, PurchaseOrderItem.__table__.c.quantity_received)
+    add_column(conn, MaterialBatch.__table__, MaterialBatch.__table__.c.goods_receipt_line_id)
+    for table in (PurchaseOrder.__table__, PurchaseOrderItem.__table__, MaterialBatch.__table__):
+        for index in table.indexes:
+            create_index(conn, index)
+    # Orders placed before receipts existed were received in full when they were placed
+    orders = PurchaseOrder.__table__
+    conn.execute(update(orders).where(orders.c.status == 'Afgivet').values(status='Modtaget'))
+    if conn.dialect.name == 'mysql':
+        conn.execute(text(f"ALTER TABLE {_table_name(conn, orders)} ALTER COLUMN status SET DEFAULT 'Modtaget'"))
+
+@data_migration(6, "Received quantities of purchase order lines", PurchaseOrderItem.__table__)
+def purchase_order_item_received(conn, start_id, end_id):
+    items, orders = PurchaseOrderItem.__table__, PurchaseOrder.__table__
+    received = select(orders.c.id).where(orders.c.status == 'Modtaget')
+    conn.execute(update(items).where(items.c.id > start_id, items.c.id <= end_id, items.c.purchase_order_id.in_(received))
+                 .values(quantity_received=items.c.quantity))
+
+@migration(7, "Attachments for invoices and supplier reports")
+def attachment_table(conn):
+    create_table(conn, Attachment.__table__)
+    for table, column in ((PurchaseOrder.__table__, 'invoice_attachment_id'), (Supplier.__table__, 'report_attachment_id')):
+        add_column(conn, table, table.c[column])
+        for index in table.indexes:
+            create_index(conn, index)
+
+def _move_to_attachments(conn, table, prefix, start_id, end_id):
+    # Files stored on the row before attachments existed. The old columns are no longer in the
+    # models, so they are read with plain SQL; emptying them gives the space back without a table rebuild.
+    if f'{prefix}_file' not in {c['name'] for c in inspect(conn).get_columns(table.name)}:
+        return
+    name = _table_name(conn, table)
+    rows = conn.execute(text(f"SELECT id, {prefix}_file, {prefix}_filename, {prefix}_mimetype FROM {name} "
+                             f"WHERE id > :start_id AND id <= :end_id AND {prefix}_file IS NOT NULL"),
+                        {'start_id': start_id, 'end_id': end_id}).all()
+    for row_id, data, filename, mimetype in rows:
+        attachment_id = attachments.store_in(conn, bytes(data), filename, mimetype)
+        conn.execute(text(f"UPDATE {name} SET {prefix}_attachment_id = :attachment_id, {prefix}_file = NULL WHERE id = :id"),
+                     {'attachment_id': attachment_id, 'id': row_id})
+
+# Few rows per chunk: every row may carry a large file
+@data_migration(8, "Move purchase order invoices to attachments", PurchaseOrder.__table__, chunk_size=100)
+def purchase_order_invoices(conn, start_id, end_id):
+    _move_to_attachments(conn, PurchaseOrder.__table__, 'invoice', start_id, end_id)
+
+@data_migration(9, "Move supplier reports to attachments", Supplier.__table__, chunk_size=100)
+def supplier_reports(conn, start_id, end_id):
+    _move_to_attachments(conn, Supplier.__table__, 'report', start_id, end_id)
+
+@migration(10, "Search index")
+def search_index(conn):
+    create_table(conn, SearchTerm.__table__)
+
+def _search_index_migration(version, entity):
+    @data_migration(version, f"Search index for {entity}", search.ENTITIES[entity][0].__table__)
+    def index_rows(conn, start_id, end_id):
+        search.reindex_range(conn, entity, start_id, end_id)
+
+for version, entity in enumerate(search.ENTITIES, 11):
+    _search_index_migration(version, entity)
+
+@migration(16, "Sites: site_id on orders, batches and production lines, indexes led by the site")
+def sites(conn):
+    create_table(conn, Site.__table__)
+    site_table = Site.__table__
+    if conn.execute(select(site_table.c.id).where(site_table.c.id == DEFAULT_SITE_ID)).first() is None:
+        conn.execute(site_table.insert().values(id=DEFAULT_SITE_ID, name="Hovedsite"))
+    # NOT NULL with a default: existing rows belong to the first site without being rewritten
+    for table in Base.metadata.sorted_tables:
+        if 'site_id' in table.c:
+            add_column(conn, table, table.c.site_id)
+            for index in table.indexes:
+                create_index(conn, index)
+    # Replaced by the site-led indexes above
+    for table, name in ((ProductionOrder.__table__, 'ix_production_order_status_due_date'),
+                        (PurchaseOrder.__table__, 'ix_purchase_order_status_supplier_date'),
+                        (MaterialBatch.__table__, 'ix_material_batch_available_material'),
+                        (MaterialBatch.__table__, 'ix_material_batch_expiry_date'),
+                        (MaterialBatch.__table__, 'ix_material_batch_last_used'),
+                        (ProductBatch.__table__, 'ix_product_batch_available_product'),
+                        (ProductBatch.__table__, 'ix_product_batch_expiry_date'),
+                        (ProductBatch.__table__, 'ix_product_batch_last_used')):
+        drop_index(conn, table, name)
+
+@migration(17, "Quality control: inspection status on material batches and inspection records")
+def quality_control(conn):
+    # The server default releases the existing batches; they have been in use already
+    batch_table = MaterialBatch.__table__
+    add_column(conn, batch_table, batch_table.c.qc_status)
+    create_index(conn, next(i for i in batch_table.indexes if i.name == 'ix_material_batch_site_qc_status_date'))
+    create_table(conn, QualityInspection.__table__)
+
+@migration(18, "API idempotency keys: hash of the request they were sent with")
+def idempotency_request_hash(conn):
+    key_table = IdempotencyKey.__table__
+    add_column(conn, key_table, key_table.c.request_hash)
+
+@migration(19, "Product batches of sales order lines")
+def sales_order_item_batches(conn):
+    # Which batches older orders were taken from was never recorded; deleting those orders is refused
+    create_table(conn, SalesOrderItemBatch.__table__)
+
+@migration(20, "Background jobs: owner and heartbeat of running jobs")
+def job_owner_heartbeat(conn):
+    job_table = Job.__table__
+    add_column(conn, job_table, job_table.c.owner)
+    add_column(conn, job_table, job_table.c.heartbeat_at)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply ERP schema and data migrations.")
+    parser.add_argument("--url", help="Database URL (default: DATABASE_URL or DB_* environment variables)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    up = sub.add_parser("upgrade", help="Apply pending migrations (interrupted data migrations resume)")
+    up.add_argument("--to", type=int, help="Stop after this version")
+    up.add_argument("--chunk-size", type=int, help=f"Rows per transaction in data migrations (default {DEFAULT_CHUNK_SIZE})")
+    sub.add_parser("status", help="List migrations and whether they are applied")
+    args = parser.parse_args(argv)
+
+    engine = create_erp_engine(args.url or database_url_from_secrets(os.environ))
+    with engine.connect() as conn:
+        if args.command == "status":
+            with conn.begin():
+                states = _states(conn) if inspect(conn).has_table(SchemaMigration.__tablename__) else {}
+            for version, description, _, table, _ in sorted(MIGRATIONS, key=lambda m: m[0]):
+                state = states.get(version)
+                status = state.status if state else "Afventer"
+                if state is not None and state.status == RUNNING:
+                    status += f" (til id {state.last_id})"
+                print(f"{version:4d}  {'data  ' if table is not None else 'schema'}  {status:20s}  {description}")
+            return 0
+
+        def report(version, fraction, message):
+            print(f"[{version}] {fraction:6.1%} {message}", file=sys.stderr)
+        applied = upgrade(conn, args.to, args.chunk_size, report)
+        print(f"Applied {len(applied)} migrations" + (f": {', '.join(map(str, applied))}" if applied else ""), file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
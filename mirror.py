@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import time
+from sqlalchemy import create_engine
+from models import Base
+from db import MIRROR_REFRESH_SECONDS, create_erp_engine, database_url_from_secrets
+import export
+
+# Local read mirror: a SQLite copy of the primary that reporting pages can read from
+# (set READ_MIRROR_PATH). It is rebuilt in a temporary file and swapped in atomically,
+# so readers never see a half-copied database.
+
+def refresh_mirror(source_engine, path, include_blobs=False, chunk_size=export.DEFAULT_CHUNK_SIZE, progress=None):
+    started = time.monotonic()
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    target = create_engine(f"sqlite:///{tmp_path}")
+    rows = {}
+    try:
+        Base.metadata.create_all(target)
+        tables = Base.metadata.sorted_tables
+        for index, table in enumerate(tables):
+            query = export.table_query(table.name, include_blobs)
+            insert = table.insert()
+            rows[table.name] = 0
+            with target.begin() as conn:
+                for chunk in export.iter_chunks(source_engine, query, chunk_size):
+                    conn.execute(insert, [dict(row._mapping) for row in chunk])
+                    rows[table.name] += len(chunk)
+            if progress:
+                progress((index + 1) / len(tables), table.name)
+    finally:
+        target.dispose()
+    os.replace(tmp_path, path)
+    return {'path': path, 'rows': rows, 'seconds': round(time.monotonic() - started, 2)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy the ERP database into a local SQLite read mirror.")
+    parser.add_argument("path", nargs="?", default=os.environ.get("READ_MIRROR_PATH"), help="Mirror file (default: READ_MIRROR_PATH)")
+    parser.add_argument("--include-blobs", action="store_true", help="Also copy invoices and supplier reports")
+    parser.add_argument("--every", type=int, help=f"Keep running and refresh every N seconds (the worker uses {MIRROR_REFRESH_SECONDS})")
+    parser.add_argument("--url", help="Database URL (default: DATABASE_URL or DB_* environment variables)")
+    args = parser.parse_args(argv)
+    if not args.path:
+        parser.error("path or READ_MIRROR_PATH is required")
+
+    engine = create_erp_engine(args.url or database_url_from_secrets(os.environ))
+    while True:
+        result = refresh_mirror(engine, args.path, args.include_blobs)
+        print(f"Refreshed {result['path']}: {sum(result['rows'].values())} rows in {result['seconds']} s", file=sys.stderr)
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, DateTime, Boolean, Text, LargeBinary, Index, event, false, true
+from sqlalchemy.orm import declarative_base, declared_attr, relationship
+from sqlalchemy.dialects.mysql import LONGBLOB, VARCHAR
+
+Base = declarative_base()
+
+# LONGBLOB on MySQL, plain BLOB elsewhere so the schema also builds on SQLite
+Blob = LargeBinary().with_variant(LONGBLOB(), 'mysql')
+
+# Search terms compare byte for byte on MySQL; the default collation would make 'a' and 'å' the same key
+SearchTermString = String(40).with_variant(VARCHAR(40, collation='utf8mb4_bin'), 'mysql')
+
+# A batch is available while it has stock left; quantities below this are rounding leftovers
+AVAILABLE_EPSILON = 1e-9
+
+# Rows from before sites existed, and rows written without a site, belong to the first site
+DEFAULT_SITE_ID = 1
+
+# Quality control of received material batches; only released batches go into production
+QC_PENDING = 'Afventer kontrol'
+QC_RELEASED = 'Frigivet'
+QC_HELD = 'Spærret'
+
+class Site(Base):
+    __tablename__ = 'site'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(80), nullable=False, unique=True)
+
+class SiteScoped:
+    # Orders, batches and lines belong to one site; sites.py limits a site's sessions to its rows.
+    # The catalog (materials, products, recipes, customers, suppliers) is shared by all sites.
+    @declared_attr
+    def site_id(cls):
+        return Column(Integer, ForeignKey('site.id'), nullable=False, default=DEFAULT_SITE_ID, server_default=str(DEFAULT_SITE_ID))
+
+class Product(Base):
+    __tablename__ = 'product'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(80), nullable=False)
+    quantity = Column(Float, default=0.0, nullable=False)
+    unit = Column(String(20), nullable=False, default='stk')
+    standard_cost = Column(Float, nullable=True)
+
+class Material(Base):
+    __tablename__ = 'material'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(80), nullable=False)
+    producer_name = Column(String(80), nullable=True)
+    unit = Column(String(20), nullable=False)
+    quantity = Column(Float, default=0.0, nullable=False)
+    standard_cost = Column(Float, nullable=True)
+
+class Customer(Base):
+    __tablename__ = 'customer'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(80), nullable=False)
+    address = Column(String(120), nullable=False)
+    contact_email = Column(String(80), nullable=False)
+    phone_number = Column(String(20), nullable=False)
+    vat_number = Column(String(20), nullable=False)
+
+class Attachment(Base):
+    __tablename__ = 'attachment'
+    id = Column(Integer, primary_key=True)
+    # Hash of the uploaded bytes; the same file is stored once
+    sha256 = Column(String(64), nullable=False, unique=True)
+    filename = Column(String(255), nullable=True)
+    mimetype = Column(String(50), nullable=True)
+    size = Column(Integer, nullable=False)
+    stored_size = Column(Integer, nullable=False)
+    compression = Column(String(10), nullable=True)
+    data = Column(Blob, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+
+class Supplier(Base):
+    __tablename__ = 'supplier'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(80), nullable=False)
+    address = Column(String(120), nullable=False)
+    contact_email = Column(String(80), nullable=False)
+    phone_number = Column(String(20), nullable=False)
+    vat_number = Column(String(20), nullable=False)
+    organic_number = Column(String(80), nullable=True)
+    report_attachment_id = Column(Integer, ForeignKey('attachment.id'), nullable=True, index=True)
+
+class Recipe(Base):
+    __tablename__ = 'recipe'
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
+    method = Column(Text, nullable=True)
+    output_quantity = Column(Float, nullable=False)
+    duration_minutes = Column(Float, nullable=True)
+
+class BoM(Base):
+    __tablename__ = 'bom'
+    id = Column(Integer, primary_key=True)
+    recipe_id = Column(Integer, ForeignKey('recipe.id'), nullable=False)
+    component_material_id = Column(Integer, ForeignKey('material.id'), nullable=True)
+    component_product_id = Column(Integer, ForeignKey('product.id'), nullable=True)
+    quantity_required = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+
+class ProductionOrder(SiteScoped, Base):
+    __tablename__ = 'production_order'
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
+    quantity = Column(Float, nullable=False)
+    status = Column(String(20), default='Afventer', nullable=False)
+    batch_id = Column(String(80), nullable=False)
+    date = Column(Date, nullable=False)
+    due_date = Column(Date, nullable=True)
+    priority = Column(Integer, default=0, server_default='0', nullable=False)
+    line_id = Column(Integer, ForeignKey('production_line.id'), nullable=True)
+    planned_start = Column(DateTime, nullable=True)
+    planned_end = Column(DateTime, nullable=True)
+    __table_args__ = (Index('ix_production_order_site_status_due_date', 'site_id', 'status', 'due_date'),)
+
+class ProductionLine(SiteScoped, Base):
+    __tablename__ = 'production_line'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(80), nullable=False)
+    minutes_per_day = Column(Float, nullable=False, default=480.0)
+    active = Column(Boolean, default=True, server_default=true(), nullable=False)
+    __table_args__ = (Index('ix_production_line_site', 'site_id'),)
+
+class ProductionOrderComponent(Base):
+    __tablename__ = 'production_order_component'
+    id = Column(Integer, primary_key=True)
+    production_order_id = Column(Integer, ForeignKey('production_order.id'), nullable=False)
+    component_material_id = Column(Integer, ForeignKey('material.id'), nullable=True)
+    component_product_id = Column(Integer, ForeignKey('product.id'), nullable=True)
+    batch_id = Column(Integer, nullable=False)
+    quantity_used = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    __table_args__ = (Index('ix_production_order_component_material', 'component_material_id', 'production_order_id'),)
+
+class SalesOrder(SiteScoped, Base):
+    __tablename__ = 'sales_order'
+    id = Column(Integer, primary_key=True)
+    customer_id = Column(Integer, ForeignKey('customer.id'), nullable=False)
+    status = Column(String(20), default='Afventer', nullable=False)
+    date = Column(Date, nullable=False)
+    items = relationship('SalesOrderItem', backref='sales_order', cascade="all,delete-orphan")
+    __table_args__ = (Index('ix_sales_order_site_date', 'site_id', 'date'),)
+
+class SalesOrderItem(Base):
+    __tablename__ = 'sales_order_item'
+    id = Column(Integer, primary_key=True)
+    sales_order_id = Column(Integer, ForeignKey('sales_order.id'), nullable=False)
+    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
+    quantity = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    batches = relationship('SalesOrderItemBatch', cascade="all,delete-orphan")
+
+class SalesOrderItemBatch(Base):
+    # The product batches a sales line was taken from, so deleting the order can put the quantities back
+    __tablename__ = 'sales_order_item_batch'
+    id = Column(Integer, primary_key=True)
+    sales_order_item_id = Column(Integer, ForeignKey('sales_order_item.id'), nullable=False, index=True)
+    batch_id = Column(Integer, nullable=False)
+    quantity_used = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+
+class MaterialBatch(SiteScoped, Base):
+    __tablename__ = 'material_batch'
+    id = Column(Integer, primary_key=True)
+    material_id = Column(Integer, ForeignKey('material.id'), nullable=False)
+    batch_id = Column(String(80), nullable=False)
+    quantity = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    date = Column(Date, nullable=False)
+    checked = Column(Boolean, default=False, nullable=False)
+    expiry_date = Column(Date, nullable=True)
+    last_used = Column(Date, nullable=True)
+    expired = Column(Boolean, default=False, server_default=false(), nullable=False)
+    unit_cost = Column(Float, nullable=True)
+    # Maintained on every write (see _set_available), so pickers and caches only load live batches
+    available = Column(Boolean, default=True, server_default=true(), nullable=False)
+    goods_receipt_line_id = Column(Integer, ForeignKey('goods_receipt_line.id'), nullable=True, index=True)
+    # New batches wait for inspection unless they were checked at receipt; batches from before quality control count as released
+    qc_status = Column(String(20), default=QC_PENDING, server_default=QC_RELEASED, nullable=False)
+    # The first covers the grouped stock reconciliation query (all sites), so it never reads the table rows.
+    # The inspection queue is a range scan on the last one.
+    __table_args__ = (Index('ix_material_batch_material_unit_quantity', 'material_id', 'unit', 'quantity'),
+                      Index('ix_material_batch_site_available_material', 'site_id', 'available', 'material_id'),
+                      Index('ix_material_batch_site_expiry_date', 'site_id', 'expiry_date'),
+                      Index('ix_material_batch_site_last_used', 'site_id', 'last_used'),
+                      Index('ix_material_batch_site_qc_status_date', 'site_id', 'qc_status', 'date'))
+
+class ProductBatch(SiteScoped, Base):
+    __tablename__ = 'product_batch'
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey('product.id'), nullable=False)
+    batch_id = Column(String(80), nullable=False)
+    quantity = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    date = Column(Date, nullable=False)
+    expiry_date = Column(Date, nullable=True)
+    last_used = Column(Date, nullable=True)
+    expired = Column(Boolean, default=False, server_default=false(), nullable=False)
+    unit_cost = Column(Float, nullable=True)
+    available = Column(Boolean, default=True, server_default=true(), nullable=False)
+    __table_args__ = (Index('ix_product_batch_product_unit_quantity', 'product_id', 'unit', 'quantity'),
+                      Index('ix_product_batch_site_available_product', 'site_id', 'available', 'product_id'),
+                      Index('ix_product_batch_site_expiry_date', 'site_id', 'expiry_date'),
+                      Index('ix_product_batch_site_last_used', 'site_id', 'last_used'))
+
+def _set_available(mapper, connection, target):
+    target.available = target.quantity > AVAILABLE_EPSILON
+
+for _batch_model in (MaterialBatch, ProductBatch):
+    event.listen(_batch_model, 'before_insert', _set_available)
+    event.listen(_batch_model, 'before_update', _set_available)
+
+class QualityInspection(SiteScoped, Base):
+    # One inspection of a material batch; the batch's qc_status is the result of the latest one
+    __tablename__ = 'quality_inspection'
+    id = Column(Integer, primary_key=True)
+    material_batch_id = Column(Integer, ForeignKey('material_batch.id'), nullable=False)
+    result = Column(String(20), nullable=False)
+    inspector = Column(String(120), nullable=True)
+    notes = Column(String(255), nullable=True)
+    inspected_at = Column(DateTime, nullable=False)
+    __table_args__ = (Index('ix_quality_inspection_batch', 'material_batch_id', 'inspected_at'),
+                      Index('ix_quality_inspection_site_inspected_at', 'site_id', 'inspected_at'))
+
+class DisposalRecord(SiteScoped, Base):
+    __tablename__ = 'disposal_record'
+    id = Column(Integer, primary_key=True)
+    material_id = Column(Integer, ForeignKey('material.id'), nullable=True)
+    product_id = Column(Integer, ForeignKey('product.id'), nullable=True)
+    batch_id = Column(Integer, nullable=False)
+    quantity = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    reason = Column(String(255), nullable=False)
+    date = Column(Date, nullable=False)
+    __table_args__ = (Index('ix_disposal_record_site_date', 'site_id', 'date'),)
+
+class PurchaseOrder(SiteScoped, Base):
+    __tablename__ = 'purchase_order'
+    id = Column(Integer, primary_key=True)
+    supplier_id = Column(Integer, ForeignKey('supplier.id'), nullable=False)
+    date = Column(Date, nullable=False)
+    checked = Column(Boolean, default=False, nullable=False)
+    status = Column(String(20), default='Modtaget', server_default='Modtaget', nullable=False)
+    invoice_attachment_id = Column(Integer, ForeignKey('attachment.id'), nullable=True, index=True)
+    items = relationship('PurchaseOrderItem', backref='purchase_order')
+    # Open orders per supplier for the pending deliveries list
+    __table_args__ = (Index('ix_purchase_order_site_status_supplier_date', 'site_id', 'status', 'supplier_id', 'date'),)
+
+class PurchaseOrderItem(Base):
+    __tablename__ = 'purchase_order_item'
+    id = Column(Integer, primary_key=True)
+    purchase_order_id = Column(Integer, ForeignKey('purchase_order.id'), nullable=False)
+    material_id = Column(Integer, ForeignKey('material.id'), nullable=False)
+    batch_id = Column(String(80), nullable=False)
+    quantity = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    unit_cost = Column(Float, nullable=True)
+    quantity_received = Column(Float, default=0.0, server_default='0', nullable=False)
+    __table_args__ = (Index('ix_purchase_order_item_order', 'purchase_order_id'),)
+
+class GoodsReceipt(SiteScoped, Base):
+    __tablename__ = 'goods_receipt'
+    id = Column(Integer, primary_key=True)
+    supplier_id = Column(Integer, ForeignKey('supplier.id'), nullable=False)
+    date = Column(Date, nullable=False)
+    delivery_note = Column(String(80), nullable=True)
+    checked = Column(Boolean, default=False, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    __table_args__ = (Index('ix_goods_receipt_supplier_date', 'supplier_id', 'date'),
+                      Index('ix_goods_receipt_site_date', 'site_id', 'date'))
+
+class GoodsReceiptLine(Base):
+    # Received in the unit of the purchase order line
+    __tablename__ = 'goods_receipt_line'
+    id = Column(Integer, primary_key=True)
+    goods_receipt_id = Column(Integer, ForeignKey('goods_receipt.id'), nullable=False, index=True)
+    purchase_order_item_id = Column(Integer, ForeignKey('purchase_order_item.id'), nullable=False, index=True)
+    material_id = Column(Integer, ForeignKey('material.id'), nullable=False)
+    batch_id = Column(String(80), nullable=False)
+    quantity = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    expiry_date = Column(Date, nullable=True)
+    unit_cost = Column(Float, nullable=True)
+
+class MaterialReplenishment(Base):
+    __tablename__ = 'material_replenishment'
+    material_id = Column(Integer, ForeignKey('material.id'), primary_key=True)
+    lead_time_days = Column(Float, default=7.0, nullable=False)
+    daily_mean = Column(Float, default=0.0, nullable=False)
+    daily_std = Column(Float, default=0.0, nullable=False)
+    safety_stock = Column(Float, default=0.0, nullable=False)
+    reorder_point = Column(Float, default=0.0, nullable=False)
+    updated_at = Column(DateTime, nullable=True)
+
+class IdempotencyKey(Base):
+    __tablename__ = 'api_idempotency_key'
+    key = Column(String(80), primary_key=True)
+    endpoint = Column(String(80), nullable=False)
+    # SHA-256 of the operations the key was first sent with; empty for keys stored before it was recorded
+    request_hash = Column(String(64), nullable=True)
+    status_code = Column(Integer, nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migration'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(255), nullable=False)
+    status = Column(String(20), nullable=False)
+    last_id = Column(Integer, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    applied_at = Column(DateTime, nullable=True)
+
+class Job(Base):
+    __tablename__ = 'job'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    status = Column(String(20), default='Afventer', nullable=False)
+    params = Column(Text, nullable=True)
+    progress = Column(Float, default=0.0, nullable=False)
+    message = Column(String(255), nullable=True)
+    result = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    # host:pid of the process running the job, and when it last reported that it is alive
+    owner = Column(String(120), nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    __table_args__ = (Index('ix_job_status_created_at', 'status', 'created_at'),)
+
+class AuditLog(Base):
+    __tablename__ = 'audit_log'
+    id = Column(Integer, primary_key=True)
+    occurred_at = Column(DateTime, nullable=False)
+    actor = Column(String(120), nullable=True)
+    source = Column(String(20), nullable=False)
+    entity = Column(String(50), nullable=False)
+    entity_id = Column(Integer, nullable=True)
+    action = Column(String(10), nullable=False)
+    changes = Column(Text, nullable=True)
+    __table_args__ = (
+        # History of one record, and everything in a time window or by one user
+        Index('ix_audit_log_entity', 'entity', 'entity_id', 'occurred_at'),
+        Index('ix_audit_log_occurred_at', 'occurred_at'),
+        Index('ix_audit_log_actor_occurred_at', 'actor', 'occurred_at'),
+    )
+
+class SearchTerm(Base):
+    # Inverted index for the global search, maintained by search.py
+    __tablename__ = 'search_term'
+    term = Column(SearchTermString, primary_key=True)
+    entity = Column(String(20), primary_key=True)
+    entity_id = Column(Integer, primary_key=True)
+    weight = Column(Float, nullable=False)
+    __table_args__ = (Index('ix_search_term_entity', 'entity', 'entity_id'),)
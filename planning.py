@@ -0,0 +1,172 @@
+import heapq
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import update, bindparam, true
+from models import Material, Product, Recipe, BoM, ProductionOrder, ProductionLine, MaterialBatch, ProductBatch, QC_RELEASED
+from units import convert_units
+import services
+
+# Finite-capacity scheduling of planned production orders.
+# Orders are taken from a priority queue (priority, then due date) and placed on the line where
+# they finish first. Components are reserved from current batches; products made by orders
+# scheduled earlier become available when those orders finish, so intermediate products line up.
+# An order short of a product waits until an order making that product is placed, and is then
+# taken again in its turn, so an intermediate made by a lower-priority order is waited for too.
+
+WORKDAY_START = time(8, 0)
+DEFAULT_DURATION_MINUTES = 60
+DEFAULT_LINE = {'id': None, 'name': "Standardlinje", 'minutes_per_day': 480.0}
+PLANNED = 'Planlagt'
+UNPLANNED = 'Afventer'
+
+def to_datetime(start_day, minutes_per_day, minutes):
+    # Working minutes on a line since start_day 08:00 -> calendar time
+    day, offset = divmod(minutes, minutes_per_day)
+    return datetime.combine(start_day + timedelta(days=int(day)), WORKDAY_START) + timedelta(minutes=offset)
+
+def to_line_minutes(start_day, minutes_per_day, moment):
+    offset = (moment - datetime.combine(moment.date(), WORKDAY_START)).total_seconds() / 60
+    return (moment.date() - start_day).days * minutes_per_day + min(max(offset, 0.0), minutes_per_day)
+
+def order_duration(recipe, quantity):
+    per_recipe = recipe['duration_minutes'] or DEFAULT_DURATION_MINUTES
+    return per_recipe * quantity / recipe['output_quantity'] if recipe['output_quantity'] else per_recipe
+
+def schedule_orders(orders, recipes, lines, stock, start_day):
+    # orders: dicts with id, product_id, quantity, due_date, priority
+    # recipes: product_id -> dict with output_quantity, duration_minutes and components
+    #          (list of (kind, item_id, quantity_required, unit, item_unit))
+    # lines: dicts with id, name, minutes_per_day; stock: (kind, item_id) -> quantity in the item unit
+    supplies = defaultdict(list)
+    for key, quantity in stock.items():
+        if quantity > 0:
+            supplies[key].append([None, quantity])
+    line_free = {index: 0.0 for index in range(len(lines))}
+    queue = [(-o['priority'], o['due_date'] or date.max, o['id'], o) for o in orders]
+    heapq.heapify(queue)
+    scheduled, unscheduled = [], []
+    # Orders only short of products: order id -> (queue entry, shortages), and the orders waiting for each product
+    deferred = {}
+    waiting = defaultdict(list)
+
+    while queue:
+        entry = heapq.heappop(queue)
+        order = entry[3]
+        recipe = recipes.get(order['product_id'])
+        if recipe is None:
+            unscheduled.append(dict(order, reason="Ingen opskrift"))
+            continue
+        scale = order['quantity'] / recipe['output_quantity'] if recipe['output_quantity'] else 1
+        needs = defaultdict(float)
+        for kind, item_id, quantity_required, unit, item_unit in recipe['components']:
+            needs[(kind, item_id)] += convert_units(quantity_required * scale, unit, item_unit)
+        shortages = [(key, need - sum(q for _, q in supplies[key])) for key, need in needs.items()
+                     if sum(q for _, q in supplies[key]) + 1e-9 < need]
+        if shortages:
+            if any(kind == 'material' for (kind, _), _ in shortages):
+                unscheduled.append(dict(order, reason="Mangler komponenter", shortages=shortages))
+            else:
+                deferred[order['id']] = (entry, shortages)
+                for key, _ in shortages:
+                    waiting[key].append(order['id'])
+            continue
+
+        # Reserve components, earliest available first; the order cannot start before the last one is ready
+        ready_at = None
+        for key, need in needs.items():
+            lots = sorted(supplies[key], key=lambda lot: lot[0] or datetime.min)
+            for lot in lots:
+                if need <= 1e-9:
+                    break
+                take = min(lot[1], need)
+                lot[1] -= take
+                need -= take
+                if lot[0] is not None and (ready_at is None or lot[0] > ready_at):
+                    ready_at = lot[0]
+            supplies[key] = [lot for lot in lots if lot[1] > 1e-9]
+
+        duration = order_duration(recipe, order['quantity'])
+        best = None
+        for index, line in enumerate(lines):
+            start = line_free[index]
+            if ready_at is not None:
+                start = max(start, to_line_minutes(start_day, line['minutes_per_day'], ready_at))
+            end = to_datetime(start_day, line['minutes_per_day'], start + duration)
+            if best is None or end < best[2]:
+                best = (index, start, end)
+        index, start, end = best
+        line = lines[index]
+        line_free[index] = start + duration
+        supplies[('product', order['product_id'])].append([end, order['quantity']])
+        for order_id in waiting.pop(('product', order['product_id']), []):
+            if order_id in deferred:
+                heapq.heappush(queue, deferred.pop(order_id)[0])
+        scheduled.append(dict(
+            order,
+            line_id=line['id'],
+            line_name=line['name'],
+            start=to_datetime(start_day, line['minutes_per_day'], start),
+            end=end,
+            late=order['due_date'] is not None and end.date() > order['due_date'],
+        ))
+    for entry, shortages in sorted(deferred.values(), key=lambda d: d[0][:3]):
+        unscheduled.append(dict(entry[3], reason="Mangler komponenter", shortages=shortages))
+    return scheduled, unscheduled
+
+def load_inputs(session):
+    orders = [
+        {'id': o.id, 'product_id': o.product_id, 'quantity': o.quantity, 'due_date': o.due_date, 'priority': o.priority or 0}
+        for o in session.query(ProductionOrder)
+        .filter(ProductionOrder.status.in_(services.PLANNED_STATUSES), ProductionOrder.batch_id == '')
+    ]
+    product_ids = {o['product_id'] for o in orders}
+    material_units = dict(session.query(Material.id, Material.unit).all())
+    product_units = dict(session.query(Product.id, Product.unit).all())
+    recipes = {}
+    if product_ids:
+        for recipe in session.query(Recipe).filter(Recipe.product_id.in_(product_ids)):
+            recipes.setdefault(recipe.product_id, {
+                'id': recipe.id,
+                'output_quantity': recipe.output_quantity,
+                'duration_minutes': recipe.duration_minutes,
+                'components': [],
+            })
+        by_recipe = {r['id']: r for r in recipes.values()}
+        for bom in session.query(BoM).filter(BoM.recipe_id.in_(list(by_recipe))):
+            if bom.component_material_id:
+                component = ('material', bom.component_material_id, bom.quantity_required, bom.unit,
+                             material_units.get(bom.component_material_id, bom.unit))
+            else:
+                component = ('product', bom.component_product_id, bom.quantity_required, bom.unit,
+                             product_units.get(bom.component_product_id, bom.unit))
+            by_recipe[bom.recipe_id]['components'].append(component)
+
+    # Availability comes from the batches (materials only once quality control released them), converted to the item unit
+    stock = defaultdict(float)
+    for material_id, quantity, unit in (session.query(MaterialBatch.material_id, MaterialBatch.quantity, MaterialBatch.unit)
+                                        .filter(MaterialBatch.available == true(), MaterialBatch.qc_status == QC_RELEASED)):
+        stock[('material', material_id)] += convert_units(quantity, unit, material_units.get(material_id, unit))
+    for product_id, quantity, unit in (session.query(ProductBatch.product_id, ProductBatch.quantity, ProductBatch.unit)
+                                       .filter(ProductBatch.available == true())):
+        stock[('product', product_id)] += convert_units(quantity, unit, product_units.get(product_id, unit))
+
+    lines = [{'id': l.id, 'name': l.name, 'minutes_per_day': l.minutes_per_day}
+             for l in session.query(ProductionLine).filter(ProductionLine.active.is_(True)).order_by(ProductionLine.id)]
+    return orders, recipes, lines or [DEFAULT_LINE], stock
+
+def build_schedule(session, start_day=None):
+    orders, recipes, lines, stock = load_inputs(session)
+    return schedule_orders(orders, recipes, lines, stock, start_day or date.today())
+
+def apply_schedule(session, scheduled, unscheduled):
+    table = ProductionOrder.__table__
+    statement = (update(table).where(table.c.id == bindparam('o_id'))
+                 .values(status=bindparam('o_status'), line_id=bindparam('o_line_id'),
+                         planned_start=bindparam('o_start'), planned_end=bindparam('o_end')))
+    rows = [{'o_id': o['id'], 'o_status': PLANNED, 'o_line_id': o['line_id'], 'o_start': o['start'], 'o_end': o['end']}
+            for o in scheduled]
+    rows += [{'o_id': o['id'], 'o_status': UNPLANNED, 'o_line_id': None, 'o_start': None, 'o_end': None}
+             for o in unscheduled]
+    if rows:
+        session.execute(statement, rows)
+    return len(scheduled)
@@ -0,0 +1,178 @@
+import math
+from datetime import date, datetime, timedelta
+import pandas as pd
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from models import Material, MaterialReplenishment, ProductionOrder, ProductionOrderComponent, PurchaseOrder, PurchaseOrderItem
+from units import convert_units
+import services
+import sites
+
+# Reorder points and safety stock per material from production consumption.
+# Daily consumption over a rolling window gives mean and standard deviation; with lead time L:
+#   safety stock  = z * std * sqrt(L)
+#   reorder point = mean * L + safety stock
+# Statistics are stored in material_replenishment and refreshed for the consumed materials
+# after every production commit; a full recompute is only needed after changing the window.
+# Stock and statistics are company-wide, so consumption and open orders of every site count.
+
+WINDOW_DAYS = 90
+DEFAULT_LEAD_TIME_DAYS = 7.0
+REVIEW_DAYS = 14
+SERVICE_LEVEL_Z = 1.65  # about 95 % of lead times without a stockout
+
+def _unit_factors(pairs):
+    return {(from_unit, to_unit): convert_units(1.0, from_unit, to_unit) for from_unit, to_unit in pairs}
+
+def consumption_frame(session, material_ids=None, today=None):
+    # One grouped query: consumption per material, day and unit within the window
+    today = today or date.today()
+    query = (
+        session.query(ProductionOrderComponent.component_material_id, ProductionOrder.date, ProductionOrderComponent.unit,
+                      func.sum(ProductionOrderComponent.quantity_used))
+        .join(ProductionOrder, ProductionOrder.id == ProductionOrderComponent.production_order_id)
+        .filter(ProductionOrderComponent.component_material_id.isnot(None),
+                ProductionOrder.date > today - timedelta(days=WINDOW_DAYS), ProductionOrder.date <= today)
+        .group_by(ProductionOrderComponent.component_material_id, ProductionOrder.date, ProductionOrderComponent.unit)
+    )
+    if material_ids is not None:
+        query = query.filter(ProductionOrderComponent.component_material_id.in_(material_ids))
+    return pd.DataFrame(query.all(), columns=['material_id', 'day', 'unit', 'quantity'])
+
+def compute_stats(materials, consumption, lead_times):
+    # materials: DataFrame with material_id and unit; consumption: see consumption_frame;
+    # lead_times: material_id -> days. Returns one row per material, vectorized over all of them.
+    stats = materials[['material_id', 'unit']].copy()
+    if not consumption.empty:
+        consumption = consumption.merge(stats, on='material_id', suffixes=('', '_material'))
+        factors = _unit_factors(set(zip(consumption['unit'], consumption['unit_material'])))
+        consumption['quantity'] = consumption['quantity'] * [factors[pair] for pair in zip(consumption['unit'], consumption['unit_material'])]
+        daily = consumption.groupby(['material_id', 'day'])['quantity'].sum()
+        sums = pd.DataFrame({'total': daily.groupby(level=0).sum(), 'total_sq': (daily ** 2).groupby(level=0).sum()})
+        stats = stats.merge(sums, left_on='material_id', right_index=True, how='left')
+    else:
+        stats['total'] = 0.0
+        stats['total_sq'] = 0.0
+    stats[['total', 'total_sq']] = stats[['total', 'total_sq']].fillna(0.0)
+    # Days without production count as zero consumption
+    stats['daily_mean'] = stats['total'] / WINDOW_DAYS
+    stats['daily_std'] = (stats['total_sq'] / WINDOW_DAYS - stats['daily_mean'] ** 2).clip(lower=0.0) ** 0.5
+    stats['lead_time_days'] = stats['material_id'].map(lead_times).fillna(DEFAULT_LEAD_TIME_DAYS)
+    stats['safety_stock'] = SERVICE_LEVEL_Z * stats['daily_std'] * stats['lead_time_days'] ** 0.5
+    stats['reorder_point'] = stats['daily_mean'] * stats['lead_time_days'] + stats['safety_stock']
+    return stats[['material_id', 'lead_time_days', 'daily_mean', 'daily_std', 'safety_stock', 'reorder_point']]
+
+def refresh_stats(session, material_ids=None, today=None, incremental=False):
+    with sites.unscoped(session):
+        return _refresh_stats(session, material_ids, today, incremental)
+
+def _refresh_stats(session, material_ids, today, incremental):
+    # material_ids=None recomputes every material. The incremental refresh after a production commit
+    # runs in a savepoint so a concurrent first insert of the same row never fails the production itself.
+    if material_ids is not None:
+        material_ids = [m for m in material_ids if m is not None]
+        if not material_ids:
+            return 0
+    materials_query = session.query(Material.id, Material.unit)
+    existing_query = session.query(MaterialReplenishment)
+    if material_ids is not None:
+        materials_query = materials_query.filter(Material.id.in_(material_ids))
+        existing_query = existing_query.filter(MaterialReplenishment.material_id.in_(material_ids))
+    materials = pd.DataFrame(materials_query.all(), columns=['material_id', 'unit'])
+    if materials.empty:
+        return 0
+    existing = {row.material_id: row for row in existing_query}
+    stats = compute_stats(materials, consumption_frame(session, material_ids, today),
+                          {m: row.lead_time_days for m, row in existing.items()})
+
+    def write():
+        now = datetime.now()
+        for row in stats.itertuples(index=False):
+            record = existing.get(row.material_id)
+            if record is None:
+                record = MaterialReplenishment(material_id=int(row.material_id))
+                session.add(record)
+            record.lead_time_days = float(row.lead_time_days)
+            record.daily_mean = float(row.daily_mean)
+            record.daily_std = float(row.daily_std)
+            record.safety_stock = float(row.safety_stock)
+            record.reorder_point = float(row.reorder_point)
+            record.updated_at = now
+        session.flush()
+
+    if incremental:
+        try:
+            with session.begin_nested():
+                write()
+        except IntegrityError:
+            return 0
+    else:
+        write()
+    return len(stats)
+
+def set_lead_time(session, material_id, lead_time_days):
+    if lead_time_days <= 0:
+        raise services.ServiceError("Leveringstiden skal være større end 0.")
+    record = session.get(MaterialReplenishment, material_id)
+    if record is None:
+        record = MaterialReplenishment(material_id=material_id)
+        session.add(record)
+    record.lead_time_days = lead_time_days
+    session.flush()
+    refresh_stats(session, [material_id])
+
+def overview(session):
+    # Stock position per material: on hand plus what is still to come from drafts and open orders, against the reorder point
+    with sites.unscoped(session):
+        return _overview(session)
+
+def _overview(session):
+    materials = pd.DataFrame(session.query(Material.id, Material.name, Material.unit, Material.quantity).all(),
+                             columns=['material_id', 'name', 'unit', 'quantity'])
+    stats = pd.DataFrame(
+        session.query(MaterialReplenishment.material_id, MaterialReplenishment.lead_time_days, MaterialReplenishment.daily_mean,
+                      MaterialReplenishment.daily_std, MaterialReplenishment.safety_stock, MaterialReplenishment.reorder_point).all(),
+        columns=['material_id', 'lead_time_days', 'daily_mean', 'daily_std', 'safety_stock', 'reorder_point'])
+    on_order = pd.DataFrame(
+        session.query(PurchaseOrderItem.material_id, PurchaseOrderItem.unit,
+                      func.sum(PurchaseOrderItem.quantity - PurchaseOrderItem.quantity_received))
+        .join(PurchaseOrder, PurchaseOrder.id == PurchaseOrderItem.purchase_order_id)
+        .filter(PurchaseOrder.status.in_((services.DRAFT,) + services.OPEN_STATUSES))
+        .group_by(PurchaseOrderItem.material_id, PurchaseOrderItem.unit).all(),
+        columns=['material_id', 'order_unit', 'on_order'])
+    # Latest supplier per material is the one proposals go to
+    last_supplier = pd.DataFrame(
+        session.query(PurchaseOrderItem.material_id, PurchaseOrder.supplier_id)
+        .join(PurchaseOrder, PurchaseOrder.id == PurchaseOrderItem.purchase_order_id)
+        .order_by(PurchaseOrder.date, PurchaseOrder.id).all(),
+        columns=['material_id', 'supplier_id']).drop_duplicates('material_id', keep='last')
+
+    df = materials.merge(stats, on='material_id', how='left').merge(last_supplier, on='material_id', how='left')
+    if not on_order.empty:
+        on_order = on_order.merge(materials[['material_id', 'unit']], on='material_id')
+        factors = _unit_factors(set(zip(on_order['order_unit'], on_order['unit'])))
+        on_order['on_order'] = on_order['on_order'] * [factors[pair] for pair in zip(on_order['order_unit'], on_order['unit'])]
+        df = df.merge(on_order.groupby('material_id')['on_order'].sum(), left_on='material_id', right_index=True, how='left')
+    else:
+        df['on_order'] = 0.0
+    df['on_order'] = df['on_order'].fillna(0.0)
+    df['lead_time_days'] = df['lead_time_days'].fillna(DEFAULT_LEAD_TIME_DAYS)
+    df[['daily_mean', 'daily_std', 'safety_stock', 'reorder_point']] = df[['daily_mean', 'daily_std', 'safety_stock', 'reorder_point']].fillna(0.0)
+    df['position'] = df['quantity'] + df['on_order']
+    df['below_reorder_point'] = (df['daily_mean'] > 0) & (df['position'] < df['reorder_point'])
+    # Order up to the reorder point plus one review period of demand
+    df['proposed_quantity'] = (df['reorder_point'] + df['daily_mean'] * REVIEW_DAYS - df['position']).where(df['below_reorder_point'], 0.0)
+    return df
+
+def create_proposals(session, today=None):
+    # One draft purchase order per supplier for every material below its reorder point
+    today = today or date.today()
+    df = overview(session)
+    proposals = df[df['below_reorder_point'] & df['supplier_id'].notna() & (df['proposed_quantity'] > 0)]
+    drafts = []
+    for supplier_id, lines in proposals.groupby('supplier_id'):
+        items = [{'material_id': int(row.material_id), 'quantity': math.ceil(row.proposed_quantity * 100) / 100, 'unit': row.unit}
+                 for row in lines.itertuples()]
+        drafts.append(services.create_purchase_order(session, int(supplier_id), items, today, status=services.DRAFT))
+    skipped = int((df['below_reorder_point'] & df['supplier_id'].isna()).sum())
+    return drafts, skipped
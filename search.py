@@ -0,0 +1,214 @@
+import argparse
+import os
+import re
+import sys
+import unicodedata
+from collections import defaultdict
+from sqlalchemy import case, delete, desc, event, func, insert, inspect, select, union_all
+from sqlalchemy.orm import Session
+from models import Customer, Supplier, Material, Product, Recipe, SearchTerm
+from db import create_erp_engine, database_url_from_secrets
+
+# Global search over the text fields of customers, suppliers, materials, products and recipes.
+# Every word of an indexed field is a row in search_term (term, entity, entity_id), written in the
+# same transaction as the change that produced it, so a search is a few index range scans on the
+# term prefixes instead of a scan of the tables. Hits must match every word of the query; exact
+# words rank above prefixes, and names above addresses and descriptions.
+# Bulk inserts that bypass the ORM flush (benchmarks, imports) are indexed with rebuild().
+
+# entity -> (model, {field: weight})
+ENTITIES = {
+    'customer': (Customer, {'name': 3.0, 'address': 1.0, 'contact_email': 1.0, 'phone_number': 1.0, 'vat_number': 2.0}),
+    'supplier': (Supplier, {'name': 3.0, 'address': 1.0, 'contact_email': 1.0, 'phone_number': 1.0, 'vat_number': 2.0,
+                            'organic_number': 2.0}),
+    'material': (Material, {'name': 3.0, 'producer_name': 1.0}),
+    'product': (Product, {'name': 3.0}),
+    'recipe': (Recipe, {'method': 1.0}),
+}
+LABELS = {'customer': "Kunde", 'supplier': "Leverandør", 'material': "Materiale", 'product': "Produkt", 'recipe': "Opskrift"}
+# Numbers are also indexed without separators, so "12345678" finds "12 34 56 78" and "DK-ØKO-100" finds "dkøko100"
+CODE_FIELDS = {'phone_number', 'vat_number', 'organic_number'}
+
+TOKEN_RE = re.compile(r"\w+")
+MAX_TERM_LENGTH = 40
+MIN_PREFIX_LENGTH = 2
+MAX_QUERY_TERMS = 6
+EXACT_BOOST = 2.0
+DEFAULT_LIMIT = 50
+REBUILD_CHUNK_SIZE = 2000
+
+def normalize(text):
+    # Lower case without accents; æ, ø and å have no decomposition and stay
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+def terms(text):
+    if not text:
+        return []
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(normalize(str(text)))]
+
+def document_terms(entity, values):
+    # values: field -> text. Returns term -> weight
+    weights = defaultdict(float)
+    for field, weight in ENTITIES[entity][1].items():
+        words = set(terms(values.get(field)))
+        if field in CODE_FIELDS and len(words) > 1:
+            words.add(''.join(terms(values.get(field)))[:MAX_TERM_LENGTH])
+        for word in words:
+            weights[word] += weight
+    return weights
+
+# Index maintenance
+def _reindex(conn, entity, model_filter, term_filter):
+    model, fields = ENTITIES[entity]
+    table = SearchTerm.__table__
+    conn.execute(delete(table).where(table.c.entity == entity, term_filter(table.c.entity_id)))
+    rows = []
+    for row in conn.execute(select(model.id, *[getattr(model, field) for field in fields]).where(model_filter(model.id))):
+        values = dict(zip(fields, row[1:]))
+        rows.extend({'term': term, 'entity': entity, 'entity_id': row[0], 'weight': weight}
+                    for term, weight in document_terms(entity, values).items())
+    if rows:
+        conn.execute(insert(table), rows)
+    return len(rows)
+
+def reindex(conn, entity, ids):
+    ids = list(ids)
+    return _reindex(conn, entity, lambda column: column.in_(ids), lambda column: column.in_(ids))
+
+def reindex_range(conn, entity, start_id, end_id):
+    def between(column):
+        return (column > start_id) & (column <= end_id)
+    return _reindex(conn, entity, between, between)
+
+def rebuild(conn, entities=None, chunk_size=REBUILD_CHUNK_SIZE):
+    # Inside the caller's transaction; returns the number of terms written per entity
+    written = {}
+    for entity in entities or ENTITIES:
+        model = ENTITIES[entity][0]
+        conn.execute(delete(SearchTerm.__table__).where(SearchTerm.entity == entity))
+        end_id = conn.execute(select(func.max(model.id))).scalar() or 0
+        written[entity] = 0
+        for start_id in range(0, end_id, chunk_size):
+            written[entity] += reindex_range(conn, entity, start_id, min(start_id + chunk_size, end_id))
+    return written
+
+_ENTITY_BY_MODEL = {model: entity for entity, (model, _) in ENTITIES.items()}
+
+@event.listens_for(Session, "after_flush")
+def _after_flush(session, flush_context):
+    touched = defaultdict(set)
+    for objects, check_fields in ((session.new, False), (session.dirty, True), (session.deleted, False)):
+        for obj in objects:
+            entity = _ENTITY_BY_MODEL.get(type(obj))
+            if entity is None:
+                continue
+            state = inspect(obj)
+            # Stock movements touch materials and products all the time; only text changes matter here
+            if check_fields and not set(state.committed_state).intersection(ENTITIES[entity][1]):
+                continue
+            touched[entity].add(state.identity[0] if state.identity else state.dict.get('id'))
+    if touched:
+        conn = session.connection()
+        for entity, ids in touched.items():
+            reindex(conn, entity, ids)
+
+# Lookups
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search(session, text, entities=None, limit=DEFAULT_LIMIT):
+    # -> list of dicts with entity, id, label, match and score, best first
+    words = list(dict.fromkeys(terms(text)))[:MAX_QUERY_TERMS]
+    if not words:
+        return []
+    parts = []
+    for word in words:
+        if len(word) < MIN_PREFIX_LENGTH:
+            condition = SearchTerm.term == word
+        else:
+            condition = SearchTerm.term.like(_escape_like(word) + '%', escape='\\')
+        part = (select(SearchTerm.entity, SearchTerm.entity_id,
+                       func.max(case((SearchTerm.term == word, SearchTerm.weight * EXACT_BOOST), else_=SearchTerm.weight))
+                       .label('score'))
+                .where(condition).group_by(SearchTerm.entity, SearchTerm.entity_id))
+        if entities:
+            part = part.where(SearchTerm.entity.in_(entities))
+        parts.append(part)
+    # One row per entity and query word, so a hit matching every word has len(words) rows
+    hits = union_all(*parts).subquery() if len(parts) > 1 else parts[0].subquery()
+    ranked = session.execute(
+        select(hits.c.entity, hits.c.entity_id, func.sum(hits.c.score).label('score'))
+        .group_by(hits.c.entity, hits.c.entity_id)
+        .having(func.count() == len(words))
+        .order_by(desc('score'), hits.c.entity, hits.c.entity_id)
+        .limit(limit)
+    ).all()
+    return _describe(session, ranked, words)
+
+def _describe(session, ranked, words):
+    ids = defaultdict(list)
+    for entity, entity_id, _ in ranked:
+        ids[entity].append(entity_id)
+    rows = {}
+    for entity, entity_ids in ids.items():
+        model, fields = ENTITIES[entity]
+        columns = [model.id] + [getattr(model, field) for field in fields]
+        query = select(*columns).where(model.id.in_(entity_ids))
+        if entity == 'recipe':
+            query = query.add_columns(Product.name).join(Product, Product.id == Recipe.product_id)
+        for row in session.execute(query):
+            rows[(entity, row[0])] = row
+    results = []
+    for entity, entity_id, score in ranked:
+        row = rows.get((entity, entity_id))
+        if row is None:
+            # Deleted with a bulk statement since it was indexed
+            continue
+        fields = list(ENTITIES[entity][1])
+        values = dict(zip(fields, row[1:]))
+        label = row[-1] if entity == 'recipe' else values['name']
+        results.append({'entity': entity, 'id': entity_id, 'label': label,
+                        'match': _matching_text(values, words), 'score': round(score, 2)})
+    return results
+
+def _matching_text(values, words):
+    # The first field containing a query word, shortened around it
+    for value in values.values():
+        if not value:
+            continue
+        text = str(value)
+        normalized = normalize(text)
+        for word in words:
+            position = normalized.find(word)
+            if position >= 0:
+                start = max(position - 30, 0)
+                return ("…" if start else "") + text[start:start + 80] + ("…" if start + 80 < len(text) else "")
+            if word in ''.join(terms(text)):
+                # Matched a number without its separators
+                return text[:80]
+    return ""
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search the ERP catalog or rebuild the search index.")
+    parser.add_argument("--url", help="Database URL (default: DATABASE_URL or DB_* environment variables)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    find = sub.add_parser("find", help="Print the best matches for a query")
+    find.add_argument("query")
+    find.add_argument("--type", choices=sorted(ENTITIES), action="append", help="Only these kinds (repeatable)")
+    sub.add_parser("rebuild", help="Index every row again (after bulk imports)")
+    args = parser.parse_args(argv)
+
+    engine = create_erp_engine(args.url or database_url_from_secrets(os.environ))
+    if args.command == "rebuild":
+        with engine.begin() as conn:
+            written = rebuild(conn)
+        print(", ".join(f"{entity}: {count} terms" for entity, count in written.items()), file=sys.stderr)
+        return 0
+    with Session(engine) as session:
+        for result in search(session, args.query, args.type):
+            print(f"{result['score']:6.1f}  {LABELS[result['entity']]:10s} {result['id']:6d}  {result['label']}  {result['match']}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,909 @@
+import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+import pandas as pd
+from sqlalchemy import insert, update, select, bindparam, case, func, literal, or_, and_, true, false, Boolean, Date, Integer
+from models import (
+    Product, Material, Customer, Supplier, Recipe, BoM, ProductionOrder, ProductionOrderComponent,
+    SalesOrder, SalesOrderItem, SalesOrderItemBatch, MaterialBatch, ProductBatch, DisposalRecord, PurchaseOrder, PurchaseOrderItem,
+    GoodsReceipt, GoodsReceiptLine, ProductionLine, Site, QualityInspection, AVAILABLE_EPSILON, QC_PENDING, QC_RELEASED, QC_HELD
+)
+from units import CONVERSION_FACTORS, convert_units
+import replenishment
+import sites
+
+# Business operations shared by the Streamlit pages, scripts and benchmarks.
+# Services only add and flush; the caller owns the transaction and commits or rolls back,
+# so several operations can be combined into one commit.
+
+class ServiceError(Exception):
+    pass
+
+@contextmanager
+def transaction(session):
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+def _get(session, model, id, message):
+    obj = session.get(model, id)
+    if obj is None:
+        raise ServiceError(message)
+    return obj
+
+def _as_date(value):
+    # Scripts, jobs and the API pass ISO strings; pages pass date objects
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value)
+
+def _by_id(session, model, ids):
+    ids = set(ids)
+    if not ids:
+        return {}
+    return {obj.id: obj for obj in session.query(model).filter(model.id.in_(ids)).all()}
+
+# Master data
+def create_material(session, name, unit, producer_name=None):
+    material = Material(name=name, unit=unit, producer_name=producer_name)
+    session.add(material)
+    session.flush()
+    return material
+
+def create_product(session, name, unit):
+    product = Product(name=name, unit=unit)
+    session.add(product)
+    session.flush()
+    return product
+
+def create_customer(session, name, address, contact_email, phone_number, vat_number):
+    customer = Customer(name=name, address=address, contact_email=contact_email, phone_number=phone_number, vat_number=vat_number)
+    session.add(customer)
+    session.flush()
+    return customer
+
+def create_supplier(session, name, address, contact_email, phone_number, vat_number, organic_number=None,
+                    report_attachment_id=None):
+    supplier = Supplier(
+        name=name,
+        address=address,
+        contact_email=contact_email,
+        phone_number=phone_number,
+        vat_number=vat_number,
+        organic_number=organic_number,
+        report_attachment_id=report_attachment_id
+    )
+    session.add(supplier)
+    session.flush()
+    return supplier
+
+def create_site(session, name):
+    name = (name or '').strip()
+    if not name:
+        raise ServiceError("Navn er påkrævet.")
+    if session.query(Site.id).filter(Site.name == name).first():
+        raise ServiceError(f"Produktionsstedet '{name}' findes allerede.")
+    site = Site(name=name)
+    session.add(site)
+    session.flush()
+    return site
+
+def create_recipe(session, product_id, method, output_quantity, duration_minutes=None):
+    if output_quantity <= 0:
+        raise ServiceError("Opskriftens mængde skal være større end 0.")
+    recipe = Recipe(product_id=product_id, method=method, output_quantity=output_quantity, duration_minutes=duration_minutes)
+    session.add(recipe)
+    session.flush()
+    return recipe
+
+def add_bom_components(session, recipe_id, components):
+    # components: dicts with either material_id or product_id, plus quantity_required and unit
+    boms = []
+    for component in components:
+        bom = BoM(
+            recipe_id=recipe_id,
+            component_material_id=component.get('material_id'),
+            component_product_id=component.get('product_id'),
+            quantity_required=component['quantity_required'],
+            unit=component['unit']
+        )
+        session.add(bom)
+        boms.append(bom)
+    session.flush()
+    return boms
+
+def delete_material(session, material_id):
+    material = _get(session, Material, material_id, "Materialet findes ikke.")
+    if session.query(BoM.id).filter_by(component_material_id=material_id).first():
+        raise ServiceError("Kan ikke slette materialet, da det bruges i en stykliste.")
+    if session.query(MaterialBatch.id).filter_by(material_id=material_id).first():
+        raise ServiceError("Kan ikke slette materialet, da der er tilknyttede batches.")
+    session.delete(material)
+
+def delete_product(session, product_id):
+    product = _get(session, Product, product_id, "Produktet findes ikke.")
+    used_in_bom = session.query(BoM.id).filter_by(component_product_id=product_id).first()
+    has_recipe = session.query(Recipe.id).filter_by(product_id=product_id).first()
+    has_orders = session.query(ProductionOrder.id).filter_by(product_id=product_id).first()
+    if used_in_bom or has_recipe or has_orders:
+        raise ServiceError("Kan ikke slette produktet, da det bruges i en stykliste eller produktionsordre.")
+    if session.query(ProductBatch.id).filter_by(product_id=product_id).first():
+        raise ServiceError("Kan ikke slette produktet, da der er tilknyttede batches.")
+    session.delete(product)
+
+def delete_customer(session, customer_id):
+    customer = _get(session, Customer, customer_id, "Kunden findes ikke.")
+    if session.query(SalesOrder.id).filter_by(customer_id=customer_id).first():
+        raise ServiceError("Kan ikke slette kunden, da der er tilknyttede salgsordrer.")
+    session.delete(customer)
+
+def delete_bom(session, bom_id):
+    session.delete(_get(session, BoM, bom_id, "Styklisteposten findes ikke."))
+
+# Purchasing
+# An order is drafted (Kladde), sent to the supplier (Bestilt) and received in one or more goods receipts
+# (Delvist modtaget, Modtaget). A receipt covers lines of any number of orders from one supplier, and each
+# received line becomes a material batch. Buying off the shelf orders and receives in one step.
+DRAFT = 'Kladde'
+ORDERED = 'Bestilt'
+PARTIALLY_RECEIVED = 'Delvist modtaget'
+RECEIVED = 'Modtaget'
+OPEN_STATUSES = (ORDERED, PARTIALLY_RECEIVED)
+RECEIPT_TOLERANCE = 1e-6
+
+def create_purchase_order(session, supplier_id, items, date, checked=False,
+                          invoice_attachment_id=None, status=RECEIVED):
+    # items: dicts with material_id, quantity and unit, optionally unit_cost (per unit).
+    # DRAFT and ORDERED only record the lines. RECEIVED also receives everything at once, so the
+    # items need a batch_id and may carry an expiry_date.
+    if not items:
+        raise ServiceError("Indkøbsordren har ingen materialer.")
+    if status not in (DRAFT, ORDERED, RECEIVED):
+        raise ServiceError(f"Ugyldig status for indkøbsordren: {status}")
+    _get(session, Supplier, supplier_id, "Leverandøren findes ikke.")
+    materials = _by_id(session, Material, [item['material_id'] for item in items])
+    purchase_order = PurchaseOrder(
+        supplier_id=supplier_id,
+        date=date,
+        checked=checked,
+        status=ORDERED if status == RECEIVED else status,
+        invoice_attachment_id=invoice_attachment_id
+    )
+    session.add(purchase_order)
+    session.flush()
+    lines = []
+    for item in items:
+        material = materials.get(item['material_id'])
+        if material is None:
+            raise ServiceError(f"Materiale med ID {item['material_id']} findes ikke.")
+        if item['quantity'] <= 0:
+            raise ServiceError("Mængden skal være større end 0.")
+        line = PurchaseOrderItem(
+            purchase_order_id=purchase_order.id,
+            material_id=material.id,
+            batch_id=item.get('batch_id') or '',
+            quantity=item['quantity'],
+            unit=item['unit'],
+            unit_cost=item.get('unit_cost')
+        )
+        session.add(line)
+        lines.append(line)
+    session.flush()
+    if status == RECEIVED:
+        receive_goods(session, supplier_id, [dict(item, purchase_order_item_id=line.id) for item, line in zip(items, lines)],
+                      date, checked=checked)
+    return purchase_order
+
+def place_purchase_order(session, purchase_order_id, items, date):
+    # Sends a draft to the supplier. items: dicts with id (the PurchaseOrderItem) and quantity, optionally
+    # unit_cost; lines with quantity 0 are dropped from the order. Stock arrives with receive_goods.
+    purchase_order = _get(session, PurchaseOrder, purchase_order_id, "Indkøbsordren findes ikke.")
+    if purchase_order.status != DRAFT:
+        raise ServiceError("Kun kladder kan afgives.")
+    lines = {line.id: line for line in session.query(PurchaseOrderItem).filter_by(purchase_order_id=purchase_order_id)}
+    ordered = 0
+    for item in items:
+        line = lines.get(item['id'])
+        if line is None:
+            raise ServiceError(f"Linje {item['id']} hører ikke til indkøbsordren.")
+        if item['quantity'] <= 0:
+            session.delete(line)
+            continue
+        line.quantity = item['quantity']
+        if item.get('unit_cost') is not None:
+            line.unit_cost = item['unit_cost']
+        ordered += 1
+    if not ordered:
+        raise ServiceError("Indkøbsordren har ingen materialer.")
+    purchase_order.status = ORDERED
+    purchase_order.date = date
+    session.flush()
+    return purchase_order
+
+def receive_goods(session, supplier_id, lines, date, delivery_note=None, checked=False):
+    # lines: dicts with purchase_order_item_id, quantity (in the unit of the order line) and batch_id, optionally
+    # expiry_date and unit_cost (defaults to the order price). Checked goods are released for production right
+    # away; the others wait in the inspection queue. All lines are validated together, then the
+    # receipt lines, batches, stock, received quantities and order statuses are written with a few set-based
+    # statements, so a truckload with hundreds of lines is one short transaction.
+    if not lines:
+        raise ServiceError("Modtagelsen har ingen linjer.")
+    item_ids = {line.get('purchase_order_item_id') for line in lines}
+    # Locked until commit, so two receipts of the same line cannot both pass the quantity check
+    items = {item.id: (item, status, order_supplier_id, site_id) for item, status, order_supplier_id, site_id in
+             session.query(PurchaseOrderItem, PurchaseOrder.status, PurchaseOrder.supplier_id, PurchaseOrder.site_id)
+             .join(PurchaseOrder, PurchaseOrder.id == PurchaseOrderItem.purchase_order_id)
+             .filter(PurchaseOrderItem.id.in_([i for i in item_ids if i is not None]))
+             .with_for_update()}
+
+    errors, rows, priced, requested, first_line = [], [], [], defaultdict(float), {}
+    receipt_site_id = None
+    for number, line in enumerate(lines, start=1):
+        entry = items.get(line.get('purchase_order_item_id'))
+        quantity = line.get('quantity')
+        batch_id = str(line.get('batch_id') or '').strip()
+        if entry is None:
+            errors.append((number, "ordrelinjen findes ikke"))
+            continue
+        item, status, order_supplier_id, site_id = entry
+        receipt_site_id = receipt_site_id or site_id
+        if order_supplier_id != supplier_id:
+            errors.append((number, "ordren er fra en anden leverandør"))
+        elif site_id != receipt_site_id:
+            errors.append((number, "ordren hører til et andet produktionssted"))
+        elif status not in OPEN_STATUSES:
+            errors.append((number, f"ordren er {status.lower()}"))
+        elif quantity is None or not quantity > 0:
+            errors.append((number, "mængden skal være større end 0"))
+        elif not batch_id:
+            errors.append((number, "batch ID er påkrævet"))
+        else:
+            requested[item.id] += quantity
+            first_line.setdefault(item.id, number)
+            unit_cost = line.get('unit_cost')
+            if unit_cost is not None:
+                priced.append({'i_id': item.id, 'i_cost': float(unit_cost)})
+            rows.append({
+                'purchase_order_item_id': item.id,
+                'material_id': item.material_id,
+                'batch_id': batch_id,
+                'quantity': float(quantity),
+                'unit': item.unit,
+                'expiry_date': _as_date(line.get('expiry_date')),
+                'unit_cost': item.unit_cost if unit_cost is None else float(unit_cost),
+            })
+    for item_id, quantity in requested.items():
+        item = items[item_id][0]
+        outstanding = item.quantity - item.quantity_received
+        if quantity > outstanding + RECEIPT_TOLERANCE:
+            errors.append((first_line[item_id], f"mere end bestilt (udestående {outstanding:g} {item.unit})"))
+    _raise_line_errors(errors)
+
+    receipt = GoodsReceipt(supplier_id=supplier_id, date=date, delivery_note=delivery_note or None, checked=checked,
+                           created_at=datetime.datetime.now(), site_id=receipt_site_id)
+    session.add(receipt)
+    session.flush()
+    line_table = GoodsReceiptLine.__table__
+    session.execute(insert(line_table), [dict(row, goods_receipt_id=receipt.id) for row in rows])
+    received = line_table.c.goods_receipt_id == receipt.id
+
+    # One batch per receipt line, straight from the lines just written
+    batch_table = MaterialBatch.__table__
+    session.execute(insert(batch_table).from_select(
+        ['material_id', 'batch_id', 'quantity', 'unit', 'date', 'checked', 'qc_status', 'expiry_date', 'unit_cost', 'available',
+         'goods_receipt_line_id', 'site_id'],
+        select(line_table.c.material_id, line_table.c.batch_id, line_table.c.quantity, line_table.c.unit,
+               literal(date, Date), literal(bool(checked), Boolean), literal(QC_RELEASED if checked else QC_PENDING),
+               line_table.c.expiry_date, line_table.c.unit_cost,
+               line_table.c.quantity > AVAILABLE_EPSILON, line_table.c.id, literal(receipt_site_id, Integer))
+        .where(received)
+    ))
+    # Stock and received quantities as relative updates, summed per material and order line inside the statement
+    material_table, item_table = Material.__table__, PurchaseOrderItem.__table__
+    material_ids = sorted({row['material_id'] for row in rows})
+    session.execute(
+        update(material_table).where(material_table.c.id.in_(material_ids))
+        .values(quantity=material_table.c.quantity + select(
+            func.sum(line_table.c.quantity * _unit_factor(line_table.c.unit, material_table.c.unit)))
+            .where(received, line_table.c.material_id == material_table.c.id).scalar_subquery())
+    )
+    session.execute(
+        update(item_table).where(item_table.c.id.in_(list(requested)))
+        .values(quantity_received=item_table.c.quantity_received + select(func.sum(line_table.c.quantity))
+                .where(received, line_table.c.purchase_order_item_id == item_table.c.id).scalar_subquery())
+    )
+
+    # Prices given at receipt replace the order price; the latest one becomes the material's standard cost
+    if priced:
+        session.execute(update(item_table).where(item_table.c.id == bindparam('i_id')).values(unit_cost=bindparam('i_cost')), priced)
+    material_units = dict(session.query(Material.id, Material.unit).filter(Material.id.in_(material_ids)).all())
+    standard_costs = {row['material_id']: row['unit_cost'] / convert_units(1.0, row['unit'], material_units[row['material_id']])
+                      for row in rows if row['unit_cost'] is not None}
+    if standard_costs:
+        session.execute(update(material_table).where(material_table.c.id == bindparam('m_id')).values(standard_cost=bindparam('m_cost')),
+                        [{'m_id': material_id, 'm_cost': cost} for material_id, cost in standard_costs.items()])
+
+    order_table = PurchaseOrder.__table__
+    order_ids = sorted({items[item_id][0].purchase_order_id for item_id in requested})
+    outstanding_orders = (select(item_table.c.purchase_order_id)
+                          .where(item_table.c.purchase_order_id.in_(order_ids),
+                                 item_table.c.quantity_received < item_table.c.quantity - RECEIPT_TOLERANCE))
+    session.execute(
+        update(order_table).where(order_table.c.id.in_(order_ids))
+        .values(status=case((order_table.c.id.in_(outstanding_orders), PARTIALLY_RECEIVED), else_=RECEIVED))
+    )
+
+    # Objects already loaded in this session still hold the old values
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Material):
+            session.expire(obj, ['quantity', 'standard_cost'])
+        elif isinstance(obj, PurchaseOrderItem):
+            session.expire(obj, ['quantity_received', 'unit_cost'])
+        elif isinstance(obj, PurchaseOrder):
+            session.expire(obj, ['status'])
+    session.flush()
+    return receipt
+
+def pending_deliveries(session, supplier_id=None):
+    # Order lines still waiting for goods, oldest order first; driven by the (status, supplier_id, date) index
+    outstanding = PurchaseOrderItem.quantity - PurchaseOrderItem.quantity_received
+    query = (session.query(PurchaseOrderItem.id, PurchaseOrder.id.label('purchase_order_id'), PurchaseOrder.supplier_id,
+                           Supplier.name.label('supplier_name'), PurchaseOrder.date, PurchaseOrderItem.material_id,
+                           Material.name.label('material_name'), PurchaseOrderItem.quantity, PurchaseOrderItem.quantity_received,
+                           outstanding.label('outstanding'), PurchaseOrderItem.unit, PurchaseOrderItem.unit_cost)
+             .join(PurchaseOrder, PurchaseOrder.id == PurchaseOrderItem.purchase_order_id)
+             .join(Supplier, Supplier.id == PurchaseOrder.supplier_id)
+             .join(Material, Material.id == PurchaseOrderItem.material_id)
+             .filter(PurchaseOrder.status.in_(OPEN_STATUSES), outstanding > RECEIPT_TOLERANCE))
+    if supplier_id is not None:
+        query = query.filter(PurchaseOrder.supplier_id == supplier_id)
+    return query.order_by(PurchaseOrder.date, PurchaseOrder.id, PurchaseOrderItem.id).all()
+
+def delete_purchase_order(session, purchase_order_id):
+    # Received goods are taken out of stock again: the batches of its receipt lines, or for orders
+    # received before receipts existed, the batch with the line's batch ID
+    purchase_order = _get(session, PurchaseOrder, purchase_order_id, "Indkøbsordren findes ikke.")
+    items = session.query(PurchaseOrderItem).filter_by(purchase_order_id=purchase_order_id).all()
+    materials = _by_id(session, Material, [item.material_id for item in items])
+    receipt_lines = defaultdict(list)
+    for line in session.query(GoodsReceiptLine).filter(GoodsReceiptLine.purchase_order_item_id.in_([item.id for item in items])):
+        receipt_lines[line.purchase_order_item_id].append(line)
+    batches = {batch.goods_receipt_line_id: batch for batch in session.query(MaterialBatch).filter(
+        MaterialBatch.goods_receipt_line_id.in_([line.id for lines in receipt_lines.values() for line in lines]))}
+    legacy_batches = {item.id: session.query(MaterialBatch).filter_by(material_id=item.material_id, batch_id=item.batch_id).first()
+                      for item in items if not receipt_lines[item.id] and item.quantity_received > 0}
+    # The inspections of the batches go first
+    batch_ids = [batch.id for batch in list(batches.values()) + list(legacy_batches.values()) if batch is not None]
+    if batch_ids:
+        session.query(QualityInspection).filter(QualityInspection.material_batch_id.in_(batch_ids)).delete(synchronize_session=False)
+    receipt_ids = set()
+    for item in items:
+        material = materials[item.material_id]
+        for line in receipt_lines[item.id]:
+            material.quantity -= convert_units(line.quantity, line.unit, material.unit)
+            if line.id in batches:
+                session.delete(batches[line.id])
+            receipt_ids.add(line.goods_receipt_id)
+            session.delete(line)
+        if not receipt_lines[item.id] and item.quantity_received > 0:
+            material.quantity -= convert_units(item.quantity_received, item.unit, material.unit)
+            batch = legacy_batches[item.id]
+            if batch:
+                session.delete(batch)
+        session.delete(item)
+    session.delete(purchase_order)
+    session.flush()
+    # Receipts that only covered this order go with it
+    for receipt_id in receipt_ids:
+        if not session.query(GoodsReceiptLine.id).filter_by(goods_receipt_id=receipt_id).first():
+            session.delete(session.get(GoodsReceipt, receipt_id))
+
+# Production
+# Orders planned ahead have no batch yet; they become produced orders through produce(production_order_id=...)
+PLANNED_STATUSES = ('Afventer', 'Planlagt')
+
+def is_produced(order):
+    return bool(order.batch_id)
+
+def create_production_line(session, name, minutes_per_day):
+    if minutes_per_day <= 0:
+        raise ServiceError("Kapaciteten skal være større end 0.")
+    line = ProductionLine(name=name, minutes_per_day=minutes_per_day, active=True)
+    session.add(line)
+    session.flush()
+    return line
+
+def plan_production_order(session, product_id, quantity, due_date, priority=0, date=None):
+    if quantity <= 0:
+        raise ServiceError("Mængden skal være større end 0.")
+    _get(session, Product, product_id, "Produktet findes ikke.")
+    if session.query(Recipe.id).filter_by(product_id=product_id).first() is None:
+        raise ServiceError("Ingen opskrift fundet for det valgte produkt.")
+    order = ProductionOrder(product_id=product_id, quantity=quantity, status='Afventer', batch_id='',
+                            date=date or datetime.date.today(), due_date=_as_date(due_date), priority=priority)
+    session.add(order)
+    session.flush()
+    return order
+
+def required_components(session, product_id, quantity):
+    recipe = session.query(Recipe).filter_by(product_id=product_id).first()
+    if recipe is None:
+        raise ServiceError("Ingen opskrift fundet for det valgte produkt.")
+    bom_items = session.query(BoM).filter_by(recipe_id=recipe.id).all()
+    if not bom_items:
+        raise ServiceError("Ingen stykliste fundet for det valgte produkt.")
+    scaling_factor = quantity / recipe.output_quantity if recipe.output_quantity != 0 else 1
+    return recipe, [(bom, bom.quantity_required * scaling_factor) for bom in bom_items]
+
+def produce(session, product_id, quantity, batch_id, date, allocations, expiry_date=None, production_order_id=None):
+    # allocations: dicts with bom_id, batch_id (database id of the component batch) and quantity in the BoM unit.
+    # With production_order_id a planned order is completed instead of creating a new one.
+    if not batch_id or not batch_id.strip():
+        raise ServiceError("Batch ID er påkrævet.")
+    if quantity <= 0:
+        raise ServiceError("Mængden skal være større end 0.")
+    product = _get(session, Product, product_id, "Produktet findes ikke.")
+    recipe, requirements = required_components(session, product_id, quantity)
+    allocations_by_bom = {}
+    for alloc in allocations:
+        allocations_by_bom.setdefault(alloc['bom_id'], []).append(alloc)
+    for bom, required_total in requirements:
+        allocated = sum(alloc['quantity'] for alloc in allocations_by_bom.get(bom.id, []))
+        if allocated < required_total:
+            raise ServiceError("Der er ikke nok komponenter tildelt til at producere den ønskede mængde.")
+
+    material_batches = _by_id(session, MaterialBatch, [a['batch_id'] for bom, _ in requirements
+                                                       if bom.component_material_id for a in allocations_by_bom.get(bom.id, [])])
+    product_batches = _by_id(session, ProductBatch, [a['batch_id'] for bom, _ in requirements
+                                                     if bom.component_product_id for a in allocations_by_bom.get(bom.id, [])])
+    materials = _by_id(session, Material, [bom.component_material_id for bom, _ in requirements if bom.component_material_id])
+    products = _by_id(session, Product, [bom.component_product_id for bom, _ in requirements if bom.component_product_id])
+
+    if production_order_id is not None:
+        new_order = _get(session, ProductionOrder, production_order_id, "Produktionsordren findes ikke.")
+        if is_produced(new_order) or new_order.product_id != product_id:
+            raise ServiceError("Produktionsordren er allerede produceret eller gælder et andet produkt.")
+        new_order.quantity, new_order.status, new_order.batch_id, new_order.date = quantity, 'Afsluttet', batch_id, date
+    else:
+        new_order = ProductionOrder(product_id=product_id, quantity=quantity, status='Afsluttet', batch_id=batch_id, date=date)
+        session.add(new_order)
+    session.flush()
+    # Actual cost of the new batch: the cost of every consumed batch; unknown if any of them has no cost
+    total_cost = 0.0
+    for bom, _ in requirements:
+        if bom.component_material_id:
+            batches, component = material_batches, materials[bom.component_material_id]
+        else:
+            batches, component = product_batches, products[bom.component_product_id]
+        for alloc in allocations_by_bom.get(bom.id, []):
+            batch = batches.get(alloc['batch_id'])
+            if batch is None:
+                raise ServiceError(f"Batch med ID {alloc['batch_id']} findes ikke.")
+            # Allocations come from the pages and from API clients; a batch only counts for its own item
+            if ((batch.material_id != bom.component_material_id) if bom.component_material_id
+                    else (batch.product_id != bom.component_product_id)):
+                raise ServiceError(f"Batch {batch.batch_id} hører ikke til {component.name}.")
+            if bom.component_material_id and batch.qc_status != QC_RELEASED:
+                raise ServiceError(f"Batch {batch.batch_id} er ikke frigivet af kvalitetskontrollen ({batch.qc_status.lower()}).")
+            batch_quantity_to_deduct = convert_units(alloc['quantity'], bom.unit, batch.unit)
+            if batch_quantity_to_deduct > batch.quantity + 1e-9:
+                raise ServiceError(f"Batch {batch.batch_id} har ikke nok på lager.")
+            batch.quantity -= batch_quantity_to_deduct
+            batch.last_used = date
+            if total_cost is not None and batch.unit_cost is not None:
+                total_cost += batch_quantity_to_deduct * batch.unit_cost
+            else:
+                total_cost = None
+            component.quantity -= convert_units(alloc['quantity'], bom.unit, component.unit)
+            session.add(ProductionOrderComponent(
+                production_order_id=new_order.id,
+                component_material_id=bom.component_material_id,
+                component_product_id=bom.component_product_id,
+                batch_id=batch.id,
+                quantity_used=alloc['quantity'],
+                unit=bom.unit
+            ))
+
+    product.quantity += quantity
+    session.add(ProductBatch(product_id=product_id, batch_id=batch_id, quantity=quantity, unit=product.unit, date=date,
+                             expiry_date=_as_date(expiry_date), unit_cost=None if total_cost is None else total_cost / quantity))
+    session.flush()
+    # Only the consumed materials get new consumption statistics, not the whole catalog
+    replenishment.refresh_stats(session, {bom.component_material_id for bom, _ in requirements if bom.component_material_id},
+                                incremental=True)
+    return new_order
+
+def update_production_order(session, production_order_id, status, quantity, product_id):
+    order = _get(session, ProductionOrder, production_order_id, "Produktionsordren findes ikke.")
+    new_product = _get(session, Product, product_id, "Produktet findes ikke.")
+    if is_produced(order):
+        old_product = _get(session, Product, order.product_id, "Produktet findes ikke.")
+        old_product.quantity -= order.quantity
+        new_product.quantity += quantity
+    order.status = status
+    order.quantity = quantity
+    order.product_id = product_id
+    return order
+
+def delete_production_order(session, production_order_id):
+    order = _get(session, ProductionOrder, production_order_id, "Produktionsordren findes ikke.")
+    if not is_produced(order):
+        session.delete(order)
+        return
+    product = _get(session, Product, order.product_id, "Produktet findes ikke.")
+    product.quantity -= order.quantity
+    product_batch = session.query(ProductBatch).filter_by(product_id=order.product_id, batch_id=order.batch_id).first()
+    if product_batch:
+        session.delete(product_batch)
+    components_used = session.query(ProductionOrderComponent).filter_by(production_order_id=production_order_id).all()
+    materials = _by_id(session, Material, [c.component_material_id for c in components_used if c.component_material_id])
+    products = _by_id(session, Product, [c.component_product_id for c in components_used if c.component_product_id])
+    material_batches = _by_id(session, MaterialBatch, [c.batch_id for c in components_used if c.component_material_id])
+    product_batches = _by_id(session, ProductBatch, [c.batch_id for c in components_used if c.component_product_id])
+    for component in components_used:
+        if component.component_material_id:
+            item = materials[component.component_material_id]
+            batch = material_batches.get(component.batch_id)
+        else:
+            item = products[component.component_product_id]
+            batch = product_batches.get(component.batch_id)
+        if batch is not None:
+            batch.quantity += convert_units(component.quantity_used, component.unit, batch.unit)
+        item.quantity += convert_units(component.quantity_used, component.unit, item.unit)
+        session.delete(component)
+    session.delete(order)
+    session.flush()
+    replenishment.refresh_stats(session, set(materials), incremental=True)
+
+# Sales
+def sell(session, customer_id, date, lines):
+    # lines: dicts with product_id, quantity and unit as ordered, plus allocations
+    # (dicts with batch_id and quantity in the product's own unit)
+    lines = [line for line in lines if line['quantity'] > 0]
+    if not lines:
+        raise ServiceError("Salgsordren har ingen produkter.")
+    _get(session, Customer, customer_id, "Kunden findes ikke.")
+    products = _by_id(session, Product, [line['product_id'] for line in lines])
+    batches = _by_id(session, ProductBatch, [a['batch_id'] for line in lines for a in line['allocations']])
+    sales_order = SalesOrder(customer_id=customer_id, status='Afsluttet', date=date)
+    session.add(sales_order)
+    session.flush()
+    for line in lines:
+        product = products.get(line['product_id'])
+        if product is None:
+            raise ServiceError(f"Produkt med ID {line['product_id']} findes ikke længere.")
+        converted_required = convert_units(line['quantity'], line['unit'], product.unit)
+        total_allocated = sum(a['quantity'] for a in line['allocations'])
+        if total_allocated < converted_required:
+            raise ServiceError(f"Ikke nok batchallokering for {product.name}.")
+        item = SalesOrderItem(sales_order_id=sales_order.id, product_id=product.id, quantity=line['quantity'], unit=line['unit'])
+        for alloc in line['allocations']:
+            batch = batches.get(alloc['batch_id'])
+            if batch is None or batch.product_id != product.id:
+                raise ServiceError(f"Batch med ID {alloc['batch_id']} hører ikke til {product.name}.")
+            deduct_qty = convert_units(alloc['quantity'], product.unit, batch.unit)
+            if deduct_qty > batch.quantity + 1e-9:
+                raise ServiceError(f"Batch {batch.batch_id} har ikke nok på lager.")
+            batch.quantity -= deduct_qty
+            batch.last_used = date
+            item.batches.append(SalesOrderItemBatch(batch_id=batch.id, quantity_used=deduct_qty, unit=batch.unit))
+        product.quantity -= total_allocated
+        session.add(item)
+    session.flush()
+    return sales_order
+
+def delete_sales_order(session, sales_order_id):
+    # Puts back what was taken from each batch, as delete_production_order does for the components
+    sales_order = _get(session, SalesOrder, sales_order_id, "Salgsordren findes ikke.")
+    if any(not item.batches for item in sales_order.items):
+        raise ServiceError("Salgsordren er fra før batchene blev gemt på ordrelinjerne, så den kan ikke slettes "
+                           "uden at lageret og batchene kommer ud af trit.")
+    products = _by_id(session, Product, [item.product_id for item in sales_order.items])
+    batches = _by_id(session, ProductBatch, [used.batch_id for item in sales_order.items for used in item.batches])
+    for item in sales_order.items:
+        product = products[item.product_id]
+        for used in item.batches:
+            batch = batches.get(used.batch_id)
+            if batch is not None:
+                batch.quantity += convert_units(used.quantity_used, used.unit, batch.unit)
+            product.quantity += convert_units(used.quantity_used, used.unit, product.unit)
+    session.delete(sales_order)
+    session.flush()
+
+# Disposal
+def dispose(session, kind, batch_id, quantity, reason, date):
+    # kind is 'material' or 'product'; quantity is in the batch's unit
+    if kind not in BATCH_KINDS:
+        raise ServiceError(f"Ugyldig type: {kind} (material eller product).")
+    if quantity <= 0:
+        raise ServiceError("Mængden skal være større end 0.")
+    if not reason or not reason.strip():
+        raise ServiceError("Årsag er påkrævet.")
+    if kind == 'material':
+        batch = _get(session, MaterialBatch, batch_id, "Batchen findes ikke.")
+        item = _get(session, Material, batch.material_id, "Materialet findes ikke.")
+    else:
+        batch = _get(session, ProductBatch, batch_id, "Batchen findes ikke.")
+        item = _get(session, Product, batch.product_id, "Produktet findes ikke.")
+    if quantity > batch.quantity + 1e-9:
+        raise ServiceError("Der kan ikke bortskaffes mere end batchens mængde.")
+    batch.quantity -= quantity
+    item.quantity -= convert_units(quantity, batch.unit, item.unit)
+    record = DisposalRecord(
+        material_id=item.id if kind == 'material' else None,
+        product_id=item.id if kind == 'product' else None,
+        batch_id=batch.id,
+        quantity=quantity,
+        unit=batch.unit,
+        reason=reason,
+        date=date,
+        site_id=batch.site_id
+    )
+    session.add(record)
+    session.flush()
+    return record
+
+BATCH_KINDS = {
+    'material': (MaterialBatch, Material, 'material_id'),
+    'product': (ProductBatch, Product, 'product_id'),
+}
+
+MAX_REPORTED_ERRORS = 10
+
+def _raise_line_errors(errors):
+    # errors: (line number, message) for every invalid line of an upload or receipt
+    if errors:
+        errors = [f"Linje {line}: {message}" for line, message in sorted(errors)]
+        more = f" (og {len(errors) - MAX_REPORTED_ERRORS} flere)" if len(errors) > MAX_REPORTED_ERRORS else ""
+        raise ServiceError("; ".join(errors[:MAX_REPORTED_ERRORS]) + more)
+
+def dispose_many(session, kind, lines, date, reason=None):
+    # Bulk write-off in one transaction. lines: dicts (or a DataFrame) with batch_id (database id),
+    # quantity in the batch unit (empty means everything left) and optionally reason (falls back to reason).
+    # All lines are validated together before anything is written; then one multi-row insert of
+    # DisposalRecords and one executemany UPDATE each for batches and for materials/products.
+    batch_model, item_model, item_key = BATCH_KINDS[kind]
+    df = pd.DataFrame(lines).reindex(columns=['batch_id', 'quantity', 'reason'])
+    if df.empty:
+        raise ServiceError("Ingen batches valgt.")
+    df['line'] = range(1, len(df) + 1)
+    df['batch_id'] = pd.to_numeric(df['batch_id'], errors='coerce')
+    df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce')
+    df['reason'] = df['reason'].where(df['reason'].notna() & (df['reason'].astype(str).str.strip() != ''), reason)
+    df['reason'] = df['reason'].fillna('').astype(str).str.strip()
+
+    batch_ids = [int(i) for i in df['batch_id'].dropna().unique()]
+    batches = pd.DataFrame(
+        session.query(batch_model.id, getattr(batch_model, item_key), batch_model.quantity, batch_model.unit, batch_model.site_id)
+        .filter(batch_model.id.in_(batch_ids)).all() if batch_ids else [],
+        columns=['batch_id', 'item_id', 'available', 'unit', 'site_id']
+    )
+    df = df.merge(batches, on='batch_id', how='left')
+    df['quantity'] = df['quantity'].fillna(df['available'])
+    requested = df.groupby('batch_id')['quantity'].transform('sum')
+
+    checks = [
+        (df['item_id'].isna(), "batchen findes ikke"),
+        (df['item_id'].notna() & ~(df['quantity'] > 0), "mængden skal være større end 0"),
+        (df['item_id'].notna() & (requested > df['available'] + 1e-9), "mere end batchens mængde"),
+        (df['reason'] == '', "årsag er påkrævet"),
+    ]
+    errors = sorted((line, message) for mask, message in checks for line in df.loc[mask, 'line'])
+    _raise_line_errors(errors)
+
+    df['batch_id'] = df['batch_id'].astype(int)
+    df['item_id'] = df['item_id'].astype(int)
+    item_units = dict(session.query(item_model.id, item_model.unit).filter(item_model.id.in_([int(i) for i in df['item_id'].unique()])).all())
+    df['item_quantity'] = [convert_units(q, unit, item_units[item_id])
+                           for q, unit, item_id in zip(df['quantity'], df['unit'], df['item_id'])]
+
+    session.execute(insert(DisposalRecord), [
+        {item_key: int(row.item_id), 'batch_id': int(row.batch_id), 'quantity': float(row.quantity),
+         'unit': row.unit, 'reason': row.reason, 'date': date, 'site_id': int(row.site_id)}
+        for row in df.itertuples()
+    ])
+    # Relative updates (quantity = quantity - x), so concurrent stock movements are not overwritten
+    batch_table, item_table = batch_model.__table__, item_model.__table__
+    per_batch = df.groupby('batch_id')['quantity'].sum()
+    session.execute(
+        update(batch_table).where(batch_table.c.id == bindparam('b_id'))
+        .values(quantity=batch_table.c.quantity - bindparam('b_quantity')),
+        [{'b_id': int(i), 'b_quantity': float(q)} for i, q in per_batch.items()]
+    )
+    # Separate statement: MySQL would evaluate a second SET against the already reduced quantity
+    session.execute(
+        update(batch_table).where(batch_table.c.id.in_([int(i) for i in per_batch.index]),
+                                  batch_table.c.quantity <= AVAILABLE_EPSILON)
+        .values(available=False)
+    )
+    per_item = df.groupby('item_id')['item_quantity'].sum()
+    session.execute(
+        update(item_table).where(item_table.c.id == bindparam('i_id'))
+        .values(quantity=item_table.c.quantity - bindparam('i_quantity')),
+        [{'i_id': int(i), 'i_quantity': float(q)} for i, q in per_item.items()]
+    )
+    # Objects already loaded in this session still hold the old quantities
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, batch_model):
+            session.expire(obj, ['quantity', 'available'])
+        elif isinstance(obj, item_model):
+            session.expire(obj, ['quantity'])
+    return {'lines': len(df), 'batches': len(per_batch), 'items': len(per_item)}
+
+# Quality control
+# Received material batches wait in the inspection queue (QC_PENDING) unless they were checked at receipt.
+# An inspection releases a batch for production or holds it (QC_HELD), for example until it is returned or
+# written off; a released batch can be held again later. Every inspection is kept in quality_inspection.
+QC_RESULTS = (QC_RELEASED, QC_HELD)
+
+def pending_inspections(session, status=QC_PENDING, limit=200):
+    # Batches with stock in the given status, oldest delivery first; a range scan on the (site_id, qc_status, date) index
+    return (session.query(MaterialBatch.id, MaterialBatch.batch_id, MaterialBatch.material_id, Material.name.label('material_name'),
+                          MaterialBatch.quantity, MaterialBatch.unit, MaterialBatch.date, MaterialBatch.expiry_date,
+                          MaterialBatch.qc_status)
+            .join(Material, Material.id == MaterialBatch.material_id)
+            .filter(MaterialBatch.qc_status == status, MaterialBatch.available == true())
+            .order_by(MaterialBatch.date, MaterialBatch.id)
+            .limit(limit).all())
+
+def record_inspections(session, lines, inspector, result=None, notes=None, inspected_at=None):
+    # lines: dicts with batch_id (database id of a material batch), optionally result (QC_RELEASED or QC_HELD,
+    # falls back to result) and notes. All lines are validated together; then one multi-row insert of the
+    # inspections and one UPDATE per result, so releasing a whole delivery is one short transaction.
+    if not lines:
+        raise ServiceError("Ingen batches valgt.")
+    inspected_at = inspected_at or datetime.datetime.now()
+    requested = [line.get('batch_id') for line in lines]
+    # Locked until commit, so a batch is not allocated while it is being held
+    batches = dict(session.query(MaterialBatch.id, MaterialBatch.site_id)
+                   .filter(MaterialBatch.id.in_([int(i) for i in requested if i is not None]))
+                   .with_for_update().all())
+    errors, rows, seen = [], [], set()
+    for number, line in enumerate(lines, start=1):
+        batch_id = int(line['batch_id']) if line.get('batch_id') is not None else None
+        line_result = line.get('result') or result
+        line_notes = str(line.get('notes') or notes or '').strip()[:255]
+        if batch_id not in batches:
+            errors.append((number, "batchen findes ikke"))
+        elif batch_id in seen:
+            errors.append((number, "batchen er med flere gange"))
+        elif line_result not in QC_RESULTS:
+            errors.append((number, f"ugyldigt resultat: {line_result}"))
+        elif line_result == QC_HELD and not line_notes:
+            errors.append((number, "årsag er påkrævet for at spærre"))
+        else:
+            seen.add(batch_id)
+            rows.append({'material_batch_id': batch_id, 'result': line_result, 'inspector': inspector,
+                         'notes': line_notes or None, 'inspected_at': inspected_at, 'site_id': batches[batch_id]})
+    _raise_line_errors(errors)
+
+    session.execute(insert(QualityInspection), rows)
+    batch_table = MaterialBatch.__table__
+    counts = {}
+    for status in QC_RESULTS:
+        ids = sorted(row['material_batch_id'] for row in rows if row['result'] == status)
+        counts[status] = len(ids)
+        if ids:
+            session.execute(update(batch_table).where(batch_table.c.id.in_(ids))
+                            .values(qc_status=status, checked=status == QC_RELEASED))
+    # Objects already loaded in this session still hold the old status
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, MaterialBatch):
+            session.expire(obj, ['qc_status', 'checked'])
+    return {'lines': len(rows), 'released': counts[QC_RELEASED], 'held': counts[QC_HELD]}
+
+def release_batches(session, batch_ids, inspector, notes=None):
+    return record_inspections(session, [{'batch_id': batch_id} for batch_id in batch_ids], inspector, QC_RELEASED, notes)
+
+def inspection_history(session, material_batch_id=None, limit=200):
+    query = (session.query(QualityInspection.inspected_at, QualityInspection.material_batch_id, MaterialBatch.batch_id,
+                           Material.name.label('material_name'), QualityInspection.result, QualityInspection.inspector,
+                           QualityInspection.notes)
+             .join(MaterialBatch, MaterialBatch.id == QualityInspection.material_batch_id)
+             .join(Material, Material.id == MaterialBatch.material_id))
+    if material_batch_id is not None:
+        query = query.filter(QualityInspection.material_batch_id == material_batch_id)
+    return query.order_by(QualityInspection.inspected_at.desc(), QualityInspection.id.desc()).limit(limit).all()
+
+# Expiry and stock ageing
+
+def expiring_batches(session, kind, until, limit=200):
+    # Range scan on the expiry_date index, closest to expiry first
+    batch_model = BATCH_KINDS[kind][0]
+    return (session.query(batch_model)
+            .filter(batch_model.expiry_date <= until, batch_model.available == true())
+            .order_by(batch_model.expiry_date)
+            .limit(limit).all())
+
+def idle_batches(session, kind, since, limit=200):
+    # Batches with stock that have not been used since the given date (or never used and received before it)
+    batch_model = BATCH_KINDS[kind][0]
+    return (session.query(batch_model)
+            .filter(batch_model.available == true(),
+                    or_(batch_model.last_used < since,
+                        and_(batch_model.last_used.is_(None), batch_model.date < since)))
+            .order_by(batch_model.date)
+            .limit(limit).all())
+
+def expiry_sweep(session, today, dispose=False, reason="Udløbet"):
+    # Flags every batch past its expiry date with a bulk UPDATE. With dispose=True the remaining
+    # stock is written off first through dispose_many.
+    result = {}
+    for kind, (batch_model, item_model, item_key) in BATCH_KINDS.items():
+        disposed = 0
+        if dispose:
+            expired_ids = [batch_id for (batch_id,) in session.query(batch_model.id)
+                           .filter(batch_model.expiry_date < today, batch_model.available == true())]
+            if expired_ids:
+                disposed = dispose_many(session, kind, [{'batch_id': batch_id} for batch_id in expired_ids], today, reason)['batches']
+        flagged = (session.query(batch_model)
+                   .filter(batch_model.expiry_date < today, batch_model.expired.is_(False))
+                   .update({batch_model.expired: True}, synchronize_session=False))
+        result[kind] = {'flagged': flagged, 'disposed': disposed}
+    session.flush()
+    return result
+
+# Stock reconciliation
+RECONCILE_TOLERANCE = 1e-6
+RECONCILE_CHUNK_SIZE = 1000
+
+def _unit_factor(from_unit, to_unit):
+    # convert_units as a SQL expression, so batch sums are converted inside the grouped query
+    return case(*[(and_(from_unit == f, to_unit == t), factor) for (f, t), factor in CONVERSION_FACTORS.items()], else_=1.0)
+
+def stock_discrepancies(session, kind, tolerance=RECONCILE_TOLERANCE):
+    # One grouped query per kind: the item total against the sum of its batches in the item unit.
+    # Item totals are company-wide, so batches of every site count.
+    batch_model, item_model, item_key = BATCH_KINDS[kind]
+    batch_total = func.coalesce(func.sum(batch_model.quantity * _unit_factor(batch_model.unit, item_model.unit)), 0.0)
+    with sites.unscoped(session):
+        rows = (session.query(item_model.id, item_model.name, item_model.unit, item_model.quantity, batch_total)
+                .outerjoin(batch_model, getattr(batch_model, item_key) == item_model.id)
+                .group_by(item_model.id, item_model.name, item_model.unit, item_model.quantity)
+                .having(func.abs(item_model.quantity - batch_total) > tolerance)
+                .order_by(item_model.id).all())
+    return [{'kind': kind, 'id': item_id, 'name': name, 'unit': unit, 'quantity': quantity, 'batch_total': total,
+             'difference': quantity - total}
+            for item_id, name, unit, quantity, total in rows]
+
+def reconcile_stock(session, repair=False, tolerance=RECONCILE_TOLERANCE):
+    # Reports every item whose quantity differs from its batches. With repair=True the totals are
+    # set to the batch sums in bulk; the sum is recomputed inside the UPDATE, so stock moved since
+    # the report is not overwritten with a stale value. Batch availability flags that disagree
+    # with the batch quantity are counted and repaired the same way.
+    with sites.unscoped(session):
+        return _reconcile_stock(session, repair, tolerance)
+
+def _reconcile_stock(session, repair, tolerance):
+    result = {}
+    for kind, (batch_model, item_model, item_key) in BATCH_KINDS.items():
+        discrepancies = stock_discrepancies(session, kind, tolerance)
+        repaired = 0
+        stale = or_(and_(batch_model.available == true(), batch_model.quantity <= AVAILABLE_EPSILON),
+                    and_(batch_model.available == false(), batch_model.quantity > AVAILABLE_EPSILON))
+        stale_flags = session.query(func.count(batch_model.id)).filter(stale).scalar()
+        if repair and stale_flags:
+            session.query(batch_model).filter(stale).update({batch_model.available: batch_model.quantity > AVAILABLE_EPSILON},
+                                                            synchronize_session=False)
+            for obj in list(session.identity_map.values()):
+                if isinstance(obj, batch_model):
+                    session.expire(obj, ['available'])
+        if repair and discrepancies:
+            batch_table, item_table = batch_model.__table__, item_model.__table__
+            batch_total = (select(func.coalesce(func.sum(batch_table.c.quantity * _unit_factor(batch_table.c.unit, item_table.c.unit)), 0.0))
+                           .where(batch_table.c[item_key] == item_table.c.id)
+                           .scalar_subquery())
+            ids = [row['id'] for row in discrepancies]
+            for start in range(0, len(ids), RECONCILE_CHUNK_SIZE):
+                repaired += session.execute(
+                    update(item_table).where(item_table.c.id.in_(ids[start:start + RECONCILE_CHUNK_SIZE])).values(quantity=batch_total)
+                ).rowcount
+            for obj in list(session.identity_map.values()):
+                if isinstance(obj, item_model):
+                    session.expire(obj, ['quantity'])
+        result[kind] = {'discrepancies': discrepancies, 'repaired': repaired, 'stale_flags': stale_flags}
+    session.flush()
+    return result
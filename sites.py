@@ -0,0 +1,51 @@
+import contextlib
+from sqlalchemy import event
+from sqlalchemy.orm import Session, with_loader_criteria
+from models import Site, SiteScoped
+
+# Production sites.
+# A session scoped to a site only sees that site's orders, batches, production lines, receipts and
+# disposals: every ORM query gets a site_id criterion (through with_loader_criteria, so joins and
+# relationship loads are limited too) and new rows get the session's site when they are flushed.
+# Sessions without a site (scheduled jobs, scripts, migrations) see all sites. Company-wide figures,
+# such as stock totals, standard costs and consumption statistics, are computed in unscoped().
+# Core statements on the plain tables are not limited; services use them on ids a scoped query found.
+
+def scope(session, site_id):
+    session.info['site_id'] = site_id
+    return session
+
+def current(session):
+    return session.info.get('site_id')
+
+@contextlib.contextmanager
+def unscoped(session):
+    site_id = session.info.pop('site_id', None)
+    try:
+        yield session
+    finally:
+        if site_id is not None:
+            session.info['site_id'] = site_id
+
+@event.listens_for(Session, "do_orm_execute")
+def _limit_to_site(orm_execute_state):
+    site_id = orm_execute_state.session.info.get('site_id')
+    if site_id is None or orm_execute_state.is_column_load:
+        return
+    # Not propagated to the loaded objects (they would not pickle for the page caches); lazy loads come through here as well
+    if orm_execute_state.is_select or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.statement = orm_execute_state.statement.options(
+            with_loader_criteria(SiteScoped, lambda cls: cls.site_id == site_id, include_aliases=True,
+                                 propagate_to_loaders=False))
+
+@event.listens_for(Session, "before_flush")
+def _assign_site(session, flush_context, instances):
+    site_id = session.info.get('site_id')
+    if site_id is None:
+        return
+    for obj in session.new:
+        if isinstance(obj, SiteScoped) and obj.site_id is None:
+            obj.site_id = site_id
+
+def all_sites(session):
+    return session.query(Site).order_by(Site.id).all()
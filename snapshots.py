@@ -0,0 +1,249 @@
+import logging
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal
+from sqlalchemy import inspect, select
+from sqlalchemy.engine import Row
+import instrumentation
+
+logger = logging.getLogger("erp.snapshots")
+
+# Shared lists for the app sessions.
+# Every session used to keep its own copy of the full lists (materials, products, orders, batches...)
+# in st.session_state, unpickled from st.cache_data, so memory grew with every connected browser.
+# Now a list is loaded once per process and version as a tuple of read-only rows, and all sessions
+# point at the same tuple. Saving loads the list again under a new version. Like before, the other
+# sessions keep the rows they have until they save something themselves (widget options are built
+# from them, so they must not change under an open form); sessions that open the app or change site
+# get the new version, and the old tuple is freed when no session points at it anymore.
+# A ledger records what each session keeps besides the shared lists, so memory can be shown per
+# session and in total, and sessions that have been idle for a while give back their lists and
+# derived data, which are loaded again if they return.
+
+IDLE_SECONDS = 30 * 60
+SESSION_BUDGET_BYTES = 20 * 2 ** 20
+SWEEP_INTERVAL_SECONDS = 60
+VERSIONS_KEY = 'snapshot_versions'
+# Session state that can be dropped from idle or oversized sessions and is rebuilt when needed
+DISPOSABLE_KEYS = ('unscheduled_orders',)
+
+Snapshot = namedtuple('Snapshot', 'rows version bytes loaded_at')
+
+_lock = threading.Lock()
+_versions = {}
+_snapshots = {}
+_sessions = {}
+_last_sweep = 0.0
+
+_ATOMIC = (str, bytes, int, float, bool, Decimal, date, datetime, type(None))
+
+def deep_size(value, seen=None):
+    # Approximate retained size in bytes: containers, rows and ORM objects are followed, other objects
+    # count with their own size (pandas objects report their data), and each object is counted once
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, _ATOMIC):
+        return size
+    if isinstance(value, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset, Row)):
+        size += sum(deep_size(v, seen) for v in value)
+    elif hasattr(value, '_sa_instance_state'):
+        size += sum(deep_size(v, seen) for k, v in vars(value).items() if k != '_sa_instance_state')
+    return size
+
+def rows(session, model, *criteria):
+    # The mapped columns only: rows are immutable, safe to share between threads and keep no session alive.
+    # Through the ORM, so the session's site scoping and replica routing apply
+    columns = [getattr(model, column_attr.key) for column_attr in inspect(model).column_attrs]
+    return session.execute(select(*columns).where(*criteria)).all()
+
+def _load(load, version):
+    rows = tuple(load())
+    stats = instrumentation.current()
+    if stats is not None:
+        stats.cache_misses += 1
+        stats.rows += len(rows)
+    return Snapshot(rows, version, deep_size(rows), time.time())
+
+def get(name, key, load):
+    stats = instrumentation.current()
+    if stats is not None:
+        stats.cache_calls += 1
+    with _lock:
+        version = _versions.get((name, key), 0)
+        snapshot = _snapshots.get((name, key))
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    snapshot = _load(load, version)
+    with _lock:
+        current = _snapshots.get((name, key))
+        # Another session may have loaded this version meanwhile; all sessions keep that one
+        if current is not None and current.version == version:
+            return current
+        if _versions.get((name, key), 0) == version:
+            _snapshots[(name, key)] = snapshot
+    return snapshot
+
+def _point(state, name, key, snapshot):
+    versions = state.get(VERSIONS_KEY)
+    if versions is None:
+        versions = state[VERSIONS_KEY] = {}
+    state[name] = snapshot.rows
+    versions[name] = (key, snapshot.version)
+    return snapshot.rows
+
+def attach(state, name, key, load):
+    # Gives the session the current snapshot of a list unless it already has one for this key
+    versions = state.get(VERSIONS_KEY) or {}
+    if name in state and versions.get(name, (None,))[0] == key:
+        return state[name]
+    return _point(state, name, key, get(name, key, load))
+
+def refresh(state, name, key, load):
+    # After a change: loaded by the session that made it (so from the primary), then published as the
+    # next version in one step, so no other session can publish a lagging replica read for it
+    snapshot = _load(load, None)
+    with _lock:
+        version = _versions[(name, key)] = _versions.get((name, key), 0) + 1
+        snapshot = _snapshots[(name, key)] = snapshot._replace(version=version)
+    return _point(state, name, key, snapshot)
+
+def version(name, key):
+    # The latest published version of a list, whichever version the sessions point at
+    with _lock:
+        return _versions.get((name, key), 0)
+
+def clear():
+    global _last_sweep
+    with _lock:
+        _versions.clear()
+        _snapshots.clear()
+        _sessions.clear()
+        _last_sweep = 0.0
+
+# Ledger
+def own_bytes(values):
+    # values: session state key -> value. Bytes per key, without the shared lists
+    shared = set(values.get(VERSIONS_KEY) or ())
+    return {key: deep_size(value) for key, value in values.items() if key not in shared}
+
+def _release(state, names):
+    for key in list(names) + [VERSIONS_KEY] + list(DISPOSABLE_KEYS):
+        if key in state:
+            del state[key]
+
+def track(session_id, state, budget_bytes=SESSION_BUDGET_BYTES, idle_seconds=IDLE_SECONDS):
+    # After each rerun of a session. state is the session's SafeSessionState; the ledger keeps the state
+    # behind it, as the wrapper only lives for one script run
+    values = state.filtered_state
+    sizes = own_bytes(values)
+    total = sum(sizes.values())
+    if total > budget_bytes:
+        largest = sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:3]
+        logger.warning("Session %s keeps %.1f MB in session state (largest: %s); dropping %s", session_id,
+                       total / 2 ** 20, ", ".join(f"{k} {v / 2 ** 20:.1f} MB" for k, v in largest), ", ".join(DISPOSABLE_KEYS))
+        for key in DISPOSABLE_KEYS:
+            if key in state:
+                total -= sizes.get(key, 0)
+                del state[key]
+    with _lock:
+        shared = {name: (key, version, _shared_bytes(name, key, version))
+                  for name, (key, version) in (values.get(VERSIONS_KEY) or {}).items()}
+        _sessions[session_id] = {'state': getattr(state, '_state', state), 'last_seen': time.time(),
+                                 'bytes': total, 'largest': max(sizes, key=sizes.get) if sizes else None,
+                                 'snapshots': shared, 'evicted': False}
+    sweep(idle_seconds)
+
+def _shared_bytes(name, key, version):
+    snapshot = _snapshots.get((name, key))
+    if snapshot is not None and snapshot.version == version:
+        return snapshot.bytes
+    # An older version this session still points at; keep what was recorded for it
+    for record in _sessions.values():
+        if record['snapshots'].get(name, (None, None))[:2] == (key, version):
+            return record['snapshots'][name][2]
+    return 0
+
+def _is_open(session_id):
+    # Sessions Streamlit has closed are forgotten, so the ledger does not keep their state alive
+    from streamlit.runtime import Runtime
+    return not Runtime.exists() or Runtime.instance().is_active_session(session_id)
+
+def sweep(idle_seconds=IDLE_SECONDS, force=False):
+    # Sessions idle for idle_seconds give back their lists and derived data; returns how many did
+    global _last_sweep
+    now = time.time()
+    with _lock:
+        if not force and now - _last_sweep < SWEEP_INTERVAL_SECONDS:
+            return 0
+        _last_sweep = now
+        records = list(_sessions.items())
+    evicted = 0
+    for session_id, record in records:
+        if not _is_open(session_id):
+            with _lock:
+                _sessions.pop(session_id, None)
+            continue
+        state = record['state']
+        if record['evicted'] or now - record['last_seen'] < idle_seconds:
+            continue
+        _release(state, record['snapshots'])
+        sizes = own_bytes(state.filtered_state)
+        with _lock:
+            record.update(evicted=True, snapshots={}, bytes=sum(sizes.values()),
+                          largest=max(sizes, key=sizes.get) if sizes else None)
+        evicted += 1
+    if evicted:
+        logger.info("Released the lists of %d idle sessions", evicted)
+    return evicted
+
+def usage():
+    # Memory of the lists and sessions in this process, for the debug panel and the metrics
+    now = time.time()
+    with _lock:
+        current = {(name, key): snapshot for (name, key), snapshot in _snapshots.items()}
+        records = [(session_id, dict(record)) for session_id, record in _sessions.items()]
+    stale = {}
+    sessions = []
+    for session_id, record in records:
+        for name, (key, version, nbytes) in record['snapshots'].items():
+            snapshot = current.get((name, key))
+            if snapshot is None or snapshot.version != version:
+                stale[(name, key, version)] = nbytes
+        sessions.append({
+            'session': session_id[:8],
+            'idle_s': round(now - record['last_seen']),
+            'own_bytes': record['bytes'],
+            'shared_bytes': sum(nbytes for _, _, nbytes in record['snapshots'].values()),
+            'largest_key': record['largest'],
+            'evicted': record['evicted'],
+        })
+    snapshot_bytes = sum(s.bytes for s in current.values())
+    session_bytes = sum(s['own_bytes'] for s in sessions)
+    return {
+        'sessions': sorted(sessions, key=lambda s: s['own_bytes'], reverse=True),
+        'active_sessions': sum(1 for s in sessions if not s['evicted']),
+        'snapshots': {name + (f"@{key}" if key is not None else ""): {'version': s.version, 'rows': len(s.rows), 'bytes': s.bytes}
+                      for (name, key), s in sorted(current.items(), key=lambda item: (item[0][0], str(item[0][1])))},
+        'snapshot_bytes': snapshot_bytes,
+        'stale_snapshot_bytes': sum(stale.values()),
+        'session_bytes': session_bytes,
+        'total_bytes': snapshot_bytes + sum(stale.values()) + session_bytes,
+    }
+
+instrumentation.add_gauge('erp_sessions', 'Sessions holding their lists in this process',
+                          lambda: usage()['active_sessions'])
+instrumentation.add_gauge('erp_session_state_bytes', 'Session state bytes outside the shared lists, all sessions',
+                          lambda: usage()['session_bytes'])
+instrumentation.add_gauge('erp_snapshot_bytes', 'Bytes of the current shared lists',
+                          lambda: usage()['snapshot_bytes'])
+instrumentation.add_gauge('erp_stale_snapshot_bytes', 'Bytes of older list versions sessions still point at',
+                          lambda: usage()['stale_snapshot_bytes'])
@@ -0,0 +1,31 @@
+from datetime import date
+from planning import schedule_orders
+
+LINES = [{'id': 1, 'name': "Linje 1", 'minutes_per_day': 480.0}]
+RECIPES = {
+    # Product 1 is made from 2 of product 2 (the intermediate), which is made from 1 kg of material 1
+    1: {'output_quantity': 1, 'duration_minutes': 60, 'components': [('product', 2, 2, 'stk', 'stk')]},
+    2: {'output_quantity': 1, 'duration_minutes': 30, 'components': [('material', 1, 1, 'kg', 'kg')]},
+}
+
+def order(order_id, product_id, quantity, priority):
+    return {'id': order_id, 'product_id': product_id, 'quantity': quantity, 'due_date': None, 'priority': priority}
+
+def test_intermediate_from_lower_priority_order():
+    orders = [order(1, 1, 5, priority=10), order(2, 2, 10, priority=0)]
+    scheduled, unscheduled = schedule_orders(orders, RECIPES, LINES, {('material', 1): 10}, date(2026, 1, 5))
+    assert unscheduled == []
+    by_id = {o['id']: o for o in scheduled}
+    assert by_id[1]['start'] >= by_id[2]['end']
+
+def test_intermediate_never_made():
+    orders = [order(1, 1, 5, priority=10), order(2, 2, 4, priority=0)]
+    scheduled, unscheduled = schedule_orders(orders, RECIPES, LINES, {('material', 1): 10}, date(2026, 1, 5))
+    assert [o['id'] for o in scheduled] == [2]
+    assert [(o['id'], o['shortages']) for o in unscheduled] == [(1, [(('product', 2), 6)])]
+
+def test_material_shortage_is_not_deferred():
+    orders = [order(1, 2, 5, priority=0)]
+    scheduled, unscheduled = schedule_orders(orders, RECIPES, LINES, {('material', 1): 2}, date(2026, 1, 5))
+    assert scheduled == []
+    assert unscheduled[0]['shortages'] == [(('material', 1), 3)]
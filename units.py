@@ -0,0 +1,11 @@
+CONVERSION_FACTORS = {
+    ('kg', 'g'): 1000,
+    ('g', 'kg'): 0.001,
+    ('l', 'ml'): 1000,
+    ('ml', 'l'): 0.001,
+}
+
+def convert_units(quantity, from_unit, to_unit):
+    if from_unit == to_unit:
+        return quantity
+    return quantity * CONVERSION_FACTORS.get((from_unit, to_unit), 1)